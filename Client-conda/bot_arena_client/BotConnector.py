@@ -5,14 +5,99 @@ from bot_arena_proto.data import *
 from bot_arena_proto.event import Event
 from bot_arena_proto.session import ClientSession, ClientInfo
 
+import curio
 import pygame
 import time
-import subprocess
+from curio import subprocess
+
+
+# Both connectors run the bot without blocking the event loop, and kill it
+# if the call is cancelled (e.g. by `curio.timeout_after`).
 
 
 class BotConnector:
     def __init__(self, cmd: str):
         self.cmd = cmd
-    def start_bot(self, inp: str):
-        bot_process = subprocess.run(args=self.cmd,stdout=subprocess.PIPE, input=inp, encoding="ascii")
-        return bot_process.stdout
+    async def start_bot(self, inp: bytes):
+        bot_process = subprocess.Popen(args=self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            stdout, _ = await bot_process.communicate(inp)
+        except curio.CancelledError:
+            # Unlike `curio.subprocess.run`, do not wait for the rest of
+            # the output: the bot's children might still be holding the pipe.
+            bot_process.kill()
+            await bot_process.wait()
+            raise
+        await bot_process.wait()
+        return stdout.decode("ascii")
+    async def close(self):
+        pass
+
+
+class PersistentBotConnector:
+    """Keeps a single bot process for the whole game.
+
+    The bot gets the fields one after another on its stdin, in the same
+    format as in the one-shot mode, and must answer each of them with a line
+    on its stdout (flushing it). If the bot exits anyway, it is started again,
+    so a one-shot bot still works, only slower.
+
+    If the call is cancelled before the bot answers, the bot is killed (a late
+    answer would be taken for the answer to the next field).
+    """
+
+    def __init__(self, cmd: str):
+        self.cmd = cmd
+        self.bot_process = None
+
+    def launch(self):
+        # Unbuffered, so that every write reaches the bot right away.
+        self.bot_process = subprocess.Popen(args=self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+
+    async def start_bot(self, inp: bytes):
+        reused = self.bot_process is not None and self.bot_process.poll() is None
+        if not reused:
+            self.launch()
+        line = await self.exchange(inp)
+        if line == "" and reused:
+            # A one-shot bot exits right after its answer, which is only
+            # noticed here. Give the field to a fresh process.
+            self.launch()
+            line = await self.exchange(inp)
+        return line
+
+    async def exchange(self, inp: bytes):
+        try:
+            await self.bot_process.stdin.write(inp)
+            line = await self.bot_process.stdout.readline()
+        except OSError:
+            # The bot has exited in the meantime.
+            line = b""
+        except curio.CancelledError:
+            await self.kill()
+            raise
+        if line == b"":
+            # Reached EOF: the bot has exited without answering.
+            await self.kill()
+        return line.decode("ascii")
+
+    async def kill(self):
+        if self.bot_process is None:
+            return
+        bot_process = self.bot_process
+        self.bot_process = None
+        bot_process.kill()
+        await bot_process.wait()
+
+    async def close(self):
+        if self.bot_process is None:
+            return
+        try:
+            await self.bot_process.stdin.close()
+        except OSError:
+            pass
+        try:
+            await curio.timeout_after(0.1, self.bot_process.wait())
+        except curio.TaskTimeout:
+            pass
+        await self.kill()
@@ -35,6 +35,12 @@ class Ui_Hello(object):
         self.Cmd = QtWidgets.QLineEdit(Hello)
         self.Cmd.setGeometry(QtCore.QRect(10, 260, 311, 32))
         self.Cmd.setObjectName("Cmd")
+        self.Persistent = QtWidgets.QCheckBox(Hello)
+        self.Persistent.setGeometry(QtCore.QRect(10, 300, 311, 32))
+        self.Persistent.setObjectName("Persistent")
+        self.Binary = QtWidgets.QCheckBox(Hello)
+        self.Binary.setGeometry(QtCore.QRect(10, 335, 311, 32))
+        self.Binary.setObjectName("Binary")
         self.pushButton_2 = QtWidgets.QPushButton(Hello)
         self.pushButton_2.setGeometry(QtCore.QRect(10, 380, 221, 34))
         self.pushButton_2.setObjectName("pushButton_2")
@@ -47,4 +53,6 @@ class Ui_Hello(object):
         Hello.setWindowTitle(_translate("Hello", "Dialog"))
         self.label.setText(_translate("Hello", "Введите адрес сервера, хост. имя пользователя и команду для запуска вашего программируемого бота"))
         self.pushButton.setText(_translate("Hello", "Продолжить"))
+        self.Persistent.setText(_translate("Hello", "Запускать бота один раз на всю игру"))
+        self.Binary.setText(_translate("Hello", "Передавать поле боту в двоичном формате"))
         self.pushButton_2.setText(_translate("Hello", "Подключить в режиме просмотра"))
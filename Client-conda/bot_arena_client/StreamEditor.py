@@ -1,9 +1,11 @@
-from bot_arena_client.BotConnector import BotConnector
+from bot_arena_client.BotConnector import BotConnector, PersistentBotConnector
 from bot_arena_client.game_viewer_files import config as c
 from bot_arena_client.game_viewer_files.main_viewer import Viewer
 
+import sys
 import time
 import subprocess
+from array import array
 
 import pygame
 from bot_arena_proto.data import *
@@ -12,11 +14,37 @@ from bot_arena_proto.session import ClientSession, ClientInfo
 
 
 class StreamEditor:
+    """Turns the field into the bot's input and runs the bot.
+
+    The bot gets the field as text: the height, the width, the number marking
+    its own body and the number marking its head, followed by the cells row
+    by row (0 is empty, 1 is food, 2k and 2k + 1 are the body and the head
+    of the k-th snake), all separated by spaces.
+
+    A bot can opt in to a binary format instead: the same four numbers on
+    a text line, followed by the cells as 16-bit little-endian integers.
+    """
+
     inf = 1000000000
 
-    def __init__(self, snake_name:str, cmd:str):
+    # Text for the most common cell values, so that they are not formatted again every turn.
+    cell_tokens = [b"%d " % value for value in range(256)]
+
+    # The bot's answers and the moves they stand for.
+    moves = {
+        "0\n": Direction.DOWN(),
+        "1\n": Direction.RIGHT(),
+        "2\n": Direction.UP(),
+        "3\n": Direction.LEFT(),
+    }
+
+    def __init__(self, snake_name:str, cmd:str, persistent:bool = False, binary:bool = False):
         self.snake_name = snake_name
         self.cmd = cmd
+        self.binary = binary
+        self.empty_template = memoryview(b"")
+        # A persistent bot is started once and then reused for the whole game.
+        self.bot = PersistentBotConnector(cmd) if persistent else None
 
     def get_snake_index(self, field_state: FieldState):
         ind = 2
@@ -81,14 +109,94 @@ class StreamEditor:
         return str_out
 
     def make_str(self, f_height, f_width, field_state: FieldState):
-        matrix = self.field_to_matrix(f_height, f_width, field_state)
-        str_out = self.matrix_into_str(f_height, f_width, matrix, field_state)
-        return str_out
+        return self.encode_text(f_height, f_width, field_state).decode("ascii")
+
+    def nonzero_cells(self, f_height, f_width, field_state: FieldState):
+        """The same cells as in `field_to_matrix`, but only the non-empty ones,
+        as a dict from the index of a cell (counting row by row) to its value.
+
+        Only the snakes and the food are visited, not the whole field.
+        """
+
+        # Moving along a tail in the matrix, the same way as in `field_to_matrix`.
+        steps = {
+            Direction.UP(): f_width,
+            Direction.DOWN(): -f_width,
+            Direction.LEFT(): -1,
+            Direction.RIGHT(): 1,
+        }
+        cells = {}
+        snake_index = 2
+        for snake_state in field_state.snakes.values():
+            cell = snake_state.head.y * f_width + snake_state.head.x
+            cells[cell] = snake_index + 1
+            for direction in snake_state.tail:
+                cell += steps[direction]
+                cells[cell] = snake_index
+            snake_index += 2
 
-    def call_bot(self, f_height, f_width, field_state: FieldState):
-        cur_bot = BotConnector(self.cmd)
-        inp = self.make_str(f_height, f_width, field_state)
-        return cur_bot.start_bot(inp)
+        for apple in field_state.objects:
+            cells[apple[0].y * f_width + apple[0].x] = 1
+
+        return cells
+
+    def encode_header(self, f_height, f_width, field_state: FieldState):
+        ind = self.get_snake_index(field_state)
+        return b"%d %d %d %d" % (f_height, f_width, ind, ind + 1)
+
+    def encode_text(self, f_height, f_width, field_state: FieldState):
+        # Most of the cells are empty. Copy the runs of empty cells from
+        # a template and format only the rest.
+        empty = self.empty_cells(f_height * f_width)
+        cell_tokens = self.cell_tokens
+        parts = [self.encode_header(f_height, f_width, field_state), b" "]
+        start = 0
+        for cell, value in sorted(self.nonzero_cells(f_height, f_width, field_state).items()):
+            parts.append(empty[2 * start : 2 * cell])
+            parts.append(cell_tokens[value] if value < len(cell_tokens) else b"%d " % value)
+            start = cell + 1
+        parts.append(empty[2 * start :])
+        parts.append(b"\n")
+        return b"".join(parts)
+
+    def empty_cells(self, num_cells):
+        if len(self.empty_template) != 2 * num_cells:
+            self.empty_template = memoryview(b"0 " * num_cells)
+        return self.empty_template
+
+    def encode_binary(self, f_height, f_width, field_state: FieldState):
+        cells = array("H", bytes(2 * f_height * f_width))
+        for cell, value in self.nonzero_cells(f_height, f_width, field_state).items():
+            cells[cell] = value
+        if sys.byteorder == "big":
+            cells.byteswap()
+        return self.encode_header(f_height, f_width, field_state) + b"\n" + cells.tobytes()
+
+    async def call_bot(self, f_height, f_width, field_state: FieldState):
+        cur_bot = self.bot if self.bot is not None else BotConnector(self.cmd)
+        if self.binary:
+            inp = self.encode_binary(f_height, f_width, field_state)
+        else:
+            inp = self.encode_text(f_height, f_width, field_state)
+        return await cur_bot.start_bot(inp)
+
+    def safe_move(self, f_height, f_width, field_state: FieldState):
+        """A move that does not crash into a wall or a snake right away, if there is one.
+
+        Used instead of the bot's answer when the bot is too slow.
+        """
+
+        matrix = self.field_to_matrix(f_height, f_width, field_state)
+        head = field_state.snakes[self.snake_name].head
+        for move, direction in self.moves.items():
+            cell = head.shift(direction)
+            if 0 <= cell.x < f_width and 0 <= cell.y < f_height and matrix[cell.y][cell.x] < 2:
+                return move
+        return "0\n"
+
+    async def close(self):
+        if self.bot is not None:
+            await self.bot.close()
 
 
 
@@ -243,7 +243,7 @@ class mywindow(QtWidgets.QMainWindow):
             self.show_error_message(f'{cmd} does not exist or is not executable')
             return
 
-        cur = Client(address, port, name, cmd)
+        cur = Client(address, port, name, cmd, persistent=self.ui.Persistent.isChecked(), binary=self.ui.Binary.isChecked())
         self.hide()
 
         #cur.application = Readywnd()
@@ -25,17 +25,33 @@ from PyQt5.QtWidgets import (
 )
 from bot_arena_proto.data import *
 from bot_arena_proto.event import Event
-from bot_arena_proto.session import ClientSession, ClientInfo, ErrReceived
+from bot_arena_proto.session import (
+    ClientSession,
+    ClientInfo,
+    ErrReceived,
+    CAPABILITY_COMPACT_FIELD_STATE,
+    CAPABILITY_FIELD_DELTAS,
+)
 
 def quit_forcefully():
     os.kill(os.getpid(), signal.SIGTERM)
 
 class Client:
-    def __init__(self, address, port, name, cmd):
+    # The share of the server's turn timeout that the bot may think for.
+    # The rest is left for sending the answer, so that a slow bot does not
+    # get the player disconnected.
+    turn_deadline_share = 0.8
+
+    def __init__(self, address, port, name, cmd, persistent=False, binary=False):
         self.host = address
         self.port = port
         self.name = name
         self.cmd = cmd
+        self.persistent = persistent
+        self.binary = binary
+        self.bot = None
+        self.turn_deadline = None
+        self.turn_task = None
 
         #
         sess = None
@@ -90,7 +106,7 @@ class Client:
         # [[[ Interesting things start here ]]]
 
         # Create a ClientSession
-        client_info = ClientInfo(self.name)
+        client_info = ClientInfo(self.name, capabilities=[CAPABILITY_FIELD_DELTAS, CAPABILITY_COMPACT_FIELD_STATE])
         self.sess = ClientSession(stream=stream, client_info=client_info)
 
         # Perform the handshake
@@ -179,6 +195,10 @@ class Client:
                     break
                 await curio.sleep(1)
 
+        turn_timeout = (await self.sess.get_room_properties())["turn_timeout_seconds"]
+        if turn_timeout is not None:
+            self.turn_deadline = turn_timeout * self.turn_deadline_share
+        self.bot = StreamEditor(self.name, self.cmd, persistent=self.persistent, binary=self.binary)
 
         await self.sess.ready()
         print("ready for game")
@@ -197,7 +217,20 @@ class Client:
 
         # Handle server-sent notifications
         while True:
-            notification = await self.sess.wait_for_notification()
+            if self.name == "@viewer" and self.handler.has_pending_frame():
+                # Show the frame held back by the viewer as soon as it is due,
+                # unless a newer field state comes first. Reading a notification
+                # can be safely cancelled: nothing is consumed until a whole
+                # message arrives.
+                notification = await curio.ignore_after(
+                    max(self.handler.seconds_until_next_frame(), 0),
+                    self.sess.wait_for_notification(),
+                )
+                if notification is None:
+                    self.handler.show_pending_frame()
+                    continue
+            else:
+                notification = await self.sess.wait_for_notification()
 
             # Handle the notification. See the documentation for the
             # `algebraic-data-type` package.
@@ -212,7 +245,7 @@ class Client:
             # (3) This object is the value returned from `.match()`.
             # (4) This object is then awaited.
             await notification.match(
-                request = self.take_turn,
+                request = self.start_turn,
                 field_state = self.handle_new_field_state,
                 event = self.handle_event,
                 error = self.handle_error,
@@ -227,7 +260,7 @@ class Client:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     exit(0)
-            self.handler.get_message_and_display(self.curField, self.f_height, self.f_width, self.score, self.screen)
+            self.handler.submit_frame(self.curField, self.f_height, self.f_width, self.score, self.screen)
         #pygame.init()
         #main_surface = pygame.display.set_mode((c.screen_width, c.screen_width))
         #pygame.display.set_caption('Pythons')
@@ -249,6 +282,10 @@ class Client:
                             exit(0)
         # TODO: replace it with something that can be handled by the calling code.
         if event.name == 'GameFinished':
+            if self.turn_task is not None:
+                await self.turn_task.cancel()
+            if self.bot is not None:
+                await self.bot.close()
             exit()
 
 
@@ -259,27 +296,37 @@ class Client:
         #print(f'Error: {description}')
         pass
 
+    async def start_turn(self):
+        # The bot thinks in a separate task, so that the notifications keep
+        # being read meanwhile. The previous turn cannot be running any more:
+        # its deadline is shorter than the server's turn timeout.
+        if self.turn_task is not None:
+            await self.turn_task.cancel()
+        self.turn_task = await curio.spawn(self.take_turn, self.curField, daemon=True)
+
     # This is where the decision-making part happens.
-    async def take_turn(self):
+    async def take_turn(self, field_state):
         # Tell the server what to do in your turn.
-        # We will always tell our snake to move right.
         #curBot = Bot()
         #action = Action.MOVE(curBot.find_direction(curField, f_width, f_height, name))
-        cur_test = StreamEditor(self.name, self.cmd)
-        move = cur_test.call_bot(self.f_height, self.f_width, self.curField)
-        action = None
-        if move == "0\n":
-            action = Action.MOVE(Direction.DOWN())
-        if move == "1\n":
-            action = Action.MOVE(Direction.RIGHT())
-        if move == "2\n":
-            action = Action.MOVE(Direction.UP())
-        if move == "3\n":
-            action = Action.MOVE(Direction.LEFT())
-        #action = Action.MOVE(Direction.UP())
+        try:
+            if self.turn_deadline is None:
+                move = await self.bot.call_bot(self.f_height, self.f_width, field_state)
+            else:
+                move = await curio.timeout_after(
+                    self.turn_deadline,
+                    self.bot.call_bot(self.f_height, self.f_width, field_state),
+                )
+        except curio.TaskTimeout:
+            # The bot has been killed. Answer anyway rather than be
+            # disconnected by the server.
+            print(f"The bot did not answer in {self.turn_deadline:.2f} seconds")
+            move = None
+        if move not in self.bot.moves:
+            move = self.bot.safe_move(self.f_height, self.f_width, field_state)
+        action = Action.MOVE(self.bot.moves[move])
         # Send our action to the server
-        await self.sess.respond(action)  # May cause an ERR if the move is invalid.
-                                    # This ERR will appear as the next
-                                    # ClientNotification. A well-designed client
-                                    # should handle this situation.
-        #print('Moved right')
+        await self.sess.send_action(action)  # May cause an ERR if the move is invalid.
+                                             # This ERR will appear as one of the next
+                                             # ClientNotifications. A well-designed client
+                                             # should handle this situation.
@@ -4,20 +4,33 @@ from bot_arena_client.game_viewer_files.snake import Snake
 from bot_arena_client.game_viewer_files.snake_body_peace import SnakeBodyPeace
 
 import random
+import time
 
 import pygame
 from bot_arena_proto.data import FieldState, Direction, SnakeState, Point, Object
 
 
+# Where the next piece of a snake is on the screen, in cells.
+_tail_steps = {
+    Direction.UP(): (0, -1),
+    Direction.DOWN(): (0, 1),
+    Direction.LEFT(): (-1, 0),
+    Direction.RIGHT(): (1, 0),
+}
+
+
 class Viewer:
+    """Draws the field in a pygame window.
+
+    Only the cells that have changed since the previous frame are redrawn,
+    from sprites that are rendered once per kind of cell. Frames are shown
+    at most `config.frame_rate` times per second: a field state coming
+    earlier than that waits, and is replaced if another one comes before it
+    is shown.
+    """
+
     def __init__(self):
-        self.all_snakes = {}
-        self.player_colors = [(0, 255, 0), (0, 0, 255), (255, 0, 255), (0, 255, 255), (255, 255, 0),
-                         (200, 0, 255)]
-        self.colors_mapping = {}
-        self.last_fieldstate = None
-        self.score = None
-        self.height = self.width = 0
+        self.reset()
 
     def reset(self):
         self.all_snakes = {}
@@ -27,6 +40,17 @@ class Viewer:
         self.last_fieldstate = None
         self.score = None
         self.height = self.width = 0
+        # What is currently on the screen: (column, row) -> the kind of cell
+        # (see `get_cells`). Empty cells are not stored.
+        self.cells = {}
+        self.sprites = {}
+        self.fonts = {}
+        self.surface = None
+        self.cell_width = 0
+        self.score_rect = None
+        self.shown_score = None
+        self.pending_frame = None
+        self.last_frame_time = float('-inf')
 
     def get_score(self):
         return self.score
@@ -43,81 +67,173 @@ class Viewer:
     def invert(self, p: int, field_height: int):
         return field_height - 1 - p
 
-    def get_message_and_display(self, cur_state: FieldState, field_height: int, field_width: int,
-                                score, surface, winners=None):
-        cell_width = int(c.screen_width / max(field_height, field_width))
+    def get_font(self, size):
+        if size not in self.fonts:
+            self.fonts[size] = pygame.font.SysFont('Arial', size)
+        return self.fonts[size]
+
+    def submit_frame(self, cur_state: FieldState, field_height: int, field_width: int, score, surface):
         self.height = field_height
         self.width = field_width
         self.last_fieldstate = cur_state
         self.score = score
-        colors_cnt = -1
-        snakes = []
-        surface.fill(pygame.Color('black'))
-        # drawing players
-        first_time_flag = False
+        self.pending_frame = (cur_state, field_height, field_width, score, surface)
+        if self.seconds_until_next_frame() <= 0:
+            self.show_pending_frame()
+
+    def has_pending_frame(self):
+        return self.pending_frame is not None
+
+    def seconds_until_next_frame(self):
+        return self.last_frame_time + 1 / c.frame_rate - time.monotonic()
+
+    def show_pending_frame(self):
+        frame, self.pending_frame = self.pending_frame, None
+        if frame is not None:
+            self.get_message_and_display(*frame)
+
+    def get_snakes(self, cur_state: FieldState):
+        # Dead snakes stay on the field, drawn below the live ones.
         if len(self.all_snakes) == 0:
-            self.all_snakes = cur_state.snakes
-            first_time_flag = True
-        for snake_name in self.all_snakes.keys():
-            if snake_name in cur_state.snakes.keys():
-                snake_state = cur_state.snakes[snake_name]
-                self.all_snakes[snake_name] = snake_state
-                snake_alive = True
-            else:
-                snake_state = self.all_snakes[snake_name]
-                snake_alive = False
-            colors_cnt += 1
-            if colors_cnt >= len(self.player_colors):
-                self.player_colors.append((random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
-            if first_time_flag is True:
+            self.all_snakes = dict(cur_state.snakes)
+            for colors_cnt, snake_name in enumerate(self.all_snakes.keys()):
+                if colors_cnt >= len(self.player_colors):
+                    self.player_colors.append((random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
                 self.colors_mapping[snake_name] = self.player_colors[colors_cnt]
-            snake_peaces = []
-            cur_x = snake_state.head.x * cell_width
-            cur_y = self.invert(snake_state.head.y, field_height) * cell_width
-            snake_peaces.append(SnakeBodyPeace(cur_x, cur_y, cell_width, self.player_colors[colors_cnt]))
+        snakes = []
+        for snake_name in self.all_snakes.keys():
+            snake_alive = snake_name in cur_state.snakes
+            if snake_alive:
+                self.all_snakes[snake_name] = cur_state.snakes[snake_name]
+            snakes.append((snake_name, self.all_snakes[snake_name], snake_alive))
+        return sorted(snakes, key=lambda elem: elem[2])
+
+    def get_cells(self, cur_state: FieldState, field_height: int, snakes):
+        cells = {}
+        for snake_name, snake_state, snake_alive in snakes:
+            color = self.colors_mapping[snake_name]
+            x = snake_state.head.x
+            y = self.invert(snake_state.head.y, field_height)
+            # The head is drawn differently depending on where the neck is.
+            neck = _tail_steps[snake_state.tail[0]] if len(snake_state.tail) > 0 else None
+            cells[x, y] = ('head', color, snake_alive, neck)
             for peace in snake_state.tail:
-                if peace == Direction.UP():
-                    cur_y -= cell_width
-                if peace == Direction.DOWN():
-                    cur_y += cell_width
-                if peace == Direction.LEFT():
-                    cur_x -= cell_width
-                if peace == Direction.RIGHT():
-                    cur_x += cell_width
-                snake_peaces.append(SnakeBodyPeace(cur_x, cur_y, cell_width, self.player_colors[colors_cnt]))
-            cur_snake = Snake(snake_peaces, snake_alive, snake_name)
-            snakes.append(cur_snake)
-        snakes = sorted(snakes, key=lambda elem: elem.get_alive_status())
-        for snake in snakes:
-            snake.draw(surface)
-        # drawing objects
-        for i in range(len(cur_state.objects)):
-            apple = Apple(cur_state.objects[i][0].x * cell_width, self.invert(cur_state.objects[i][0].y, field_height) *
-                          cell_width, cell_width // 2)
-            apple.draw(surface)
-        # drawing score distribution
+                dx, dy = _tail_steps[peace]
+                x += dx
+                y += dy
+                cells[x, y] = ('body', color, snake_alive)
+        for point, _ in cur_state.objects:
+            cells[point.x, self.invert(point.y, field_height)] = ('apple',)
+        return cells
+
+    def get_sprite(self, kind):
+        sprite = self.sprites.get(kind)
+        if sprite is not None:
+            return sprite
+
+        cell_width = self.cell_width
+        sprite = pygame.Surface((cell_width, cell_width))
+        sprite.fill(pygame.Color('black'))
+        if kind[0] == 'apple':
+            Apple(0, 0, cell_width // 2).draw(sprite)
+        elif kind[0] == 'body' or kind[3] is None:
+            SnakeBodyPeace(0, 0, cell_width, kind[1]).draw(sprite, kind[2])
+        else:
+            # Draw the head with its neck around the middle of a bigger
+            # surface, then cut the head out.
+            _, color, snake_alive, (dx, dy) = kind
+            around = pygame.Surface((3 * cell_width, 3 * cell_width))
+            around.fill(pygame.Color('black'))
+            head = SnakeBodyPeace(cell_width, cell_width, cell_width, color)
+            neck = SnakeBodyPeace((1 + dx) * cell_width, (1 + dy) * cell_width, cell_width, color)
+            Snake([head, neck], snake_alive, None).draw(around)
+            sprite.blit(around, (0, 0), head.bounds)
+        self.sprites[kind] = sprite
+        return sprite
+
+    def draw_cell(self, surface, cell):
+        x, y = cell
+        rect = pygame.Rect(x * self.cell_width, y * self.cell_width, self.cell_width, self.cell_width)
+        kind = self.cells.get(cell)
+        if kind is None:
+            surface.fill(pygame.Color('black'), rect)
+        else:
+            surface.blit(self.get_sprite(kind), rect)
+        return rect
+
+    def draw_score(self, surface, snakes, score, dirty_rects):
         font_size = 30
         whitespace_size = 15
-        my_font = pygame.font.SysFont('Arial', font_size)
-        text_surface = my_font.render('Score:', True, (255, 255, 255))
-        surface.blit(text_surface, (0, 0))
-        cur_x_coord = text_surface.get_rect().width + whitespace_size
-        for snake in snakes:
-            snake_name = snake.get_name()
-            if score is None:
-                snake_score = 0
-            else:
-                snake_score = score[snake_name]
-            text_surface = my_font.render(str(snake_score), True, snake.get_color())
-            text_surface_copy = text_surface.copy()
-            text_surface_copy.fill((0, 0, 0))
-            surface.blit(text_surface_copy, (cur_x_coord, 0))
+        shown_score = [
+            (snake_name, 0 if score is None else score[snake_name])
+            for snake_name, _, _ in snakes
+        ]
+        if shown_score == self.shown_score and self.score_rect.collidelist(dirty_rects) == -1:
+            return
+
+        my_font = self.get_font(font_size)
+        text_surfaces = [my_font.render('Score:', True, (255, 255, 255))]
+        for snake_name, snake_score in shown_score:
+            text_surfaces.append(my_font.render(str(snake_score), True, self.colors_mapping[snake_name]))
+        score_rect = pygame.Rect(
+            0,
+            0,
+            sum(text_surface.get_rect().width + whitespace_size for text_surface in text_surfaces),
+            max(text_surface.get_rect().height for text_surface in text_surfaces),
+        )
+
+        area = score_rect if self.score_rect is None else score_rect.union(self.score_rect)
+        self.score_rect = score_rect
+        self.shown_score = shown_score
+
+        # Bring back the cells below the old score, then draw the new one over them.
+        cell_width = self.cell_width
+        for x in range(area.left // cell_width, (area.right - 1) // cell_width + 1):
+            for y in range(area.top // cell_width, (area.bottom - 1) // cell_width + 1):
+                self.draw_cell(surface, (x, y))
+        surface.blit(text_surfaces[0], (0, 0))
+        cur_x_coord = text_surfaces[0].get_rect().width + whitespace_size
+        for text_surface in text_surfaces[1:]:
+            surface.fill((0, 0, 0), text_surface.get_rect(topleft=(cur_x_coord, 0)))
             surface.blit(text_surface, (cur_x_coord, 0))
             cur_x_coord += text_surface.get_rect().width + whitespace_size
+        dirty_rects.append(area)
+
+    def get_message_and_display(self, cur_state: FieldState, field_height: int, field_width: int,
+                                score, surface, winners=None):
+        cell_width = int(c.screen_width / max(field_height, field_width))
+        self.height = field_height
+        self.width = field_width
+        self.last_fieldstate = cur_state
+        self.score = score
+        self.pending_frame = None
+        self.last_frame_time = time.monotonic()
+
+        full_redraw = surface is not self.surface or cell_width != self.cell_width
+        if full_redraw:
+            surface.fill(pygame.Color('black'))
+            self.surface = surface
+            self.cell_width = cell_width
+            self.cells = {}
+            self.sprites = {}
+            self.score_rect = None
+            self.shown_score = None
+
+        # drawing players and objects
+        snakes = self.get_snakes(cur_state)
+        old_cells = self.cells
+        self.cells = self.get_cells(cur_state, field_height, snakes)
+        dirty_rects = [
+            self.draw_cell(surface, cell)
+            for cell in old_cells.keys() | self.cells.keys()
+            if old_cells.get(cell) != self.cells.get(cell)
+        ]
+        # drawing score distribution
+        self.draw_score(surface, snakes, score, dirty_rects)
         # drawing winner
 
         def show_text(xcoord, ycoord, text, color, fontsize, screen, is_name):
-            font = pygame.font.SysFont('Arial', fontsize)
+            font = self.get_font(fontsize)
             text_to_show = font.render(text, True, color)
             textbox = text_to_show.get_rect()
             if is_name is True:
@@ -128,6 +244,7 @@ class Viewer:
             return textbox.height
 
         if winners is not None:
+            full_redraw = True
             font_size = 40
             y_coord = 2
             for i in range(len(winners['winners'])):
@@ -150,5 +267,8 @@ class Viewer:
                 show_text(x_coord, y_coord, win_text, white_color, font_size, surface, False)
                 y_coord += p
 
-        pygame.display.update()
+        if full_redraw:
+            pygame.display.update()
+        elif len(dirty_rects) > 0:
+            pygame.display.update(dirty_rects)
         return
@@ -5,9 +5,13 @@ using namespace std;
 
 #define endl '\n'
 
-int main(){
+// Answers every field read from stdin, so that the bot can be run both
+// once per turn and once per game (see `PersistentBotConnector`).
+static bool take_turn(){
     int n, m, num_snake, num_head;
-    cin >> n >> m >> num_snake >> num_head;
+    if (!(cin >> n >> m >> num_snake >> num_head)){
+        return false;
+    }
     vector<vector<int>> field(n, vector<int>(m));
     for (int i = 0; i < n; i++){
         for (int j = 0; j < m; j++){
@@ -77,5 +81,12 @@ int main(){
     
     cout << min_pos.second << endl;
 
+    return true;
+}
+
+int main(){
+    while (take_turn()){
+        cout.flush();
+    }
     return 0;
 }
@@ -11,7 +11,7 @@ setup(
         'bot_arena_client': ['bots/*'],
     },
 
-    install_requires = ['bot_arena-proto ~= 1.0.1', 'pygame', 'pyqt5'],
+    install_requires = ['bot_arena-proto ~= 1.1', 'pygame', 'pyqt5'],
 
     entry_points = {
         'console_scripts': [
@@ -4,11 +4,16 @@ from bot_arena_proto.serialization import (
     Primitive,
     PrimitiveSerializable,
     ensure_type,
+    variant_key,
+    variant_keys,
     wrap_deserialization_errors,
 )
 
+import itertools
+import sys
+from array import array
 from dataclasses import dataclass
-from typing import List, Type, Tuple, Dict, cast
+from typing import Iterable, List, Type, Tuple, Dict
 
 from adt import adt, Case
 
@@ -16,12 +21,14 @@ from adt import adt, Case
 __all__ = [
     'Action',
     'Direction',
+    'FieldDelta',
     'FieldState',
     'FoodRespawnBehavior',
     'Object',
     'Point',
     'RoomInfo',
     'RoomOpenness',
+    'SnakeDelta',
     'SnakeState',
 ]
 
@@ -36,45 +43,116 @@ class Direction:
     RIGHT: Case
 
     def to_primitive(self) -> Primitive:
-        return self.match(
-            up = lambda: 'u',
-            down = lambda: 'd',
-            left = lambda: 'l',
-            right = lambda: 'r',
-        )  # type: ignore
-        # mypy complains unreasonably here
+        return _DIRECTION_PRIMITIVES[variant_key(self)]
 
     @classmethod
     @wrap_deserialization_errors
     def from_primitive(Class: Type['Direction'], p: Primitive) -> 'Direction':
         p = ensure_type(p, str)
+        direction = _DIRECTIONS_BY_PRIMITIVE.get(p)
+        if direction is None:
+            raise DeserializationAdtTagError(Class, p)
+        return direction
 
-        if p == 'u':
-            return Class.UP()
-        if p == 'd':
-            return Class.DOWN()
-        if p == 'l':
-            return Class.LEFT()
-        if p == 'r':
-            return Class.RIGHT()
+    def __hash__(self) -> int:
+        return _DIRECTION_HASHES[variant_key(self)]
 
-        raise DeserializationAdtTagError(Class, p)
+    def opposite(self) -> 'Direction':
+        return _DIRECTION_OPPOSITES[variant_key(self)]
 
-    def __hash__(self) -> int:
-        a = self.match(
-            up = lambda: 0,
-            down = lambda: 1,
-            left = lambda: 2,
-            right = lambda: 3,
-        ) # type: ignore
-        a = cast(int, a)
+    def __copy__(self) -> 'Direction':
+        return self
 
-        return a ^ 0x7843c6aab56971b4
+    def __deepcopy__(self, memo: dict) -> 'Direction':
+        return self
 
 
-@dataclass
+def _intern_variants(Adt: type) -> None:
+    """Make the constructors of the variants of an adt without arguments return shared instances.
+
+    The values of such variants are immutable, so there is no need to
+    allocate a new one every time, e.g. for every segment of a snake.
+    """
+
+    for key in variant_keys(Adt):
+        instance = getattr(Adt, key.name)()
+        setattr(Adt, key.name, classmethod(lambda Class, _instance=instance: _instance))
+
+
+_intern_variants(Direction)
+
+
+# The hot methods of Direction and Object look the variant up in these tables
+# instead of calling `match`, which creates a lambda per variant and validates
+# all of them on every call.
+_DIRECTIONS_BY_PRIMITIVE = {
+    'u': Direction.UP(),
+    'd': Direction.DOWN(),
+    'l': Direction.LEFT(),
+    'r': Direction.RIGHT(),
+}
+
+_DIRECTION_KEYS = variant_keys(Direction)
+
+_DIRECTION_PRIMITIVES = {variant_key(direction): p for p, direction in _DIRECTIONS_BY_PRIMITIVE.items()}
+
+_DIRECTION_HASHES = {
+    _DIRECTION_KEYS.UP: 0 ^ 0x7843c6aab56971b4,
+    _DIRECTION_KEYS.DOWN: 1 ^ 0x7843c6aab56971b4,
+    _DIRECTION_KEYS.LEFT: 2 ^ 0x7843c6aab56971b4,
+    _DIRECTION_KEYS.RIGHT: 3 ^ 0x7843c6aab56971b4,
+}
+
+_DIRECTION_OPPOSITES = {
+    _DIRECTION_KEYS.UP: _DIRECTIONS_BY_PRIMITIVE['d'],
+    _DIRECTION_KEYS.DOWN: _DIRECTIONS_BY_PRIMITIVE['u'],
+    _DIRECTION_KEYS.LEFT: _DIRECTIONS_BY_PRIMITIVE['r'],
+    _DIRECTION_KEYS.RIGHT: _DIRECTIONS_BY_PRIMITIVE['l'],
+}
+
+_DIRECTION_OFFSETS = {
+    _DIRECTION_KEYS.UP: (0, 1),
+    _DIRECTION_KEYS.DOWN: (0, -1),
+    _DIRECTION_KEYS.LEFT: (-1, 0),
+    _DIRECTION_KEYS.RIGHT: (1, 0),
+}
+
+# 2-bit codes of the directions in the compact encoding.
+_DIRECTION_CODES = {
+    _DIRECTION_KEYS.UP: 0,
+    _DIRECTION_KEYS.DOWN: 1,
+    _DIRECTION_KEYS.LEFT: 2,
+    _DIRECTION_KEYS.RIGHT: 3,
+}
+
+# For each byte of packed directions, the four directions it contains.
+_UNPACKED_DIRECTION_BYTES = [
+    tuple(
+        [_DIRECTIONS_BY_PRIMITIVE[p] for p in 'udlr'][(byte >> shift) & 3]
+        for shift in (0, 2, 4, 6)
+    )
+    for byte in range(256)
+]
+
+
+def _directions_from_primitive(p: Primitive) -> List[Direction]:
+    p = ensure_type(p, list)
+    try:
+        return [_DIRECTIONS_BY_PRIMITIVE[x] for x in p]
+    except (KeyError, TypeError):
+        # Let Direction.from_primitive report the invalid element.
+        return [Direction.from_primitive(x) for x in p]
+
+
+@dataclass(frozen=True)
 class Point:
-    """A 2D point with integer coords representing a cell of the game field."""
+    """A 2D point with integer coords representing a cell of the game field.
+
+    Points are immutable. Use `Point.interned` in hot code: it returns shared
+    instances for the cells of fields up to 256x256.
+    """
+
+    __slots__ = ('x', 'y')
 
     x: int
     y: int
@@ -91,20 +169,46 @@ class Point:
         y = ensure_type(y, int)
         return Class(x=x, y=y)
 
-    def shift(self, direction: Direction) -> 'Point':
-        dxdy = direction.match(
-            up = lambda: (0, 1),
-            down = lambda: (0, -1),
-            left = lambda: (-1, 0),
-            right = lambda: (1, 0),
-        ) # type: ignore
+    @staticmethod
+    def interned(x: int, y: int) -> 'Point':
+        """Return a point equal to `Point(x, y)`, shared with other callers if possible."""
 
-        dx, dy = cast(Tuple[int, int], dxdy)
+        if 0 <= x < _POINT_CACHE_SIDE and 0 <= y < _POINT_CACHE_SIDE:
+            i = y * _POINT_CACHE_SIDE + x
+            point = _point_cache.get(i)
+            if point is None:
+                point = _point_cache[i] = Point(x, y)
+            return point
+        return Point(x, y)
 
-        return Point(x = self.x + dx, y = self.y + dy)
+    def shift(self, direction: Direction) -> 'Point':
+        dx, dy = _DIRECTION_OFFSETS[variant_key(direction)]
+        return Point.interned(self.x + dx, self.y + dy)
 
     def __hash__(self) -> int:
-        return hash((self.x, self.y)) ^ 0xdd77ab420fecfdb9
+        # Distinct for all the points of fields up to 65536 cells wide.
+        return ((self.y << 16) ^ self.x) ^ 0xdd77ab420fecfdb9
+
+    def __copy__(self) -> 'Point':
+        return self
+
+    def __deepcopy__(self, memo: dict) -> 'Point':
+        return self
+
+
+# Interned points, indexed by `y * _POINT_CACHE_SIDE + x`. The cache is filled lazily,
+# so it only holds the cells that have actually been used.
+_POINT_CACHE_SIDE = 256
+_point_cache: Dict[int, Point] = {}
+
+
+def _point_from_primitive(p: Primitive) -> Point:
+    if type(p) is list and len(p) == 2:
+        x, y = p
+        if type(x) is int and type(y) is int:
+            return Point.interned(x, y)
+    # Let Point.from_primitive handle the unusual and the invalid cases.
+    return Point.from_primitive(p)
 
 
 @dataclass
@@ -115,15 +219,17 @@ class SnakeState:
     tail: List[Direction]
 
     def to_primitive(self) -> Primitive:
-        return {'head': self.head.to_primitive(), 'tail': [x.to_primitive() for x in self.tail]}
+        return {
+            'head': [self.head.x, self.head.y],
+            'tail': [_DIRECTION_PRIMITIVES[key] for key in map(variant_key, self.tail)],
+        }
 
     @classmethod
     @wrap_deserialization_errors
     def from_primitive(Class: Type['SnakeState'], p: Primitive) -> 'SnakeState':
         p = ensure_type(p, dict)
-        head = Point.from_primitive(p['head'])
-        tail = ensure_type(p['tail'], list, 'Snake.tail')
-        tail = [Direction.from_primitive(x) for x in tail]
+        head = _point_from_primitive(p['head'])
+        tail = _directions_from_primitive(ensure_type(p['tail'], list, 'Snake.tail'))
         return Class(head=head, tail=tail)
 
 
@@ -145,7 +251,7 @@ class FieldState:
     def to_primitive(self) -> Primitive:
         return {
             'snakes': {name: snake.to_primitive() for name, snake in self.snakes.items()},
-            'objects': [[point.to_primitive(), obj.to_primitive()] for point, obj in self.objects],
+            'objects': [[[point.x, point.y], _OBJECT_PRIMITIVES[variant_key(obj)]] for point, obj in self.objects],
         }
 
     @classmethod
@@ -155,9 +261,198 @@ class FieldState:
         snakes = ensure_type(p['snakes'], dict)
         objects = ensure_type(p['objects'], list)
         snakes = {ensure_type(key, str): SnakeState.from_primitive(value) for key, value in snakes.items()}
-        objects = [(Point.from_primitive(point), Object.from_primitive(obj)) for point, obj in objects]
+        objects = [(_point_from_primitive(point), _object_from_primitive(obj)) for point, obj in objects]
+        return Class(snakes=snakes, objects=objects)
+
+    def to_compact_primitive(self) -> Primitive:
+        """Serialize self into a primitive that is several times smaller when encoded.
+
+        Points are packed as pairs of little-endian uint16 into byte strings, and
+        tails as 2-bit direction codes (four per byte). Each snake becomes
+        `[head, tail length, packed tail]`, and the objects become
+        `[packed points, object tags]`, where the tags are concatenated into one string.
+        """
+
+        return {
+            'snakes': {
+                name: [_pack_points([snake.head]), len(snake.tail), _pack_directions(snake.tail)]
+                for name, snake in self.snakes.items()
+            },
+            'objects': [
+                _pack_points(point for point, _ in self.objects),
+                ''.join(_OBJECT_PRIMITIVES[variant_key(obj)] for _, obj in self.objects),
+            ],
+        }
+
+    @classmethod
+    @wrap_deserialization_errors
+    def from_compact_primitive(Class: Type['FieldState'], p: Primitive) -> 'FieldState':
+        """Deserialize from a primitive produced by `to_compact_primitive`."""
+
+        p = ensure_type(p, dict)
+        snakes = {}
+        for name, value in ensure_type(p['snakes'], dict).items():
+            [head, tail_len, tail] = ensure_type(value, list)
+            [head] = _unpack_points(ensure_type(head, bytes))
+            tail = _unpack_directions(ensure_type(tail, bytes), ensure_type(tail_len, int))
+            snakes[ensure_type(name, str)] = SnakeState(head=head, tail=tail)
+
+        [points, tags] = ensure_type(p['objects'], list)
+        points = _unpack_points(ensure_type(points, bytes))
+        tags = ensure_type(tags, str)
+        if len(points) != len(tags):
+            raise ValueError(f'{len(points)} object positions, but {len(tags)} objects')
+        objects = [(point, _object_from_primitive(tag)) for point, tag in zip(points, tags)]
+
         return Class(snakes=snakes, objects=objects)
 
+
+def _pack_directions(directions: List[Direction]) -> bytes:
+    codes = [_DIRECTION_CODES[key] for key in map(variant_key, directions)]
+    codes.extend([0] * (-len(codes) % 4))
+    return bytes(
+        a | (b << 2) | (c << 4) | (d << 6)
+        for a, b, c, d in zip(codes[0::4], codes[1::4], codes[2::4], codes[3::4])
+    )
+
+
+def _unpack_directions(data: bytes, length: int) -> List[Direction]:
+    if length < 0 or len(data) != (length + 3) // 4:
+        raise ValueError(f'{len(data)} bytes cannot contain exactly {length} packed directions')
+    unpacked = itertools.chain.from_iterable(map(_UNPACKED_DIRECTION_BYTES.__getitem__, data))
+    return list(itertools.islice(unpacked, length))
+
+
+def _pack_points(points: Iterable[Point]) -> bytes:
+    coords = array('H')
+    for point in points:
+        coords.append(point.x)
+        coords.append(point.y)
+    if sys.byteorder != 'little':
+        coords.byteswap()
+    return coords.tobytes()
+
+
+def _unpack_points(data: bytes) -> List[Point]:
+    if len(data) % 4 != 0:
+        raise ValueError(f'{len(data)} bytes cannot contain packed points')
+    coords = array('H')
+    coords.frombytes(data)
+    if sys.byteorder != 'little':
+        coords.byteswap()
+    return [Point.interned(x, y) for x, y in zip(coords[0::2], coords[1::2])]
+
+
+@dataclass
+class SnakeDelta:
+    """Changes in the position of a snake since the previous field state.
+
+    `advances` lists the directions in which the head has moved, in order.
+    `tail_pops` is the number of segments removed from the end of the tail.
+    """
+
+    advances: List[Direction]
+    tail_pops: int
+
+    def to_primitive(self) -> Primitive:
+        return {
+            'advances': [_DIRECTION_PRIMITIVES[key] for key in map(variant_key, self.advances)],
+            'tail_pops': self.tail_pops,
+        }
+
+    @classmethod
+    @wrap_deserialization_errors
+    def from_primitive(Class: Type['SnakeDelta'], p: Primitive) -> 'SnakeDelta':
+        p = ensure_type(p, dict)
+        advances = _directions_from_primitive(ensure_type(p['advances'], list, 'SnakeDelta.advances'))
+        tail_pops = ensure_type(p['tail_pops'], int)
+        if tail_pops < 0:
+            raise ValueError(f'Negative number of tail pops: {tail_pops}')
+        return Class(advances=advances, tail_pops=tail_pops)
+
+    def apply_to(self, state: SnakeState) -> SnakeState:
+        head = state.head
+        new_segments = []
+        for direction in self.advances:
+            head = head.shift(direction)
+            new_segments.append(direction.opposite())
+        new_segments.reverse()
+
+        tail = new_segments + state.tail
+        tail = tail[:max(0, len(tail) - self.tail_pops)]
+        return SnakeState(head=head, tail=tail)
+
+
+@dataclass
+class FieldDelta:
+    """Changes in the game field since the previous field state.
+
+    `snakes` maps snake names to the changes in their positions (see SnakeDelta).
+    `dead_snakes` lists the snakes that have been removed from the field.
+    `removed_objects` lists the positions of the objects that have disappeared,
+    and `new_objects` lists the objects that have appeared. Removals are applied
+    before additions.
+
+    Applying a delta is lenient: changes to snakes and objects that are not
+    present in the base state are ignored.
+    """
+
+    snakes: Dict[str, SnakeDelta]
+    dead_snakes: List[str]
+    new_objects: List[Tuple[Point, 'Object']]
+    removed_objects: List[Point]
+
+    def to_primitive(self) -> Primitive:
+        return {
+            'snakes': {name: delta.to_primitive() for name, delta in self.snakes.items()},
+            'dead_snakes': self.dead_snakes,
+            'new_objects': [
+                [[point.x, point.y], _OBJECT_PRIMITIVES[variant_key(obj)]]
+                for point, obj in self.new_objects
+            ],
+            'removed_objects': [[point.x, point.y] for point in self.removed_objects],
+        }
+
+    @classmethod
+    @wrap_deserialization_errors
+    def from_primitive(Class: Type['FieldDelta'], p: Primitive) -> 'FieldDelta':
+        p = ensure_type(p, dict)
+        snakes = ensure_type(p['snakes'], dict)
+        snakes = {ensure_type(key, str): SnakeDelta.from_primitive(value) for key, value in snakes.items()}
+        dead_snakes = [ensure_type(name, str) for name in ensure_type(p['dead_snakes'], list)]
+        new_objects = [
+            (_point_from_primitive(point), _object_from_primitive(obj))
+            for point, obj in ensure_type(p['new_objects'], list)
+        ]
+        removed_objects = [_point_from_primitive(point) for point in ensure_type(p['removed_objects'], list)]
+        return Class(
+            snakes = snakes,
+            dead_snakes = dead_snakes,
+            new_objects = new_objects,
+            removed_objects = removed_objects,
+        )
+
+    def is_empty(self) -> bool:
+        return not (self.snakes or self.dead_snakes or self.new_objects or self.removed_objects)
+
+    def apply_to(self, state: FieldState) -> FieldState:
+        """Return the field state obtained by applying this delta to `state`."""
+
+        snakes = dict(state.snakes)
+        for name, snake_delta in self.snakes.items():
+            if name in snakes:
+                snakes[name] = snake_delta.apply_to(snakes[name])
+        for name in self.dead_snakes:
+            snakes.pop(name, None)
+
+        objects = dict(state.objects)
+        for point in self.removed_objects:
+            objects.pop(point, None)
+        for point, obj in self.new_objects:
+            objects[point] = obj
+
+        return FieldState(snakes=snakes, objects=list(objects.items()))
+
 @adt
 class Object:
     """An in-game object.
@@ -167,16 +462,40 @@ class Object:
     FOOD: Case
 
     def to_primitive(self) -> Primitive:
-        return self.match(food = lambda: 'f')  # type: ignore
-        # mypy complains unreasonably here
+        return _OBJECT_PRIMITIVES[variant_key(self)]
 
     @classmethod
     @wrap_deserialization_errors
     def from_primitive(Class: Type['Object'], p: Primitive) -> 'Object':
         p = ensure_type(p, str)
-        if p == 'f':
-            return Class.FOOD()
-        raise DeserializationAdtTagError(Class, p)
+        obj = _OBJECTS_BY_PRIMITIVE.get(p)
+        if obj is None:
+            raise DeserializationAdtTagError(Class, p)
+        return obj
+
+    def __copy__(self) -> 'Object':
+        return self
+
+    def __deepcopy__(self, memo: dict) -> 'Object':
+        return self
+
+
+_intern_variants(Object)
+
+# See the comment on the Direction tables.
+_OBJECTS_BY_PRIMITIVE = {
+    'f': Object.FOOD(),
+}
+
+_OBJECT_PRIMITIVES = {variant_key(obj): p for p, obj in _OBJECTS_BY_PRIMITIVE.items()}
+
+
+def _object_from_primitive(p: Primitive) -> Object:
+    obj = _OBJECTS_BY_PRIMITIVE.get(p) if type(p) is str else None  # type: ignore
+    if obj is None:
+        # Let Object.from_primitive report the error.
+        return Object.from_primitive(p)
+    return obj
 
 
 @adt
@@ -1,4 +1,4 @@
-from bot_arena_proto.data import Action, FieldState, FoodRespawnBehavior, RoomOpenness, RoomInfo
+from bot_arena_proto.data import Action, FieldDelta, FieldState, FoodRespawnBehavior, RoomOpenness, RoomInfo
 from bot_arena_proto.event import Event
 from bot_arena_proto.serialization import (
     DeserializationAdtTagError,
@@ -6,12 +6,15 @@ from bot_arena_proto.serialization import (
     Primitive,
     PrimitiveSerializable,
     ensure_type,
+    variant_key,
+    variant_keys,
+    variant_value,
     wrap_deserialization_errors,
 )
 
 from adt import adt, Case
 from dataclasses import dataclass
-from typing import List, Dict, Any, Type, cast, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
 
 
 __all__ = ['Message']
@@ -22,7 +25,7 @@ class UnknownProperty:
 
 
 def prop_to_primitive(name: str, value: Any) -> Primitive:
-    if name == 'name':
+    if name == 'name' or name == 'field_storage':
         return ensure_type(value, str)
 
     if name == 'players' or name == 'admins':
@@ -45,11 +48,14 @@ def prop_to_primitive(name: str, value: Any) -> Primitive:
             return None
         return ensure_type(value, int)
 
-    if name == 'turn_timeout_seconds':
+    if name == 'turn_timeout_seconds' or name == 'turns_per_second':
         if value is None:
             return None
         return ensure_type(value, float)
 
+    if name == 'simultaneous_moves':
+        return ensure_type(value, bool)
+
     if name in {'respawn_food', 'open'}:
         return value.to_primitive()
 
@@ -58,7 +64,7 @@ def prop_to_primitive(name: str, value: Any) -> Primitive:
 
 
 def prop_from_primitive(name: str, p: Primitive) -> Any:
-    if name == 'name':
+    if name == 'name' or name == 'field_storage':
         return ensure_type(p, str)
 
     if name == 'players' or name == 'admins':
@@ -81,11 +87,14 @@ def prop_from_primitive(name: str, p: Primitive) -> Any:
             return None
         return ensure_type(p, int)
 
-    if name == 'turn_timeout_seconds':
+    if name == 'turn_timeout_seconds' or name == 'turns_per_second':
         if p is None:
             return None
         return ensure_type(p, float)
 
+    if name == 'simultaneous_moves':
+        return ensure_type(p, bool)
+
     if name == 'respawn_food':
         return FoodRespawnBehavior.from_primitive(p)
 
@@ -104,8 +113,9 @@ class Message(PrimitiveSerializable):
     Currently, the following types of messages exist:
 
     - CLIENT_HELLO:     The message sent by a client when it connects
-                        to the server. The name of the player is the
-                        only parameter.
+                        to the server. The name of the player and the
+                        list of optional protocol features (capabilities)
+                        the client supports are attached as parameters.
 
     - SERVER_HELLO:     Successful server's response to a CLIENT_HELLO.
 
@@ -121,6 +131,18 @@ class Message(PrimitiveSerializable):
                         the field state has changed. The new field state
                         is attached as a parameter.
 
+    - NEW_FIELD_DELTA:  A notification from a server to a client that
+                        the field state has changed. Only the changes
+                        since the previous field state are attached (see
+                        bot_arena_proto.data.FieldDelta). Only sent to the
+                        clients that support the corresponding capability.
+
+    - NEW_COMPACT_FIELD_STATE:
+                        The same as NEW_FIELD_STATE, but the field state is
+                        serialized with FieldState.to_compact_primitive. Only
+                        sent to the clients that support the corresponding
+                        capability.
+
     - ACT:              An instruction sent by a client to the server
                         that this client wants to perform a certain
                         action (see bot_arena_proto.data.Action) with
@@ -166,11 +188,13 @@ class Message(PrimitiveSerializable):
                         A server's response to the client's GET_ROOM_PROPERTIES with
                         the dictionary mapping the property names to their values.
     """
-    CLIENT_HELLO: Case[str]
+    CLIENT_HELLO: Case[str, List[str]]
     SERVER_HELLO: Case
     YOUR_TURN: Case
     READY: Case
     NEW_FIELD_STATE: Case['FieldState']
+    NEW_FIELD_DELTA: Case['FieldDelta']
+    NEW_COMPACT_FIELD_STATE: Case['FieldState']
     ACT: Case['Action']
     EVENT_HAPPENED: Case['Event']
     OK: Case
@@ -186,38 +210,8 @@ class Message(PrimitiveSerializable):
     ROOM_PROPERTIES_AVAILABLE: Case[Dict[str, Any]]
 
     def to_primitive(self) -> Primitive:
-        return cast(
-            Primitive,
-            self.match(
-                client_hello = lambda name: ['ClientHello', name],
-                server_hello = lambda: ['ServerHello'],
-                your_turn = lambda: ['YourTurn'],
-                ready = lambda: ['Ready'],
-                new_field_state = lambda state: ['NewFieldState', state.to_primitive()],
-                act = lambda action: ['Act', action.to_primitive()],
-                event_happened = lambda event: ['EventHappened', event.to_primitive()],
-                ok = lambda: ['Ok'],
-                err = lambda message: ['Err', message],
-                list_rooms = lambda: ['ListRooms'],
-                enter_room = lambda name, password: ['EnterRoom', name, password],
-                enter_any_room = lambda: ['EnterAnyRoom'],
-                new_room = lambda: ['NewRoom'],
-                leave_room = lambda: ['LeaveRoom'],
-                get_room_properties = lambda: ['GetRoomProperties'],
-                set_room_properties = lambda props: [
-                    'SetRoomProperties',
-                    {k: prop_to_primitive(k, v) for k, v in props.items()},
-                ],
-                room_list_available = lambda rooms: [
-                    'RoomListAvailable',
-                    [r.to_primitive() for r in rooms],
-                ],
-                room_properties_available = lambda props: [
-                    'RoomPropertiesAvailable',
-                    {k: prop_to_primitive(k, v) for k, v in props.items()},
-                ]
-            ),
-        )
+        tag, encode_data = _MESSAGE_ENCODERS[variant_key(self)]
+        return [tag, *encode_data(variant_value(self))]
 
     @classmethod
     @wrap_deserialization_errors
@@ -230,7 +224,10 @@ class Message(PrimitiveSerializable):
 
         if tag == 'ClientHello':
             name = ensure_type(data[0], str)
-            return Message.CLIENT_HELLO(name)
+            capabilities: List[str] = []
+            if len(data) > 1:
+                capabilities = [ensure_type(c, str) for c in ensure_type(data[1], list)]
+            return Message.CLIENT_HELLO(name, capabilities)
         if tag == 'ServerHello':
             return Message.SERVER_HELLO()
         if tag == 'YourTurn':
@@ -240,6 +237,12 @@ class Message(PrimitiveSerializable):
         if tag == 'NewFieldState':
             state = FieldState.from_primitive(data[0])
             return Message.NEW_FIELD_STATE(state)
+        if tag == 'NewFieldDelta':
+            delta = FieldDelta.from_primitive(data[0])
+            return Message.NEW_FIELD_DELTA(delta)
+        if tag == 'NewCompactFieldState':
+            state = FieldState.from_compact_primitive(data[0])
+            return Message.NEW_COMPACT_FIELD_STATE(state)
         if tag == 'Act':
             action = Action.from_primitive(data[0])
             return Message.ACT(action)
@@ -290,4 +293,52 @@ class Message(PrimitiveSerializable):
         raise DeserializationAdtTagError(Message, tag)
 
     def kind(self) -> str:
-        return cast(List[str], self.to_primitive())[0]
+        tag, _ = _MESSAGE_ENCODERS[variant_key(self)]
+        return tag
+
+
+# Message variant -> (tag, function turning the variant's value into the rest of the primitive).
+#
+# A table is used instead of `match` because this is on the path of every message sent,
+# and `match` creates a lambda per variant and validates all of them on every call.
+# The function gets the arguments of the variant as `variant_value` returns them.
+_MESSAGE_KEYS = variant_keys(Message)
+
+_MESSAGE_ENCODERS: Dict[Any, Tuple[str, Callable[[Any], List[Primitive]]]] = {
+    _MESSAGE_KEYS.CLIENT_HELLO: (
+        'ClientHello',
+        # Clients without capabilities use the original form of the message.
+        lambda value: [value[0], value[1]] if value[1] else [value[0]],
+    ),
+    _MESSAGE_KEYS.SERVER_HELLO: ('ServerHello', lambda value: []),
+    _MESSAGE_KEYS.YOUR_TURN: ('YourTurn', lambda value: []),
+    _MESSAGE_KEYS.READY: ('Ready', lambda value: []),
+    _MESSAGE_KEYS.NEW_FIELD_STATE: ('NewFieldState', lambda state: [state.to_primitive()]),
+    _MESSAGE_KEYS.NEW_FIELD_DELTA: ('NewFieldDelta', lambda delta: [delta.to_primitive()]),
+    _MESSAGE_KEYS.NEW_COMPACT_FIELD_STATE: (
+        'NewCompactFieldState',
+        lambda state: [state.to_compact_primitive()],
+    ),
+    _MESSAGE_KEYS.ACT: ('Act', lambda action: [action.to_primitive()]),
+    _MESSAGE_KEYS.EVENT_HAPPENED: ('EventHappened', lambda event: [event.to_primitive()]),
+    _MESSAGE_KEYS.OK: ('Ok', lambda value: []),
+    _MESSAGE_KEYS.ERR: ('Err', lambda message: [message]),
+    _MESSAGE_KEYS.LIST_ROOMS: ('ListRooms', lambda value: []),
+    _MESSAGE_KEYS.ENTER_ROOM: ('EnterRoom', lambda value: [value[0], value[1]]),
+    _MESSAGE_KEYS.ENTER_ANY_ROOM: ('EnterAnyRoom', lambda value: []),
+    _MESSAGE_KEYS.NEW_ROOM: ('NewRoom', lambda value: []),
+    _MESSAGE_KEYS.LEAVE_ROOM: ('LeaveRoom', lambda value: []),
+    _MESSAGE_KEYS.GET_ROOM_PROPERTIES: ('GetRoomProperties', lambda value: []),
+    _MESSAGE_KEYS.SET_ROOM_PROPERTIES: (
+        'SetRoomProperties',
+        lambda props: [{k: prop_to_primitive(k, v) for k, v in props.items()}],
+    ),
+    _MESSAGE_KEYS.ROOM_LIST_AVAILABLE: (
+        'RoomListAvailable',
+        lambda rooms: [[r.to_primitive() for r in rooms]],
+    ),
+    _MESSAGE_KEYS.ROOM_PROPERTIES_AVAILABLE: (
+        'RoomPropertiesAvailable',
+        lambda props: [{k: prop_to_primitive(k, v) for k, v in props.items()}],
+    ),
+}
@@ -1,7 +1,8 @@
 from bot_arena_proto.error import ProtocolError
 
 from abc import abstractmethod
-from typing import Protocol, Type, TypeVar, Union, Optional, Any
+from operator import attrgetter
+from typing import Any, Callable, Optional, Protocol, Type, TypeVar, Union
 
 # No type hints available for this library, unfortunately.
 import cbor2  # type: ignore
@@ -37,7 +38,7 @@ class Serializable(Protocol):
 
     @classmethod
     @abstractmethod
-    def from_bytes(Class: Type[SerializableSelfType], b: bytes) -> SerializableSelfType:
+    def from_bytes(Class: Type[SerializableSelfType], b: Union[bytes, memoryview]) -> SerializableSelfType:
         """Deserialize from a byte string."""
         ...
 
@@ -94,7 +95,7 @@ class PrimitiveSerializable(Serializable, Protocol):
         return cbor2.dumps(primitive)
 
     @classmethod
-    def from_bytes(Class: Type[SerializableSelfType], b: bytes) -> SerializableSelfType:
+    def from_bytes(Class: Type[SerializableSelfType], b: Union[bytes, memoryview]) -> SerializableSelfType:
         # First, decode the byte string into the intermediate representation.
         primitive = cbor2.loads(b)
 
@@ -292,6 +293,25 @@ def unwrap_variant(message: Any, variant: str) -> Any:
         raise
 
 
+# The hot paths of the codec look up the variant of an adt value in tables
+# instead of calling `match`, which creates a lambda per variant and validates
+# all of them on every call. That relies on undocumented attributes of the
+# `adt` package: the enum of the variants of a class (`_Key`), and the variant
+# and the arguments of a value (`_key` and `_value`; the latter is None, a single
+# value, or a tuple of values if there are several). They are only accessed
+# through the three functions below, and setup.py pins the version of `adt`
+# they have been checked against.
+
+def variant_keys(Adt: type) -> Any:
+    """Return the enum of the variants of an adt class."""
+    return Adt._Key  # type: ignore
+
+
+# attrgetter, since these are called for every direction and object encoded.
+variant_key: Callable[[Any], Any] = attrgetter('_key')
+variant_value: Callable[[Any], Any] = attrgetter('_value')
+
+
 def wrap_deserialization_errors(func):
     def inner(*args, **kwargs):
         try:
@@ -1,17 +1,19 @@
-from bot_arena_proto.data import Action, FieldState, RoomInfo
+from bot_arena_proto.data import Action, FieldDelta, FieldState, RoomInfo
 from bot_arena_proto.error import ProtocolError
 from bot_arena_proto.event import Event
 from bot_arena_proto.message import Message
 from bot_arena_proto.serialization import ensure_type, Primitive, unwrap_variant, wrap_deserialization_errors
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from time import sleep
-from typing import Protocol, Tuple, Any, List, Dict, Type, Optional
+from typing import Protocol, Tuple, Any, List, Dict, Type, Optional, Union
 
 from adt import adt, Case
 
 
 __all__ = [
+    'CAPABILITY_COMPACT_FIELD_STATE',
+    'CAPABILITY_FIELD_DELTAS',
     'ClientInfo',
     'ClientNotification',
     'ClientSession',
@@ -25,6 +27,17 @@ __all__ = [
 
 MAX_SANE_LENGTH = 2**20  # 1 MiB should be much more than enough
 
+# How many bytes to ask the stream for at once when receiving frames.
+# A single read may bring several small frames, which are then decoded
+# without reading from the stream again.
+_RECV_CHUNK_SIZE = 2**16
+
+# The client understands NEW_FIELD_DELTA messages.
+CAPABILITY_FIELD_DELTAS = 'field_deltas'
+
+# The client understands NEW_COMPACT_FIELD_STATE messages.
+CAPABILITY_COMPACT_FIELD_STATE = 'compact_field_state'
+
 
 class FrameTooLargeError(ProtocolError):
     def __init__(self, actual_length: int) -> None:
@@ -77,7 +90,7 @@ class AsyncStream(Protocol):
 class Session:
     """Base class for client and server sessions."""
 
-    def __init__(self, stream: AsyncStream) -> None:
+    def __init__(self, stream: AsyncStream, unread_data: bytes = b'') -> None:
         """Initialize self.
 
         Parameters:
@@ -85,55 +98,151 @@ class Session:
                     an async TCP network stream (such as TCP streams provided
                     by libraries like asyncio or curio, but, in theory, may have
                     a different nature.
+            unread_data: Data that has already been read from the stream, but
+                    not consumed, e.g. by another session over the same stream
+                    (see `take_unread_data`). It is received before anything
+                    else.
         """
 
         self._stream = stream
+        # Received data that has not been consumed yet starts at `_recv_pos`.
+        self._recv_buf: Union[bytes, bytearray] = unread_data
+        self._recv_pos = 0
 
     async def send_message(self, message: Message) -> None:
         """Send the specified message to the peer on the other end of the stream."""
 
-        await self._send_frame(message.to_bytes())
+        await self.send_raw_frame(self._encode_message(message))
+
+    async def send_raw_frame(self, frame: bytes) -> None:
+        """Send a message that has already been encoded with `Message.to_bytes()`.
+
+        Useful when the same message is sent to many peers: it can be encoded
+        only once.
+        """
+
+        await self._send_frame(frame)
+
+    async def send_messages(self, messages: List[Message]) -> None:
+        """Send several messages to the peer with a single write to the stream."""
+
+        await self.send_raw_frames([self._encode_message(message) for message in messages])
+
+    async def send_raw_frames(self, frames: List[bytes]) -> None:
+        """Send several messages that have already been encoded, with a single write."""
+
+        if len(frames) > 0:
+            await self._write_bytes(_join_frames(frames))
 
     async def recv_message(self) -> Message:
         """Receive a message from the peer on the other end of the
         stream.
         """
 
-        return Message.from_bytes(await self._recv_frame())
+        with await self._recv_frame_view() as frame:
+            return self._decode_message(frame)
+
+    def unread_message(self, message: Message) -> None:
+        """Put a received message back, so that it is the next one to be received."""
+
+        leftover = bytearray(_join_frames([message.to_bytes()]))
+        leftover += self._recv_buf[self._recv_pos:]
+        self._recv_buf = leftover
+        self._recv_pos = 0
+
+    def take_unread_data(self) -> bytes:
+        """Remove the data that has been received, but not consumed yet, and return it.
+
+        This allows to hand the stream over to another session, possibly in
+        another process: the data should be passed to it as `unread_data`.
+        """
+
+        data = bytes(self._recv_buf[self._recv_pos:])
+        self._recv_buf = b''
+        self._recv_pos = 0
+        return data
+
+    def _encode_message(self, message: Message) -> bytes:
+        """[Internal] Encode a message to be sent.
+
+        Subclasses may override this and `_decode_message`, e.g. to measure
+        the time spent on encoding and decoding.
+        """
+
+        return message.to_bytes()
+
+    def _decode_message(self, frame: memoryview) -> Message:
+        """[Internal] Decode a received message."""
+
+        return Message.from_bytes(frame)
 
     async def _send_frame(self, data: bytes):
         """[Internal] Send a string of bytes together with its length."""
 
-        assert len(data) <= MAX_SANE_LENGTH
-        await self._write_bytes(len(data).to_bytes(8, 'little', signed=False))
-        await self._write_bytes(data)
+        # The length and the data go in one write, so that they are not split
+        # into separate TCP segments.
+        await self._write_bytes(_join_frames([data]))
 
     async def _recv_frame(self) -> bytes:
         """[Internal] Receive a string of bytes together with its length."""
 
-        length = int.from_bytes(await self._read_bytes(8), 'little', signed=False)
+        with await self._recv_frame_view() as frame:
+            return bytes(frame)
+
+    async def _recv_frame_view(self) -> memoryview:
+        """[Internal] Receive a frame without copying it out of the receive buffer.
+
+        The returned view is only valid until the next read from the stream
+        and must be released before it.
+        """
+
+        await self._fill_recv_buf(8)
+        pos = self._recv_pos
+        length = int.from_bytes(self._recv_buf[pos : pos + 8], 'little', signed=False)
         if length > MAX_SANE_LENGTH:
             # Prevents a malicious user from crashing the server by sending it
             # a multi-gigabyte message, forcing it to run out of RAM.
             raise FrameTooLargeError(length)
-        return await self._read_bytes(length)
+
+        await self._fill_recv_buf(8 + length)
+        pos = self._recv_pos
+        self._recv_pos = pos + 8 + length
+        with memoryview(self._recv_buf) as view:
+            return view[pos + 8 : pos + 8 + length]
 
     async def _write_bytes(self, data: bytes) -> None:
         """[Internal] Write a byte string to the underlying stream."""
 
         await self._stream.write(data)
 
-    async def _read_bytes(self, how_many: int) -> bytes:
-        """[Internal] Read exactly `how_many` bytes from the underlying stream."""
+    async def _fill_recv_buf(self, how_many: int) -> None:
+        """[Internal] Read until at least `how_many` unconsumed bytes are buffered."""
 
-        buf = bytearray()
-        while len(buf) < how_many:
-            bytes_still_to_read = how_many - len(buf)
-            new_data = await self._stream.read(bytes_still_to_read)
+        while len(self._recv_buf) - self._recv_pos < how_many:
+            bytes_still_to_read = how_many - (len(self._recv_buf) - self._recv_pos)
+            new_data = await self._stream.read(max(bytes_still_to_read, _RECV_CHUNK_SIZE))
             if len(new_data) == 0:
                 raise EOFError('No more data available to read')
-            buf += new_data
-        return bytes(buf)
+
+            if self._recv_pos == len(self._recv_buf):
+                # Nothing is left over, so the new chunk becomes the buffer as is.
+                self._recv_buf = new_data
+            elif isinstance(self._recv_buf, bytearray) and self._recv_pos == 0:
+                self._recv_buf += new_data
+            else:
+                leftover = bytearray(self._recv_buf[self._recv_pos:])
+                leftover += new_data
+                self._recv_buf = leftover
+            self._recv_pos = 0
+
+
+def _join_frames(frames: List[bytes]) -> bytes:
+    parts = []
+    for data in frames:
+        assert len(data) <= MAX_SANE_LENGTH
+        parts.append(len(data).to_bytes(8, 'little', signed=False))
+        parts.append(data)
+    return b''.join(parts)
 
 
 class ClientSession(Session):
@@ -150,6 +259,8 @@ class ClientSession(Session):
 
         super().__init__(stream)
         self._info = client_info
+        # The latest field state, which field deltas are applied to.
+        self._field_state: Optional[FieldState] = None
 
     async def initialize(self):
         """Send a CLIENT_HELLO and receive a SERVER_HELLO.
@@ -168,7 +279,7 @@ class ClientSession(Session):
         a more informative exception.
         """
 
-        await self.send_message(Message.CLIENT_HELLO(self._info.name))
+        await self.send_message(Message.CLIENT_HELLO(self._info.name, self._info.capabilities))
         unwrap_variant(not_err(await self.recv_message()), 'server_hello')
 
     async def ready(self):
@@ -202,6 +313,9 @@ class ClientSession(Session):
 
         The possible types of notifications are described in the
         documentation for the ClientNotification class.
+
+        Field deltas are applied to the latest field state transparently,
+        and the resulting state is returned as a FIELD_STATE notification.
         """
 
         def err(e):
@@ -221,7 +335,9 @@ class ClientSession(Session):
                 server_hello = on_unexpected,
                 your_turn = lambda: ClientNotification.REQUEST(),
                 ready = on_unexpected,
-                new_field_state = lambda state: ClientNotification.FIELD_STATE(state),
+                new_field_state = self._on_new_field_state,
+                new_field_delta = self._on_new_field_delta,
+                new_compact_field_state = self._on_new_field_state,
                 act = on_unexpected,
                 event_happened = lambda ev: ClientNotification.EVENT(ev),
                 ok = lambda: None,
@@ -239,12 +355,33 @@ class ClientSession(Session):
             if result is not None:
                 return result
 
+    def _on_new_field_state(self, state: FieldState) -> 'ClientNotification':
+        self._field_state = state
+        return ClientNotification.FIELD_STATE(state)
+
+    def _on_new_field_delta(self, delta: FieldDelta) -> Optional['ClientNotification']:
+        if self._field_state is None:
+            # Nothing to apply the delta to: wait for a full field state.
+            return None
+        return self._on_new_field_state(delta.apply_to(self._field_state))
+
     async def respond(self, action: Action) -> None:
         """Respond to a YOUR_TURN message with an Action."""
 
         await self.send_message(Message.ACT(action))
         await self.expect_ok()
 
+    async def send_action(self, action: Action) -> None:
+        """Respond to a YOUR_TURN message with an Action without waiting for
+        the server to accept it.
+
+        This lets another task keep calling .wait_for_notification() in
+        the meantime: it skips the OK and returns an ERR as an ERROR
+        notification.
+        """
+
+        await self.send_message(Message.ACT(action))
+
     async def list_rooms(self) -> List[RoomInfo]:
         """List the game rooms on the server."""
 
@@ -319,8 +456,8 @@ class ServerSession(Session):
         """Receive a CLIENT_HELLO message and return the attached ClientInfo object."""
 
         client_msg = await self.recv_message()
-        name = unwrap_variant(client_msg, 'client_hello')
-        return ClientInfo(name=name)
+        name, capabilities = unwrap_variant(client_msg, 'client_hello')
+        return ClientInfo(name=name, capabilities=capabilities)
 
     async def initialize_ok(self) -> None:
         """Respond with a SERVER_HELLO (indicating success) to a CLIENT_HELLO."""
@@ -353,6 +490,8 @@ class ServerSession(Session):
                 get_room_properties         = fail,
                 leave_room                  = fail,
                 list_rooms                  = ok,
+                new_field_delta             = fail,
+                new_compact_field_state     = fail,
                 new_field_state             = fail,
                 new_room                    = ok,
                 ok                          = fail,
@@ -390,6 +529,8 @@ class ServerSession(Session):
                 get_room_properties         = ok,
                 leave_room                  = ok,
                 list_rooms                  = fail,
+                new_field_delta             = fail,
+                new_compact_field_state     = fail,
                 new_field_state             = fail,
                 new_room                    = fail,
                 ok                          = fail,
@@ -442,6 +583,23 @@ class ServerSession(Session):
 
         await self.send_message(Message.NEW_FIELD_STATE(state))
 
+    async def send_new_field_delta(self, delta: FieldDelta) -> None:
+        """Send the changes in the field state to the client.
+
+        Must only be used if the client supports CAPABILITY_FIELD_DELTAS
+        and has already received a full field state.
+        """
+
+        await self.send_message(Message.NEW_FIELD_DELTA(delta))
+
+    async def send_new_compact_field_state(self, state: FieldState) -> None:
+        """Send a new field state to the client in the compact encoding.
+
+        Must only be used if the client supports CAPABILITY_COMPACT_FIELD_STATE.
+        """
+
+        await self.send_message(Message.NEW_COMPACT_FIELD_STATE(state))
+
     async def send_event(self, event: Event) -> None:
         """Inform the client about an event."""
 
@@ -496,10 +654,13 @@ class ClientInfo:
     """Stores the information about a client.
 
     Fields:
-        name:   The name of the player.
+        name:           The name of the player.
+        capabilities:   Optional protocol features supported by the client
+                        (such as CAPABILITY_FIELD_DELTAS).
     """
 
     name: str
+    capabilities: List[str] = field(default_factory=list)
 
 
 @adt
@@ -1,8 +1,20 @@
-from bot_arena_proto.data import Direction, Point, SnakeState, FieldState, Object, Action
+from bot_arena_proto.data import (
+    Action,
+    Direction,
+    FieldDelta,
+    FieldState,
+    Object,
+    Point,
+    SnakeDelta,
+    SnakeState,
+)
 
+import copy
 import itertools
+import random
 
 import pytest
+from bot_arena_proto.serialization import DeserializationError
 
 
 class TestBasicSoundnesss:
@@ -115,6 +127,179 @@ class TestBasicSerde:
         assert Action.from_primitive(['m', 'd']) == Action.MOVE(Direction.DOWN())
 
 
+class TestFieldDelta:
+    @staticmethod
+    def test_snake_delta():
+        snake = SnakeState(head=Point(2, 4), tail=[Direction.RIGHT(), Direction.DOWN(), Direction.LEFT()])
+
+        moved = SnakeDelta(advances=[Direction.UP()], tail_pops=1).apply_to(snake)
+        assert moved == SnakeState(head=Point(2, 5), tail=[Direction.DOWN(), Direction.RIGHT(), Direction.DOWN()])
+
+        grown = SnakeDelta(advances=[Direction.UP(), Direction.LEFT()], tail_pops=0).apply_to(snake)
+        assert grown == SnakeState(
+            head = Point(1, 5),
+            tail = [Direction.RIGHT(), Direction.DOWN(), Direction.RIGHT(), Direction.DOWN(), Direction.LEFT()],
+        )
+
+        lone = SnakeState(head=Point(0, 0), tail=[])
+        assert SnakeDelta(advances=[Direction.RIGHT()], tail_pops=1).apply_to(lone) == SnakeState(
+            head = Point(1, 0),
+            tail = [],
+        )
+
+    @staticmethod
+    def test_apply_to_field_state():
+        state = FieldState(
+            snakes = {
+                'A': SnakeState(head=Point(1, 1), tail=[Direction.LEFT()]),
+                'B': SnakeState(head=Point(5, 5), tail=[]),
+            },
+            objects = [(Point(1, 2), Object.FOOD()), (Point(7, 7), Object.FOOD())],
+        )
+        delta = FieldDelta(
+            snakes = {
+                'A': SnakeDelta(advances=[Direction.UP()], tail_pops=0),
+                'B': SnakeDelta(advances=[Direction.UP()], tail_pops=1),
+                'C': SnakeDelta(advances=[Direction.UP()], tail_pops=1),
+            },
+            dead_snakes = ['B', 'D'],
+            new_objects = [(Point(3, 3), Object.FOOD())],
+            removed_objects = [Point(1, 2), Point(0, 0)],
+        )
+
+        new_state = delta.apply_to(state)
+        assert new_state.snakes == {'A': SnakeState(head=Point(1, 2), tail=[Direction.DOWN(), Direction.LEFT()])}
+        assert dict(new_state.objects) == {Point(7, 7): Object.FOOD(), Point(3, 3): Object.FOOD()}
+
+        # The base state is not modified.
+        assert state.snakes['A'] == SnakeState(head=Point(1, 1), tail=[Direction.LEFT()])
+        assert len(state.objects) == 2
+
+    @staticmethod
+    def test_serde():
+        delta = FieldDelta(
+            snakes = {'A': SnakeDelta(advances=[Direction.UP(), Direction.LEFT()], tail_pops=1)},
+            dead_snakes = ['B'],
+            new_objects = [(Point(3, 3), Object.FOOD())],
+            removed_objects = [Point(1, 2)],
+        )
+        assert FieldDelta.from_primitive(delta.to_primitive()) == delta
+        assert not delta.is_empty()
+        assert FieldDelta(snakes={}, dead_snakes=[], new_objects=[], removed_objects=[]).is_empty()
+
+
+class TestCompactFieldState:
+    @staticmethod
+    def test_roundtrip():
+        directions = [Direction.UP(), Direction.DOWN(), Direction.LEFT(), Direction.RIGHT()]
+        for tail_len in range(10):
+            state = FieldState(
+                snakes = {
+                    f'snake{i}': SnakeState(
+                        head = Point(random.randrange(1000), random.randrange(1000)),
+                        tail = [random.choice(directions) for _ in range(tail_len + i)],
+                    )
+                    for i in range(3)
+                },
+                objects = [(Point(i, 2 * i), Object.FOOD()) for i in range(tail_len)],
+            )
+            assert FieldState.from_compact_primitive(state.to_compact_primitive()) == state
+
+    @staticmethod
+    def test_invalid():
+        valid = FieldState(
+            snakes = {'A': SnakeState(head=Point(1, 2), tail=[Direction.UP()] * 5)},
+            objects = [(Point(0, 0), Object.FOOD())],
+        ).to_compact_primitive()
+
+        invalid_snakes = [
+            [b'\x01\x00\x02', 5, b'\x00\x00'],
+            [b'\x01\x00\x02\x00', 9, b'\x00\x00'],
+            [b'\x01\x00\x02\x00', -1, b''],
+            [b'\x01\x00\x02\x00', 5, 'uuuuu'],
+        ]
+        for snake in invalid_snakes:
+            with pytest.raises(DeserializationError):
+                FieldState.from_compact_primitive(dict(valid, snakes={'A': snake}))
+
+        with pytest.raises(DeserializationError):
+            FieldState.from_compact_primitive(dict(valid, objects=[b'\x00\x00\x00\x00', 'ff']))
+
+
+def reference_direction_primitive(direction):
+    return direction.match(up=lambda: 'u', down=lambda: 'd', left=lambda: 'l', right=lambda: 'r')
+
+
+def reference_field_state_primitive(state):
+    """Encode a field state the straightforward way, one `match` per element."""
+
+    return {
+        'snakes': {
+            name: {
+                'head': [snake.head.x, snake.head.y],
+                'tail': [reference_direction_primitive(d) for d in snake.tail],
+            }
+            for name, snake in state.snakes.items()
+        },
+        'objects': [[[point.x, point.y], obj.match(food=lambda: 'f')] for point, obj in state.objects],
+    }
+
+
+class TestFastCodec:
+    @staticmethod
+    def test_matches_reference():
+        directions = [Direction.UP(), Direction.DOWN(), Direction.LEFT(), Direction.RIGHT()]
+        for _ in range(20):
+            state = FieldState(
+                snakes = {
+                    f'snake{i}': SnakeState(
+                        head = Point(random.randrange(-5, 100), random.randrange(-5, 100)),
+                        tail = [random.choice(directions) for _ in range(random.randrange(30))],
+                    )
+                    for i in range(random.randrange(5))
+                },
+                objects = [
+                    (Point(random.randrange(100), random.randrange(100)), Object.FOOD())
+                    for _ in range(random.randrange(5))
+                ],
+            )
+            primitive = reference_field_state_primitive(state)
+            assert state.to_primitive() == primitive
+            assert FieldState.from_primitive(primitive) == state
+
+    @staticmethod
+    def test_invalid_elements():
+        valid = {'snakes': {'A': {'head': [1, 2], 'tail': ['u', 'l']}}, 'objects': [[[0, 0], 'f']]}
+        assert FieldState.from_primitive(valid) == FieldState(
+            snakes = {'A': SnakeState(head=Point(1, 2), tail=[Direction.UP(), Direction.LEFT()])},
+            objects = [(Point(0, 0), Object.FOOD())],
+        )
+
+        invalid_snakes = [
+            {'head': [1, 2], 'tail': ['u', 'x']},
+            {'head': [1, 2], 'tail': ['u', ['l']]},
+            {'head': [1, 2], 'tail': [0]},
+            {'head': [1, '2'], 'tail': []},
+            {'head': [1, 2, 3], 'tail': []},
+            {'head': [1], 'tail': []},
+        ]
+        for snake in invalid_snakes:
+            with pytest.raises(DeserializationError):
+                FieldState.from_primitive(dict(valid, snakes={'A': snake}))
+
+        for obj in [[[0, 0], 'g'], [[0, 0], ['f']], [[0.5, 0], 'f']]:
+            with pytest.raises(DeserializationError):
+                FieldState.from_primitive(dict(valid, objects=[obj]))
+
+    @staticmethod
+    def test_direction_tables():
+        for direction in [Direction.UP(), Direction.DOWN(), Direction.LEFT(), Direction.RIGHT()]:
+            assert direction.to_primitive() == reference_direction_primitive(direction)
+            assert direction.opposite().opposite() == direction
+            assert direction.opposite() != direction
+            assert Point(0, 0).shift(direction).shift(direction.opposite()) == Point(0, 0)
+
+
 class TestPoint:
     @staticmethod
     def test_that_shift_works():
@@ -145,6 +330,24 @@ class TestPoint:
         for i, j in itertools.product([a, b, c, d], repeat=2):
             assert i != j or hash(i) == hash(j)
 
+    @staticmethod
+    def test_immutable():
+        point = Point(1, 2)
+        with pytest.raises(AttributeError):
+            point.x = 3  # type: ignore
+        assert not hasattr(point, '__dict__')
+        assert copy.copy(point) is point
+        assert copy.deepcopy(point) is point
+
+    @staticmethod
+    def test_interned():
+        assert Point.interned(3, 4) is Point.interned(3, 4)
+        assert Point.interned(3, 4) == Point(3, 4)
+        assert Point(3, 4).shift(Direction.UP()) is Point.interned(3, 5)
+        assert Point.from_primitive([3, 4]) == Point.interned(3, 4)
+        for x, y in [(-1, 0), (0, -1), (10**6, 5), (5, 10**6)]:
+            assert Point.interned(x, y) == Point(x, y)
+
 
 class TestDirection:
     @staticmethod
@@ -161,3 +364,12 @@ class TestDirection:
         for i, j in itertools.product([a1, b1, c1, d1, a2, b2, c2, d2], repeat=2):
             assert i != j or hash(i) == hash(j)
 
+    @staticmethod
+    def test_interned():
+        assert Direction.UP() is Direction.UP()
+        assert Direction.from_primitive('l') is Direction.LEFT()
+        assert Direction.DOWN().opposite() is Direction.UP()
+        assert copy.deepcopy(Direction.RIGHT()) is Direction.RIGHT()
+        assert Object.from_primitive('f') is Object.FOOD()
+        assert FieldState.from_primitive({'snakes': {}, 'objects': [[[1, 1], 'f']]}).objects[0][1] is Object.FOOD()
+
@@ -1,6 +1,7 @@
-from bot_arena_proto.data import FieldState, SnakeState, Action, Direction, Point, Object
+from bot_arena_proto.data import FieldDelta, FieldState, SnakeDelta, SnakeState, Action, Direction, Point, Object
 from bot_arena_proto.event import Event
 from bot_arena_proto.message import Message
+from bot_arena_proto.serialization import variant_key, variant_keys
 
 import copy
 import itertools
@@ -10,7 +11,8 @@ import pytest
 
 def test_basic_soundness():
     samples = [
-        Message.CLIENT_HELLO('Bot 1'), Message.CLIENT_HELLO('Bot 2'),
+        Message.CLIENT_HELLO('Bot 1', []), Message.CLIENT_HELLO('Bot 2', []),
+        Message.CLIENT_HELLO('Bot 1', ['field_deltas']),
         Message.SERVER_HELLO(),
         Message.YOUR_TURN(),
         Message.READY(),
@@ -26,6 +28,9 @@ def test_basic_soundness():
                 objects = [],
             )
         ),
+        Message.NEW_FIELD_DELTA(
+            FieldDelta(snakes={}, dead_snakes=['Bob'], new_objects=[], removed_objects=[]),
+        ),
         Message.ACT(Action.MOVE(Direction.LEFT())), Message.ACT(Action.MOVE(Direction.UP())),
         Message.EVENT_HAPPENED(Event(name='GameFinished', data=None, must_know=True)),
         Message.EVENT_HAPPENED(Event(name='SnakeDied', data='Bob', must_know=False)),
@@ -47,11 +52,45 @@ def test_basic_soundness():
             assert a != b
 
 
+def test_every_variant():
+    state = FieldState(snakes={'A': SnakeState(head=Point(1, 1), tail=[Direction.UP()])}, objects=[])
+    samples = [
+        Message.CLIENT_HELLO('Bot', ['field_deltas']),
+        Message.SERVER_HELLO(),
+        Message.YOUR_TURN(),
+        Message.READY(),
+        Message.NEW_FIELD_STATE(state),
+        Message.NEW_FIELD_DELTA(FieldDelta(snakes={}, dead_snakes=['A'], new_objects=[], removed_objects=[])),
+        Message.NEW_COMPACT_FIELD_STATE(state),
+        Message.ACT(Action.MOVE(Direction.LEFT())),
+        Message.EVENT_HAPPENED(Event(name='GameFinished', data=None, must_know=True)),
+        Message.OK(),
+        Message.ERR('foo'),
+        Message.LIST_ROOMS(),
+        Message.ENTER_ROOM('room', None),
+        Message.ENTER_ANY_ROOM(),
+        Message.NEW_ROOM(),
+        Message.LEAVE_ROOM(),
+        Message.GET_ROOM_PROPERTIES(),
+        Message.SET_ROOM_PROPERTIES({'max_players': 3}),
+        Message.ROOM_LIST_AVAILABLE([]),
+        Message.ROOM_PROPERTIES_AVAILABLE({'name': 'room'}),
+    ]
+    assert {variant_key(message) for message in samples} == set(variant_keys(Message))
+
+    for message in samples:
+        primitive = message.to_primitive()
+        assert message.kind() == primitive[0]
+        assert Message.from_primitive(primitive) == message
+
+
 class TestBasicSerde:
     @staticmethod
     def test_client_hello():
-        assert Message.CLIENT_HELLO('Bob').to_primitive() == ['ClientHello', 'Bob']
-        assert Message.from_primitive(['ClientHello', 'Sam']) == Message.CLIENT_HELLO('Sam')
+        assert Message.CLIENT_HELLO('Bob', []).to_primitive() == ['ClientHello', 'Bob']
+        assert Message.from_primitive(['ClientHello', 'Sam']) == Message.CLIENT_HELLO('Sam', [])
+        assert Message.CLIENT_HELLO('Bob', ['x', 'y']).to_primitive() == ['ClientHello', 'Bob', ['x', 'y']]
+        assert Message.from_primitive(['ClientHello', 'Sam', ['x']]) == Message.CLIENT_HELLO('Sam', ['x'])
 
     @staticmethod
     def test_server_hello():
@@ -110,6 +149,42 @@ class TestBasicSerde:
         assert m2.to_primitive() == p2
         assert Message.from_primitive(p2) == m2
 
+    @staticmethod
+    def test_new_field_delta():
+        delta = FieldDelta(
+            snakes = {'Bob': SnakeDelta(advances=[Direction.UP()], tail_pops=1)},
+            dead_snakes = ['Sam'],
+            new_objects = [(Point(1, 2), Object.FOOD())],
+            removed_objects = [Point(3, 3)],
+        )
+        primitive = [
+            'NewFieldDelta',
+            {
+                'snakes': {'Bob': {'advances': ['u'], 'tail_pops': 1}},
+                'dead_snakes': ['Sam'],
+                'new_objects': [[[1, 2], 'f']],
+                'removed_objects': [[3, 3]],
+            },
+        ]
+        assert Message.NEW_FIELD_DELTA(delta).to_primitive() == primitive
+        assert Message.from_primitive(primitive) == Message.NEW_FIELD_DELTA(delta)
+
+    @staticmethod
+    def test_new_compact_field_state():
+        state = FieldState(
+            snakes = {'Bob': SnakeState(head=Point(1, 258), tail=[Direction.DOWN(), Direction.RIGHT()])},
+            objects = [(Point(3, 4), Object.FOOD())],
+        )
+        primitive = [
+            'NewCompactFieldState',
+            {
+                'snakes': {'Bob': [b'\x01\x00\x02\x01', 2, b'\x0d']},
+                'objects': [b'\x03\x00\x04\x00', 'f'],
+            },
+        ]
+        assert Message.NEW_COMPACT_FIELD_STATE(state).to_primitive() == primitive
+        assert Message.from_primitive(primitive) == Message.NEW_COMPACT_FIELD_STATE(state)
+
     @staticmethod
     def test_act():
         assert Message.ACT(Action.MOVE(Direction.DOWN())).to_primitive() == ['Act', ['m', 'd']]
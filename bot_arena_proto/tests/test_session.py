@@ -1,8 +1,9 @@
 import pytest
 
-from bot_arena_proto.session import ClientSession, ServerSession, ClientInfo, GameInfo
+from bot_arena_proto.session import ClientSession, ServerSession, Session, ClientInfo, GameInfo, CAPABILITY_FIELD_DELTAS
+from bot_arena_proto.message import Message
 from bot_arena_proto.event import Event
-from bot_arena_proto.data import FieldState, Direction, Point, SnakeState, Object, Action
+from bot_arena_proto.data import FieldDelta, FieldState, Direction, Point, SnakeDelta, SnakeState, Object, Action
 
 import sys
 from queue import Queue, Empty
@@ -110,7 +111,10 @@ def print_now(*a, **k):
 
 async def client_session(endpoint):
     print_now('Client: starting')
-    sess = ClientSession(endpoint, client_info=ClientInfo(name='Python39'))
+    sess = ClientSession(
+        endpoint,
+        client_info=ClientInfo(name='Python39', capabilities=[CAPABILITY_FIELD_DELTAS]),
+    )
     print_now('Client: created session')
     await sess.initialize()
     print_now('Client: sess.initialize() called')
@@ -134,6 +138,10 @@ async def client_session(endpoint):
     await sess.respond(Action.MOVE(Direction.UP()))
     print_now('Client: now move up')
 
+    (await sess.wait_for_notification()).request()
+    await sess.send_action(Action.MOVE(Direction.RIGHT()))
+    print_now('Client: move right without waiting for OK')
+
     fs = (await sess.wait_for_notification()).field_state()
     print_now('Client: received field state update')
     assert fs == FieldState(
@@ -145,6 +153,15 @@ async def client_session(endpoint):
         ]
     )
 
+    fs = (await sess.wait_for_notification()).field_state()
+    print_now('Client: received field delta')
+    assert fs == FieldState(
+        snakes = {
+            'Bob': SnakeState(head=Point(3, 5), tail=[Direction.DOWN()]),
+        },
+        objects = [],
+    )
+
     assert (await sess.wait_for_notification()).event().name == 'GameFinished'
     print_now('Client: game finished')
 
@@ -157,6 +174,7 @@ async def server_session(endpoint):
     name = client_info.name
     print_now('Server: sess.pre_initialize() called')
     assert name == 'Python39'
+    assert client_info.capabilities == [CAPABILITY_FIELD_DELTAS]
     print_now('Server: name ok')
     await sess.initialize_ok()
     print_now('Server: initialized')
@@ -176,6 +194,8 @@ async def server_session(endpoint):
     assert another_action == Action.MOVE(Direction.UP())
     await sess.respond_ok()
     print_now('Server: accepted player\'s action')
+    assert await sess.request_action() == Action.MOVE(Direction.RIGHT())
+    await sess.respond_ok()
     await sess.send_new_field_state(
         FieldState(
             snakes = {
@@ -187,6 +207,15 @@ async def server_session(endpoint):
         )
     )
     print_now('Server: sent new field state')
+    await sess.send_new_field_delta(
+        FieldDelta(
+            snakes = {'Bob': SnakeDelta(advances=[Direction.UP()], tail_pops=1)},
+            dead_snakes = [],
+            new_objects = [],
+            removed_objects = [Point(1, 0)],
+        )
+    )
+    print_now('Server: sent field delta')
     await sess.send_event(Event(name='GameFinished', data=None, must_know=True))
     print_now('Server: game finished')
 
@@ -195,3 +224,91 @@ def test_session():
     fake_stream = FakeStream()
     a, b = fake_stream.pipe()
     run(client_session(a), server_session(b))
+
+
+class ScriptedStream:
+    """Returns the given chunks from successive reads, regardless of the requested size."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.num_reads = 0
+
+    async def read(self, size: int) -> bytes:
+        self.num_reads += 1
+        if len(self.chunks) == 0:
+            return b''
+        return self.chunks.pop(0)
+
+
+def run_to_completion(coro):
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise AssertionError('The coroutine was not expected to suspend')
+
+
+def make_frame(message: Message) -> bytes:
+    data = message.to_bytes()
+    return len(data).to_bytes(8, 'little') + data
+
+
+def test_pipelined_frames_are_read_at_once():
+    messages = [Message.OK(), Message.ERR('Oops'), Message.ACT(Action.MOVE(Direction.UP()))]
+    stream = ScriptedStream([b''.join(make_frame(m) for m in messages)])
+    sess = Session(stream)
+
+    for message in messages:
+        assert run_to_completion(sess.recv_message()) == message
+    assert stream.num_reads == 1
+
+    with pytest.raises(EOFError):
+        run_to_completion(sess.recv_message())
+
+
+def test_frames_split_across_reads():
+    messages = [Message.ERR('x' * 100), Message.OK(), Message.ERR('y' * 5)]
+    data = b''.join(make_frame(m) for m in messages)
+    for chunk_size in [1, 3, 8, 50, 1000]:
+        stream = ScriptedStream(data[i : i + chunk_size] for i in range(0, len(data), chunk_size))
+        sess = Session(stream)
+        for message in messages:
+            assert run_to_completion(sess.recv_message()) == message
+
+
+class RecordingStream:
+    def __init__(self):
+        self.writes = []
+
+    async def write(self, data: bytes):
+        self.writes.append(data)
+
+
+def test_send_messages_writes_once():
+    messages = [Message.OK(), Message.ERR('Oops'), Message.YOUR_TURN()]
+    recording_stream = RecordingStream()
+    sess = Session(recording_stream)
+
+    run_to_completion(sess.send_messages(messages))
+    run_to_completion(sess.send_message(Message.OK()))
+    run_to_completion(sess.send_raw_frames([]))
+    assert len(recording_stream.writes) == 2
+
+    reading_sess = Session(ScriptedStream(recording_stream.writes))
+    for message in messages + [Message.OK()]:
+        assert run_to_completion(reading_sess.recv_message()) == message
+
+
+def test_unread_data_is_handed_over():
+    messages = [Message.OK(), Message.ERR('Oops'), Message.YOUR_TURN()]
+    data = b''.join(make_frame(m) for m in messages)
+    sess = Session(ScriptedStream([data[:-3]]))
+
+    first = run_to_completion(sess.recv_message())
+    assert first == messages[0]
+    sess.unread_message(first)
+    unread_data = sess.take_unread_data()
+
+    new_sess = Session(ScriptedStream([data[-3:]]), unread_data)
+    for message in messages:
+        assert run_to_completion(new_sess.recv_message()) == message
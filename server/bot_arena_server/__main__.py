@@ -1,12 +1,12 @@
+from bot_arena_server.cli_types import int_ge, uint, ufloat
 from bot_arena_server.server import Server
+from bot_arena_server.sharded_server import ShardedServer
 from bot_arena_server.game_loop import run_game_loop
 from bot_arena_server.limits import Limits, UpperBound, OptionalUpperBound, Range
 from bot_arena_server.work_limit import WorkLimit
 
-import math
 import sys
 from argparse import ArgumentParser, Namespace
-from typing import Callable
 
 from loguru import logger
 
@@ -16,49 +16,31 @@ __all__ = [
 ]
 
 
-def uint(s: str) -> int:
-    n = int(s)
-    if n < 0:
-        raise ValueError('Value is negative')
-    return n
-
-
-def ufloat(s: str) -> float:
-    f = float(s)
-    if f < 0:
-        raise ValueError('Value is negative')
-    if not math.isfinite(f):
-        raise ValueError('Value is NaN or infinite')
-
-    return f
-
-
-def int_ge(limit: int) -> Callable[[str], int]:
-    def inner(s: str) -> int:
-        n = int(s)
-        if n < limit:
-            raise ValueError(f'value is less than {limit}')
-        return n
-
-    inner.__name__ = f'int ≥ {limit}'
-    return inner
-
-
 def parse_args() -> Namespace:
     ap = ArgumentParser(prog='bot-arena-server', description='Pythons game server')
+    ap.add_argument('--broadcast-write-timeout', type=ufloat, default=5.0, help='Clients that take longer than this many seconds to receive a broadcast message are disconnected')
     ap.add_argument('--listen-on', default='0.0.0.0', help='IP address or domain name to listen on')
     ap.add_argument('--port', '-p', type=uint, default=23456, help='Port to listen on')
     ap.add_argument('--max-client-name-len', type=uint, default=50, help='Maximum allowed client name length')
     ap.add_argument('--max-field-side', type=uint, default=200, help='Maximum allowed field width/height')
     ap.add_argument('--min-field-side', type=uint, default=5, help='Minimum allowed field width/height')
     ap.add_argument('--max-food-items', type=uint, default=50, help='Maximum allowed initial number of food items')
+    ap.add_argument('--max-pending-events', type=uint, default=1000, help='Clients that have more than this many events waiting to be sent are disconnected')
     ap.add_argument('--max-password-len', type=uint, default=500, help='Maximum allowed password length')
     ap.add_argument('--max-room-name-len', type=int_ge(16), default=50, help='Maximum allowed room name length (at least 16)')
     ap.add_argument('--max-room-players', type=uint, default=20, help='Maximum allowed number of players in a room')
     ap.add_argument('--max-snake-len', type=uint, default=50, help='Maximum allowed initial snake length')
     ap.add_argument('--max-turn-timeout', type=ufloat, default=None, help='Maximum allowed turn timeout in seconds')
     ap.add_argument('--max-turns', type=uint, default=None, help='Maximum allowed number of turns')
-    ap.add_argument('--turn-delay', type=ufloat, default=0.1, help='Delay between turns in seconds')
+    ap.add_argument('--max-turns-per-second', type=ufloat, default=None, help='Maximum turn rate a room may set with the "turns_per_second" property')
+    ap.add_argument('--metrics-listen-on', default='127.0.0.1', help='IP address or domain name to serve the metrics on')
+    ap.add_argument('--metrics-port', type=uint, default=None, help='Port to serve the metrics on, in the Prometheus text format at /metrics (not served by default)')
+    ap.add_argument('--replay-dir', default=None, help='Record every game into this directory, so that it can be replayed')
+    ap.add_argument('--spectator-buffer-size', type=uint, default=256, help='Number of updates buffered for the viewers of a game; viewers lagging further behind skip ahead')
+    ap.add_argument('--trace-dir', default=None, help='Save a trace of every game (in the Chrome trace-event JSON format) into this directory')
+    ap.add_argument('--turn-delay', type=ufloat, default=0.1, help='Interval between the starts of consecutive turns in seconds, unless the room sets its own rate (the time the turn itself takes counts towards it)')
+    ap.add_argument('--unpaced-without-viewers', action='store_true', help='Run the games that have no viewers as fast as possible, unless the room sets its own rate')
+    ap.add_argument('--workers', type=uint, default=0, help='Number of worker processes running the rooms; with 0, everything runs in a single process')
     ap.add_argument('--work-units', type=uint, default=500, help='Maximum allowed amount of game preparation work')
     return ap.parse_args()
 
@@ -76,6 +58,13 @@ def make_limits(args: Namespace) -> Limits:
         max_turns = OptionalUpperBound(args.max_turns),
         turn_delay = args.turn_delay,
         work_units = WorkLimit(args.work_units),
+        broadcast_write_timeout = args.broadcast_write_timeout,
+        max_pending_events = args.max_pending_events,
+        spectator_buffer_size = args.spectator_buffer_size,
+        trace_dir = args.trace_dir,
+        replay_dir = args.replay_dir,
+        max_turns_per_second = OptionalUpperBound(args.max_turns_per_second),
+        unpaced_without_viewers = args.unpaced_without_viewers,
     )
 
 
@@ -84,9 +73,13 @@ def main() -> None:
     logger.remove()
     logger.add(sys.stderr, level='INFO')
     limits = make_limits(args)
-    server = Server(run_game_loop, limits)
+    if args.workers > 0:
+        server = ShardedServer(run_game_loop, limits, args.workers)
+    else:
+        server = Server(run_game_loop, limits)
 
-    server.listen(args.listen_on, args.port)
+    metrics_address = None if args.metrics_port is None else (args.metrics_listen_on, args.metrics_port)
+    server.listen(args.listen_on, args.port, metrics_address)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,335 @@
+"""Play many games in-process, without the network server.
+
+Useful for tuning bots: the games reuse `Game` directly, with no sessions,
+no game rooms and no turn delay, and can be distributed over several
+processes. Results are printed as JSON lines, one per game.
+
+Example:
+
+    python -m bot_arena_server.batch --games 1000 --workers 8 \\
+        --bot A=random --bot B=exec:./greedybot --bot C=my_bots:chase_food
+"""
+
+from bot_arena_server.cli_types import probability, uint
+from bot_arena_server.field_storage import FIELD_STORAGE_KINDS
+from bot_arena_server.game import Game, IllegalAction
+from bot_arena_server.game_config import GameConfig
+from bot_arena_server.work_limit import WorkLimit
+
+import importlib
+import json
+import multiprocessing
+import random
+import subprocess
+import sys
+from argparse import ArgumentParser, Namespace
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from bot_arena_proto.data import Action, Direction, FieldState, FoodRespawnBehavior, Point
+from bot_arena_proto.session import GameInfo
+
+
+__all__ = [
+    'BatchJob',
+    'Policy',
+    'SubprocessPolicy',
+    'load_policy',
+    'main',
+    'play_game',
+    'random_policy',
+    'run_batch',
+]
+
+
+# A policy is given the snake's name, the current state of the field and
+# the dimensions of the field, and returns the snake's action.
+Policy = Callable[[str, FieldState, GameInfo], Action]
+
+
+_DIRECTIONS = [Direction.UP(), Direction.DOWN(), Direction.LEFT(), Direction.RIGHT()]
+
+
+def random_policy(name: str, state: FieldState, info: GameInfo) -> Action:
+    """Move in a random direction that does not crash right away, if there is one."""
+
+    occupied = set()
+    for snake in state.snakes.values():
+        cell = snake.head
+        occupied.add(cell)
+        for direction in snake.tail:
+            cell = cell.shift(direction)
+            occupied.add(cell)
+
+    head = state.snakes[name].head
+    safe_directions = [
+        direction
+        for direction in _DIRECTIONS
+        if _is_within(head.shift(direction), info) and head.shift(direction) not in occupied
+    ]
+    return Action.MOVE(random.choice(safe_directions or _DIRECTIONS))
+
+
+def _is_within(cell: Point, info: GameInfo) -> bool:
+    return 0 <= cell.x < info.field_width and 0 <= cell.y < info.field_height
+
+
+class SubprocessPolicy:
+    """Runs an external bot once per turn, the same way the desktop client does.
+
+    The bot receives the field as a matrix on stdin: the height, the width,
+    the number marking its own body and the number marking its head, followed
+    by the cells row by row (0 is empty, 1 is food, 2k and 2k + 1 are the body
+    and the head of the k-th snake). It must print 0, 1, 2 or 3 to move down,
+    right, up or left, respectively.
+    """
+
+    _moves = {
+        '0': Direction.DOWN(),
+        '1': Direction.RIGHT(),
+        '2': Direction.UP(),
+        '3': Direction.LEFT(),
+    }
+
+    def __init__(self, cmd: str) -> None:
+        self.cmd = cmd
+
+    def __call__(self, name: str, state: FieldState, info: GameInfo) -> Action:
+        bot_process = subprocess.run(
+            args = self.cmd,
+            shell = True,
+            stdout = subprocess.PIPE,
+            input = self.encode_input(name, state, info),
+            encoding = 'ascii',
+            check = True,
+        )
+        move = bot_process.stdout.strip()
+        if move not in self._moves:
+            raise ValueError(f'Invalid move from bot {self.cmd!r}: {move!r}')
+        return Action.MOVE(self._moves[move])
+
+    @staticmethod
+    def encode_input(name: str, state: FieldState, info: GameInfo) -> str:
+        matrix = [[0] * info.field_width for _ in range(info.field_height)]
+        own_index = 0
+        for i, (snake_name, snake) in enumerate(state.snakes.items()):
+            index = 2 * (i + 1)
+            if snake_name == name:
+                own_index = index
+            cell = snake.head
+            matrix[cell.y][cell.x] = index + 1
+            for direction in snake.tail:
+                cell = cell.shift(direction)
+                matrix[cell.y][cell.x] = index
+
+        for point, _ in state.objects:
+            matrix[point.y][point.x] = 1
+
+        numbers = [info.field_height, info.field_width, own_index, own_index + 1]
+        numbers.extend(value for row in matrix for value in row)
+        return ' '.join(map(str, numbers)) + '\n'
+
+
+def load_policy(spec: str) -> Policy:
+    """Turn a policy specification from the command line into a policy.
+
+    `random` is the built-in random policy, `exec:COMMAND` runs COMMAND as
+    a subprocess bot, and `MODULE:ATTRIBUTE` imports a Python callable.
+    """
+
+    if spec == 'random':
+        return random_policy
+
+    if spec.startswith('exec:'):
+        return SubprocessPolicy(spec[len('exec:'):])
+
+    module_name, sep, attr = spec.partition(':')
+    if sep == '' or module_name == '' or attr == '':
+        raise ValueError(f'Invalid policy specification: {spec!r}')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+@dataclass
+class BatchJob:
+    """Everything needed to play one game, in a form that can be sent to another process.
+
+    `Game` objects, configs and policies are not picklable (the adt types are
+    not), so policies are passed as their specifications and `respawn_food`
+    as its primitive.
+    """
+
+    index: int
+    seed: Optional[int]
+    # Snake name -> policy specification, see `load_policy`.
+    bots: Dict[str, str]
+    config: Dict[str, Any]
+    work_units: int = 500
+    simultaneous_moves: bool = False
+
+    @staticmethod
+    def pack_config(config: GameConfig) -> Dict[str, Any]:
+        return dict(vars(config), respawn_food=config.respawn_food.to_primitive())
+
+    def unpack_config(self) -> GameConfig:
+        params = dict(self.config)
+        params['respawn_food'] = FoodRespawnBehavior.from_primitive(params['respawn_food'])
+        return GameConfig(**params)
+
+
+def play_game(
+    policies: Dict[str, Policy],
+    config: GameConfig,
+    work_limit: WorkLimit,
+    simultaneous_moves: bool = False,
+) -> Dict[str, Any]:
+    """Play a single game to the end and return its result.
+
+    The turns are taken in the same order as in a game room. A snake whose
+    policy raises an exception is killed off, just like a disconnected player.
+    """
+
+    names = list(policies.keys())
+    game = Game(names, config, work_limit)
+    info = game.info()
+    num_turns = 0
+
+    def get_action(name: str, state: FieldState) -> Optional[Action]:
+        try:
+            return policies[name](name, state, info)
+        except Exception:
+            game.kill_snake_off(name)
+            return None
+
+    while not game.is_finish_condition_satisfied():
+        if simultaneous_moves:
+            state = game.field.get_state()
+            actions = {}
+            for name in names:
+                if name in state.snakes:
+                    action = get_action(name, state)
+                    if action is not None:
+                        actions[name] = action
+            game.take_simultaneous_turn(actions)
+        else:
+            for name in names:
+                if game.is_finish_condition_satisfied():
+                    break
+                state = game.field.get_state()
+                if name not in state.snakes:
+                    continue
+                action = get_action(name, state)
+                if action is not None:
+                    try:
+                        game.take_turn(name, action)
+                    except IllegalAction:
+                        pass
+
+        game.finish_turn()
+        num_turns += 1
+
+    return {
+        'turns': num_turns,
+        'winners': game.get_winners(),
+        'scores': game.get_score().score,
+    }
+
+
+def _run_job(job: BatchJob) -> Dict[str, Any]:
+    if job.seed is not None:
+        random.seed(job.seed)
+
+    result = play_game(
+        policies = {name: load_policy(spec) for name, spec in job.bots.items()},
+        config = job.unpack_config(),
+        work_limit = WorkLimit(job.work_units),
+        simultaneous_moves = job.simultaneous_moves,
+    )
+    return dict(game=job.index, seed=job.seed, **result)
+
+
+def run_batch(jobs: List[BatchJob], workers: int = 1) -> Iterator[Dict[str, Any]]:
+    """Play the games, yielding their results as they finish.
+
+    With more than one worker, the games are distributed over a process pool
+    and the results may come in any order.
+    """
+
+    if workers <= 1:
+        yield from map(_run_job, jobs)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap_unordered(_run_job, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
+
+
+def parse_args() -> Namespace:
+    ap = ArgumentParser(prog='bot-arena-batch', description='Play Pythons games without the server')
+    ap.add_argument('--bot', action='append', required=True, metavar='NAME=POLICY', help='Add a snake with a policy: random, exec:COMMAND or MODULE:ATTRIBUTE')
+    ap.add_argument('--field-height', type=uint, default=40, help='Field height')
+    ap.add_argument('--field-storage', choices=FIELD_STORAGE_KINDS, default='hash', help='Field storage engine')
+    ap.add_argument('--field-width', type=uint, default=40, help='Field width')
+    ap.add_argument('--games', '-n', type=uint, default=1, help='Number of games to play')
+    ap.add_argument('--max-turns', type=uint, default=500, help='Maximum number of turns in a game')
+    ap.add_argument('--num-food-items', type=uint, default=3, help='Initial number of food items')
+    ap.add_argument('--output', '-o', default=None, help='File to write the results to (default: stdout)')
+    ap.add_argument('--respawn-food', type=probability, default=None, help='Respawn food with this probability every turn (default: respawn eaten food)')
+    ap.add_argument('--seed', type=int, default=None, help='Seed of the first game, the following games get the next seeds')
+    ap.add_argument('--simultaneous-moves', action='store_true', help='Let all snakes move at the same time')
+    ap.add_argument('--snake-len', type=uint, default=5, help='Initial snake length')
+    ap.add_argument('--work-units', type=uint, default=500, help='Maximum allowed amount of game preparation work')
+    ap.add_argument('--workers', '-j', type=uint, default=multiprocessing.cpu_count(), help='Number of worker processes')
+    return ap.parse_args()
+
+
+def make_jobs(args: Namespace) -> List[BatchJob]:
+    bots = {}
+    for bot in args.bot:
+        name, sep, spec = bot.partition('=')
+        if sep == '':
+            raise ValueError(f'Invalid bot: {bot!r}, expected NAME=POLICY')
+        # Fail early rather than in every worker.
+        load_policy(spec)
+        bots[name] = spec
+
+    config = GameConfig(
+        snake_len = args.snake_len,
+        field_width = args.field_width,
+        field_height = args.field_height,
+        num_food_items = args.num_food_items,
+        respawn_food = (
+            FoodRespawnBehavior.YES()
+            if args.respawn_food is None
+            else FoodRespawnBehavior.RANDOM(args.respawn_food)
+        ),
+        max_turns = args.max_turns,
+        field_storage = args.field_storage,
+    )
+
+    return [
+        BatchJob(
+            index = i,
+            seed = None if args.seed is None else args.seed + i,
+            bots = bots,
+            config = BatchJob.pack_config(config),
+            work_units = args.work_units,
+            simultaneous_moves = args.simultaneous_moves,
+        )
+        for i in range(args.games)
+    ]
+
+
+def main() -> None:
+    args = parse_args()
+    jobs = make_jobs(args)
+    output = sys.stdout if args.output is None else open(args.output, 'w')
+    try:
+        for result in run_batch(jobs, args.workers):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
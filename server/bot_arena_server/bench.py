@@ -0,0 +1,249 @@
+"""Micro-benchmarks of the game engine and the protocol hot paths.
+
+Run `python -m bot_arena_server.bench` and compare the numbers before and
+after a change; `--json` prints the results in a machine-readable form.
+"""
+
+from bot_arena_server.field_storage import FIELD_STORAGE_KINDS
+from bot_arena_server.game import Game, Field, _generate_snake
+from bot_arena_server.game_config import GameConfig
+from bot_arena_server.work_limit import WorkLimit
+
+import copy
+import itertools
+import json
+import random
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from bot_arena_proto.data import Direction, FoodRespawnBehavior
+from bot_arena_proto.message import Message
+
+
+__all__ = [
+    'BENCHMARKS',
+    'BenchCase',
+    'BenchResult',
+    'main',
+    'run_benchmarks',
+]
+
+
+_DIRECTIONS = [Direction.UP(), Direction.DOWN(), Direction.LEFT(), Direction.RIGHT()]
+
+
+@dataclass
+class BenchCase:
+    field_side: int
+    num_snakes: int
+    snake_len: int
+    field_storage: str = 'hash'
+
+    def make_config(self) -> GameConfig:
+        return GameConfig(
+            snake_len = self.snake_len,
+            field_width = self.field_side,
+            field_height = self.field_side,
+            num_food_items = self.num_snakes,
+            respawn_food = FoodRespawnBehavior.YES(),
+            max_turns = None,
+            field_storage = self.field_storage,
+        )
+
+    def make_game(self) -> Game:
+        return Game(
+            [f'snake{i}' for i in range(self.num_snakes)],
+            self.make_config(),
+            WorkLimit(10**9),
+        )
+
+
+@dataclass
+class BenchResult:
+    name: str
+    case: BenchCase
+    ops_per_sec: float
+    # Peak memory allocated while performing a single operation.
+    peak_bytes_per_op: int
+    # Size of the encoded message, for the benchmarks that produce one.
+    encoded_bytes: Optional[int] = None
+
+    def format(self) -> str:
+        case = self.case
+        line = (
+            f'{self.name:<24} side={case.field_side:<4} snakes={case.num_snakes:<3} '
+            f'len={case.snake_len:<4} storage={case.field_storage:<5} '
+            f'{self.ops_per_sec:>12,.0f} ops/s  {self.peak_bytes_per_op:>9,} B peak'
+        )
+        if self.encoded_bytes is not None:
+            line += f'  {self.encoded_bytes:>8,} B encoded'
+        return line
+
+
+def _measure(op: Callable[[], Any], num_ops: int) -> Tuple[float, int]:
+    start = time.perf_counter()
+    for _ in range(num_ops):
+        op()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        op()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return num_ops / elapsed, peak
+
+
+def _record_moves(game: Game, num_moves: int, seed: int) -> List[Tuple[str, Direction]]:
+    """Find a sequence of moves that does not crash any snake.
+
+    The same sequence can then be replayed on a copy of the game, provided
+    that the global random generator is seeded in the same way (food respawns
+    depend on it).
+    """
+
+    rng = random.Random(seed)
+    field = game.field
+    moves = []
+    names = itertools.cycle(list(game.snake_names()))
+    while len(moves) < num_moves:
+        name = next(names)
+        head = field._snakes[name].head
+        safe = [d for d in _DIRECTIONS if field.is_cell_passable(head.shift(d))]
+        if len(safe) == 0:
+            # Trapped: end the sequence here rather than kill the snake.
+            break
+        direction = rng.choice(safe)
+        field.move_snake(name, direction)
+        moves.append((name, direction))
+    return moves
+
+
+def bench_move_snake(case: BenchCase, num_ops: int) -> BenchResult:
+    random.seed(0)
+    game = case.make_game()
+    initial_field = copy.deepcopy(game.field)
+    random.seed(1)
+    moves = _record_moves(game, num_ops + 1, seed=2)
+
+    field = copy.deepcopy(initial_field)
+    random.seed(1)
+    moves_iter = iter(moves)
+
+    def op() -> None:
+        name, direction = next(moves_iter)
+        field.move_snake(name, direction)
+
+    ops_per_sec, peak = _measure(op, len(moves) - 1)
+    return BenchResult('Field.move_snake', case, ops_per_sec, peak)
+
+
+def bench_get_state(case: BenchCase, num_ops: int) -> BenchResult:
+    field = case.make_game().field
+    snakes = list(field._snakes.values())
+
+    def op() -> None:
+        # The state is cached until the field changes; measure building
+        # it from scratch, as if every snake had moved.
+        field._invalidate_state()
+        for snake in snakes:
+            snake._state = None
+        field.get_state()
+
+    ops_per_sec, peak = _measure(op, num_ops)
+    return BenchResult('Field.get_state', case, ops_per_sec, peak)
+
+
+def bench_generate_snake(case: BenchCase, num_ops: int) -> BenchResult:
+    field = Field(snakes={}, objects=[], config=case.make_config())
+    work_limit = WorkLimit(10**9)
+
+    def op() -> None:
+        _generate_snake(field, case.snake_len, work_limit.counter())
+
+    ops_per_sec, peak = _measure(op, num_ops)
+    return BenchResult('_generate_snake', case, ops_per_sec, peak)
+
+
+def bench_to_primitive(case: BenchCase, num_ops: int) -> BenchResult:
+    state = case.make_game().field.get_state()
+    ops_per_sec, peak = _measure(state.to_primitive, num_ops)
+    return BenchResult('FieldState.to_primitive', case, ops_per_sec, peak)
+
+
+def bench_to_bytes(case: BenchCase, num_ops: int) -> BenchResult:
+    message = Message.NEW_FIELD_STATE(case.make_game().field.get_state())
+    ops_per_sec, peak = _measure(message.to_bytes, num_ops)
+    return BenchResult('Message.to_bytes', case, ops_per_sec, peak, len(message.to_bytes()))
+
+
+def bench_from_bytes(case: BenchCase, num_ops: int) -> BenchResult:
+    data = Message.NEW_FIELD_STATE(case.make_game().field.get_state()).to_bytes()
+    ops_per_sec, peak = _measure(lambda: Message.from_bytes(data), num_ops)
+    return BenchResult('Message.from_bytes', case, ops_per_sec, peak, len(data))
+
+
+BENCHMARKS: Dict[str, Callable[[BenchCase, int], BenchResult]] = {
+    'move_snake': bench_move_snake,
+    'get_state': bench_get_state,
+    'generate_snake': bench_generate_snake,
+    'to_primitive': bench_to_primitive,
+    'to_bytes': bench_to_bytes,
+    'from_bytes': bench_from_bytes,
+}
+
+
+def run_benchmarks(
+    cases: Iterable[BenchCase],
+    names: Iterable[str],
+    num_ops: int,
+) -> Iterable[BenchResult]:
+    for case in cases:
+        for name in names:
+            yield BENCHMARKS[name](case, num_ops)
+
+
+def _int_list(s: str) -> List[int]:
+    return [int(x) for x in s.split(',')]
+
+
+def parse_args() -> Namespace:
+    ap = ArgumentParser(prog='python -m bot_arena_server.bench', description='Pythons game engine benchmarks')
+    ap.add_argument('--field-sides', type=_int_list, default=[20, 100, 200], help='Comma-separated field sizes')
+    ap.add_argument('--json', action='store_true', help='Print the results as JSON lines')
+    ap.add_argument('--num-ops', '-n', type=int, default=2000, help='Number of operations per benchmark')
+    ap.add_argument('--num-snakes', type=_int_list, default=[2, 10], help='Comma-separated snake counts')
+    ap.add_argument('--only', action='append', choices=list(BENCHMARKS.keys()), help='Run only these benchmarks')
+    ap.add_argument('--snake-lens', type=_int_list, default=[5, 50], help='Comma-separated snake lengths')
+    ap.add_argument('--storage', action='append', choices=FIELD_STORAGE_KINDS, help='Field storage engines to use')
+    return ap.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    cases = [
+        BenchCase(field_side, num_snakes, snake_len, storage)
+        for field_side, num_snakes, snake_len, storage in itertools.product(
+            args.field_sides,
+            args.num_snakes,
+            args.snake_lens,
+            args.storage or ['hash'],
+        )
+        # Leave some room for the snakes to move.
+        if num_snakes * snake_len * 2 <= field_side * field_side
+    ]
+
+    for result in run_benchmarks(cases, args.only or list(BENCHMARKS.keys()), args.num_ops):
+        if args.json:
+            print(json.dumps(asdict(result)))
+        else:
+            print(result.format())
+
+
+if __name__ == '__main__':
+    main()
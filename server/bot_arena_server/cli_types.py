@@ -0,0 +1,45 @@
+import math
+from typing import Callable
+
+
+__all__ = [
+    'int_ge',
+    'probability',
+    'uint',
+    'ufloat',
+]
+
+
+def uint(s: str) -> int:
+    n = int(s)
+    if n < 0:
+        raise ValueError('Value is negative')
+    return n
+
+
+def ufloat(s: str) -> float:
+    f = float(s)
+    if f < 0:
+        raise ValueError('Value is negative')
+    if not math.isfinite(f):
+        raise ValueError('Value is NaN or infinite')
+
+    return f
+
+
+def probability(s: str) -> float:
+    p = float(s)
+    if not 0.0 <= p <= 1.0:
+        raise ValueError('Value is not between 0 and 1')
+    return p
+
+
+def int_ge(limit: int) -> Callable[[str], int]:
+    def inner(s: str) -> int:
+        n = int(s)
+        if n < limit:
+            raise ValueError(f'value is less than {limit}')
+        return n
+
+    inner.__name__ = f'int ≥ {limit}'
+    return inner
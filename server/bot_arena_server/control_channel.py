@@ -0,0 +1,83 @@
+import array
+import socket
+from typing import Any, Dict, List, Optional, Tuple
+
+import cbor2
+import curio # type: ignore
+
+
+__all__ = [
+    'ControlChannel',
+]
+
+
+# Enough for a few descriptors arriving with a single read.
+_ANCILLARY_BUFFER_SIZE = socket.CMSG_SPACE(16 * array.array('i').itemsize)
+_RECV_CHUNK_SIZE = 2**16
+
+
+class ControlChannel:
+    """Exchanges messages, optionally carrying a file descriptor, over a Unix socket.
+
+    A message is a dict that can be encoded with CBOR. It is sent together with its
+    length, and the file descriptor (if any) is sent along with its first byte
+    (`SCM_RIGHTS`). The receiving process gets a new descriptor for the same open file,
+    so the sender may close its own descriptor after `send` returns.
+
+    Several tasks may send at the same time, but only one of them may receive.
+    """
+
+    def __init__(self, sock: curio.io.Socket) -> None:
+        self._sock = sock
+        self._send_lock = curio.Lock()
+        self._recv_buf = bytearray()
+        self._recv_fds: List[int] = []
+
+    async def send(self, message: Dict[str, Any], fd: Optional[int] = None) -> None:
+        payload = cbor2.dumps({'message': message, 'has_fd': fd is not None})
+        data = len(payload).to_bytes(8, 'little', signed=False) + payload
+        async with self._send_lock:
+            if fd is None:
+                await self._sock.sendall(data)
+            else:
+                ancillary_data = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))]
+                sent = await self._sock.sendmsg([data], ancillary_data)
+                await self._sock.sendall(data[sent:])
+
+    async def recv(self) -> Tuple[Dict[str, Any], Optional[int]]:
+        """Receive a message and the file descriptor sent with it.
+
+        Raises EOFError when the other end has closed the channel.
+        """
+
+        await self._fill_recv_buf(8)
+        length = int.from_bytes(self._recv_buf[:8], 'little', signed=False)
+        await self._fill_recv_buf(8 + length)
+        envelope = cbor2.loads(bytes(self._recv_buf[8 : 8 + length]))
+        del self._recv_buf[: 8 + length]
+
+        # Descriptors arrive in the same order as the messages carrying them.
+        fd = self._recv_fds.pop(0) if envelope['has_fd'] else None
+        return envelope['message'], fd
+
+    async def close(self) -> None:
+        for fd in self._recv_fds:
+            socket.close(fd)
+        self._recv_fds.clear()
+        await self._sock.close()
+
+    async def _fill_recv_buf(self, how_many: int) -> None:
+        while len(self._recv_buf) < how_many:
+            try:
+                data, ancillary_data, _, _ = await self._sock.recvmsg(_RECV_CHUNK_SIZE, _ANCILLARY_BUFFER_SIZE)
+            except ConnectionResetError:
+                # The other end has exited without reading everything.
+                raise EOFError('The control channel has been closed')
+            for level, kind, fd_data in ancillary_data:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds = array.array('i')
+                    fds.frombytes(fd_data[: len(fd_data) - len(fd_data) % fds.itemsize])
+                    self._recv_fds.extend(fds)
+            if len(data) == 0:
+                raise EOFError('The control channel has been closed')
+            self._recv_buf += data
@@ -0,0 +1,242 @@
+import random
+from array import array
+from typing import Any, Dict, Optional, Protocol, Sequence, Set
+
+from bot_arena_proto.data import Object, Point
+
+
+__all__ = [
+    'FIELD_STORAGE_KINDS',
+    'FieldStorage',
+    'FreeCellIndex',
+    'GLOBAL_RANDOM',
+    'GridFieldStorage',
+    'HashFieldStorage',
+    'make_field_storage',
+    'RandomSource',
+]
+
+
+FIELD_STORAGE_KINDS = ('hash', 'grid')
+
+
+class RandomSource(Protocol):
+    """A random number generator, such as `random.Random`."""
+
+    def random(self) -> float: ...
+
+    def randrange(self, stop: int) -> int: ...
+
+    def choice(self, seq: Sequence[Any]) -> Any: ...
+
+
+class _GlobalRandomSource:
+    """The global generator of the `random` module, shared even by deep copies."""
+
+    def random(self) -> float:
+        return random.random()
+
+    def randrange(self, stop: int) -> int:
+        return random.randrange(stop)
+
+    def choice(self, seq: Sequence[Any]) -> Any:
+        return random.choice(seq)
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> '_GlobalRandomSource':
+        return self
+
+
+GLOBAL_RANDOM: RandomSource = _GlobalRandomSource()
+
+
+class FieldStorage(Protocol):
+    """Storage engine keeping track of what is located in each cell of the game field.
+
+    A cell may be occupied by a snake and/or contain an object. The engine does not
+    check whether cells are within the field, this is up to the caller.
+    """
+
+    # Positions of all objects on the field, in the order of their placement.
+    objects: Dict[Point, Object]
+
+    def occupy(self, cell: Point) -> None:
+        """Mark the cell as occupied by a snake."""
+        ...
+
+    def release(self, cell: Point) -> None:
+        """Mark the cell as no longer occupied by a snake."""
+        ...
+
+    def is_occupied(self, cell: Point) -> bool:
+        """Check whether the cell is occupied by a snake."""
+        ...
+
+    def num_occupied(self) -> int:
+        """Count the cells occupied by snakes."""
+        ...
+
+    def put_object(self, cell: Point, obj: Object) -> None:
+        """Place an object into the cell."""
+        ...
+
+    def pop_object(self, cell: Point) -> Object:
+        """Remove the object from the cell and return it."""
+        ...
+
+    def get_object(self, cell: Point) -> Optional[Object]:
+        """Return the object in the cell, if any."""
+        ...
+
+    def is_completely_free(self, cell: Point) -> bool:
+        """Check whether the cell is neither occupied by a snake nor contains an object."""
+        ...
+
+
+class HashFieldStorage:
+    """Storage engine based on a set of occupied cells and a dict of objects.
+
+    Memory usage is proportional to the number of non-empty cells, but each
+    lookup hashes a Point.
+    """
+
+    def __init__(self) -> None:
+        self.objects: Dict[Point, Object] = {}
+        self._occupied_cells: Set[Point] = set()
+
+    def occupy(self, cell: Point) -> None:
+        self._occupied_cells.add(cell)
+
+    def release(self, cell: Point) -> None:
+        self._occupied_cells.remove(cell)
+
+    def is_occupied(self, cell: Point) -> bool:
+        return cell in self._occupied_cells
+
+    def num_occupied(self) -> int:
+        return len(self._occupied_cells)
+
+    def put_object(self, cell: Point, obj: Object) -> None:
+        self.objects[cell] = obj
+
+    def pop_object(self, cell: Point) -> Object:
+        return self.objects.pop(cell)
+
+    def get_object(self, cell: Point) -> Optional[Object]:
+        return self.objects.get(cell)
+
+    def is_completely_free(self, cell: Point) -> bool:
+        return (cell not in self._occupied_cells) and (cell not in self.objects)
+
+
+# Bit flags stored in each cell of GridFieldStorage.
+_SNAKE = 1
+_OBJECT = 2
+
+
+class GridFieldStorage:
+    """Storage engine based on a flat array of cell kinds indexed by `y * width + x`.
+
+    Checking a cell is a single array lookup, which neither hashes nor allocates
+    anything. The dict of objects is still kept to list and retrieve them, but it
+    is only consulted for cells that are known to contain an object.
+    """
+
+    def __init__(self, width: int, height: int) -> None:
+        self.objects: Dict[Point, Object] = {}
+        self._width = width
+        self._cells = bytearray(width * height)
+        self._num_occupied = 0
+
+    def _index(self, cell: Point) -> int:
+        return cell.y * self._width + cell.x
+
+    def occupy(self, cell: Point) -> None:
+        i = self._index(cell)
+        if not self._cells[i] & _SNAKE:
+            self._cells[i] |= _SNAKE
+            self._num_occupied += 1
+
+    def release(self, cell: Point) -> None:
+        i = self._index(cell)
+        if not self._cells[i] & _SNAKE:
+            raise KeyError(cell)
+        self._cells[i] &= ~_SNAKE
+        self._num_occupied -= 1
+
+    def is_occupied(self, cell: Point) -> bool:
+        return bool(self._cells[self._index(cell)] & _SNAKE)
+
+    def num_occupied(self) -> int:
+        return self._num_occupied
+
+    def put_object(self, cell: Point, obj: Object) -> None:
+        self._cells[self._index(cell)] |= _OBJECT
+        self.objects[cell] = obj
+
+    def pop_object(self, cell: Point) -> Object:
+        obj = self.objects.pop(cell)
+        self._cells[self._index(cell)] &= ~_OBJECT
+        return obj
+
+    def get_object(self, cell: Point) -> Optional[Object]:
+        if self._cells[self._index(cell)] & _OBJECT:
+            return self.objects[cell]
+        return None
+
+    def is_completely_free(self, cell: Point) -> bool:
+        return self._cells[self._index(cell)] == 0
+
+
+class FreeCellIndex:
+    """An indexable set of free cells supporting O(1) insertion, removal and uniform sampling.
+
+    Cells are identified by `y * width + x`. The identifiers of free cells are
+    kept in a dense array (removal swaps the removed element with the last one),
+    and a second array maps each cell to its position in the first one (or -1).
+    """
+
+    def __init__(self, width: int, height: int, rng: RandomSource = GLOBAL_RANDOM) -> None:
+        self._width = width
+        self._rng = rng
+        self._free = array('l', range(width * height))
+        self._positions = array('l', range(width * height))
+
+    def __len__(self) -> int:
+        return len(self._free)
+
+    def __contains__(self, cell: Point) -> bool:
+        return self._positions[cell.y * self._width + cell.x] >= 0
+
+    def add(self, cell: Point) -> None:
+        i = cell.y * self._width + cell.x
+        if self._positions[i] >= 0:
+            return
+        self._positions[i] = len(self._free)
+        self._free.append(i)
+
+    def discard(self, cell: Point) -> None:
+        i = cell.y * self._width + cell.x
+        position = self._positions[i]
+        if position < 0:
+            return
+        last = self._free.pop()
+        if last != i:
+            self._free[position] = last
+            self._positions[last] = position
+        self._positions[i] = -1
+
+    def sample(self) -> Optional[Point]:
+        """Return a uniformly chosen free cell, or None if there are none."""
+
+        if len(self._free) == 0:
+            return None
+        i = self._free[self._rng.randrange(len(self._free))]
+        return Point.interned(i % self._width, i // self._width)
+
+
+def make_field_storage(kind: str, width: int, height: int) -> FieldStorage:
+    if kind == 'hash':
+        return HashFieldStorage()
+    if kind == 'grid':
+        return GridFieldStorage(width, height)
+    raise ValueError(f'Unknown field storage kind: {kind!r}')
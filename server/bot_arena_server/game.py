@@ -1,24 +1,27 @@
+from bot_arena_server.field_storage import GLOBAL_RANDOM, FreeCellIndex, RandomSource, make_field_storage
 from bot_arena_server.game_config import GameConfig
 from bot_arena_server.work_limit import WorkLimit, WorkLimitCounter
 
-import random
 from collections import deque
 from copy import copy
 from dataclasses import dataclass
 from typing import List, Callable, Tuple, Dict, Set, Generator, Optional, Iterable, Deque
 
 from adt import adt, Case
-from bot_arena_proto.data import SnakeState, Direction, Point, Object, FieldState, Action
+from bot_arena_proto.data import SnakeState, SnakeDelta, Direction, Point, Object, FieldState, FieldDelta, Action
+from bot_arena_proto.message import Message
 from bot_arena_proto.session import GameInfo
 
 
 __all__ = [
     'Field',
+    'FieldSnapshot',
     'Game',
     'GameScore',
     'IllegalAction',
     'InvalidMoveError',
     'MoveResult',
+    'NoFreeCellsError',
     'NoSuchSnakeError',
 ]
 
@@ -58,6 +61,35 @@ class ChangeInFreeCells:
         return copy(self._new_occupied)
 
 
+class SnakeStep:
+    """A change in free cells caused by a single step of a snake.
+
+    A step always occupies exactly one cell (the new head) and frees at most
+    one cell (the former end of the tail), so, unlike ChangeInFreeCells, there
+    is no need to build any sets here.
+    """
+
+    __slots__ = ('new_occupied', 'new_free')
+
+    def __init__(self, new_occupied: Point, new_free: Optional[Point] = None) -> None:
+        self.new_occupied = new_occupied
+        self.new_free = new_free
+
+    def _normalized(self) -> Tuple[Optional[Point], Optional[Point]]:
+        if self.new_free == self.new_occupied:
+            # The snake has moved into the cell just freed by its own tail.
+            return None, None
+        return self.new_occupied, self.new_free
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, SnakeStep):
+            return NotImplemented
+        return self._normalized() == other._normalized()
+
+    def __repr__(self) -> str:
+        return f'SnakeStep(new_occupied={self.new_occupied!r}, new_free={self.new_free!r})'
+
+
 class IllegalAction(Exception):
     pass
 
@@ -75,6 +107,11 @@ class NoSuchSnakeError(IllegalAction):
         return f'No such snake: {self._snake_name!r}'
 
 
+class NoFreeCellsError(Exception):
+    def __str__(self) -> str:
+        return 'There are no free cells left on the field'
+
+
 @adt
 class MoveResult:
     OK: Case
@@ -101,14 +138,14 @@ def _try_generate_snake(
         work_limit_counter.do_work()
         next_cell_candidates = []
         for dx, dy in [(1, 0), (0, 1), (-1, 0), (0, -1)]:
-            candidate = Point(head.x + dx, head.y + dy)
+            candidate = Point.interned(head.x + dx, head.y + dy)
             if field.is_cell_completely_free(candidate) and candidate not in snake_cells:
                 next_cell_candidates.append(candidate)
 
         if len(next_cell_candidates) == 0:
             return None
 
-        next_cell = random.choice(next_cell_candidates)
+        next_cell = field.rng.choice(next_cell_candidates)
         tail.append(head)
         head = next_cell
         snake_cells.add(next_cell)
@@ -120,13 +157,22 @@ def _try_generate_snake(
 
 
 class Game:
-    def __init__(self, snake_names: List[str], config: GameConfig, work_limit: WorkLimit) -> None:
+    def __init__(
+        self,
+        snake_names: List[str],
+        config: GameConfig,
+        work_limit: WorkLimit,
+        rng: RandomSource = GLOBAL_RANDOM,
+    ) -> None:
+        # With a dedicated seeded `random.Random`, the game is reproducible:
+        # the same actions always lead to the same field.
         self._config = config
         self._turns_counter = 0
         self._field = Field(
             config = config,
             snakes = {},
             objects = [],
+            rng = rng,
         )
 
         for name in snake_names:
@@ -137,9 +183,20 @@ class Game:
         for i in range(self._config.num_food_items):
             self._field.place_object_randomly(Object.FOOD())
 
+        # The initial state is sent to clients in full, so its changes are not needed.
+        self._field.take_delta()
+
     def finish_turn(self) -> None:
         self._turns_counter += 1
 
+    @property
+    def turns_played(self) -> int:
+        return self._turns_counter
+
+    @property
+    def config(self) -> GameConfig:
+        return self._config
+
     def get_score(self) -> 'GameScore':
         return self._field.get_score()
 
@@ -152,6 +209,18 @@ class Game:
             move = lambda direction: self.field.move_snake(name, direction),
         ) # type: ignore
 
+    def take_simultaneous_turn(self, actions: Dict[str, Action]) -> Dict[str, MoveResult]:
+        """Perform the actions of several snakes at once.
+
+        See `Field.move_snakes_simultaneously` for how conflicts are resolved.
+        """
+
+        moves: Dict[str, Direction] = {
+            name: action.match(move = lambda direction: direction) # type: ignore
+            for name, action in actions.items()
+        }
+        return self.field.move_snakes_simultaneously(moves)
+
     def info(self) -> GameInfo:
         return GameInfo(field_width=self._field.width, field_height=self._field.height)
 
@@ -205,15 +274,32 @@ class Field:
         snakes: Dict[str, '_Snake'],
         objects: List[Tuple[Point, Object]],
         config: GameConfig,
+        rng: RandomSource = GLOBAL_RANDOM,
     ) -> None:
         self._config = config
         self._snakes = snakes
-        self._objects: Dict[Point, Object] = dict(objects)
-        self._occupied_cells: Set[Point] = set()
+        self._rng = rng
+        self._storage = make_field_storage(config.field_storage, config.field_width, config.field_height)
+        self._free_cells = FreeCellIndex(config.field_width, config.field_height, rng)
         self._game_score = GameScore.from_snake_names(self._snakes.keys())
         self._lost_objects: Deque[Object] = deque()
+        self._delta_recorder = _FieldDeltaRecorder()
+        self._version = 0
+        self._snapshot: Optional[FieldSnapshot] = None
+        for point, obj in objects:
+            self._place_object_at(obj, point)
         for snake in snakes.values():
-            self._occupied_cells.update(snake.list_occupied_cells())
+            for cell in snake.list_occupied_cells():
+                self._storage.occupy(cell)
+                self._free_cells.discard(cell)
+
+    @property
+    def _objects(self) -> Dict[Point, Object]:
+        return self._storage.objects
+
+    @property
+    def rng(self) -> RandomSource:
+        return self._rng
 
     def get_score(self) -> GameScore:
         for name, snake in self._snakes.items():
@@ -221,16 +307,15 @@ class Field:
         return self._game_score.copy()
 
     def random_free_cell(self) -> Point:
-        while True:
-            cell = self._try_random_free_cell()
-            if cell is not None:
-                return cell
+        """Return a uniformly chosen completely free cell.
 
-    def _try_random_free_cell(self) -> Optional[Point]:
-        x = random.randrange(0, self.width)
-        y = random.randrange(0, self.height)
-        point = Point(x, y)
-        return point if self.is_cell_completely_free(point) else None
+        Complexity: O(1). Raises NoFreeCellsError if the field is full.
+        """
+
+        cell = self._free_cells.sample()
+        if cell is None:
+            raise NoFreeCellsError()
+        return cell
 
     def count_alive_players(self) -> int:
         return len(self._snakes)
@@ -239,17 +324,20 @@ class Field:
         if name not in self._snakes:
             raise NoSuchSnakeError(name)
 
+        self._invalidate_state()
         snake = self._snakes[name]
         self._update_occupied_cells(
             ChangeInFreeCells(new_free=snake.list_occupied_cells(), new_occupied=[])
         )
 
         self._snakes.pop(name)
+        self._delta_recorder.kill(name)
 
     def move_snake(self, name: str, direction: Direction) -> MoveResult:
         if name not in self._snakes:
             raise NoSuchSnakeError(name)
 
+        self._invalidate_state()
         snake = self._snakes[name]
 
         destination = snake.head.shift(direction)
@@ -262,26 +350,126 @@ class Field:
                 )
                 # Delete it from the world.
                 self._snakes.pop(name)
+                self._delta_recorder.kill(name)
                 # Report the death.
                 return MoveResult.CRASH()
 
-            if destination in self._objects:
-                obj = self._objects[destination]
+            obj = self._storage.get_object(destination)
+            if obj is not None:
                 return obj.match(
-                    food = lambda: self._consume_food(snake, direction)
+                    food = lambda: self._consume_food(name, snake, direction)
                 ) # type: ignore
 
-            change_in_free_cells = snake.move(direction)
-            self._update_occupied_cells(change_in_free_cells)
+            self._apply_snake_step(snake.move(direction))
+            self._delta_recorder.advance(name, direction, pop_tail=True)
 
         finally:
             self._do_object_placement_step()
 
         return MoveResult.OK()
 
-    def _consume_food(self, snake: '_Snake', direction: Direction) -> MoveResult:
-        self._update_occupied_cells(snake.grow(direction))
-        self._objects.pop(snake.head)
+    def move_snakes_simultaneously(self, moves: Dict[str, Direction]) -> Dict[str, MoveResult]:
+        """Move several snakes as if all of them moved at the same time.
+
+        A snake crashes if its head ends up outside the field or on the body of
+        any snake after the move (a tail that moves away this turn does not count).
+        When several heads enter the same cell, the strictly longest snake survives
+        and the others crash; if there is a tie, all of them crash. Two snakes
+        swapping cells both crash, whatever their lengths. Snakes that are
+        not mentioned in `moves` stay in place.
+        """
+
+        for name in moves:
+            if name not in self._snakes:
+                raise NoSuchSnakeError(name)
+
+        self._invalidate_state()
+        destinations = {name: self._snakes[name].head.shift(d) for name, d in moves.items()}
+        growing = {
+            name
+            for name, destination in destinations.items()
+            if destination in self and self._storage.get_object(destination) is not None
+        }
+        vacated = {self._snakes[name].tail_end for name in moves if name not in growing}
+
+        crashed: Set[str] = set()
+        contenders: Dict[Point, List[str]] = {}
+        for name, destination in destinations.items():
+            if destination not in self or (self._storage.is_occupied(destination) and destination not in vacated):
+                crashed.add(name)
+            contenders.setdefault(destination, []).append(name)
+
+        # Snakes of length 1 vacate their heads, so two of them swapping cells
+        # would otherwise pass through each other.
+        movers_by_head = {self._snakes[name].head: name for name in moves}
+        for name, destination in destinations.items():
+            other = movers_by_head.get(destination)
+            if other is not None and other != name and destinations[other] == self._snakes[name].head:
+                crashed.add(name)
+
+        for names in contenders.values():
+            if len(names) < 2:
+                continue
+            lengths = sorted((self._snakes[name].length for name in names), reverse=True)
+            for name in names:
+                if lengths[0] == lengths[1] or self._snakes[name].length < lengths[0]:
+                    crashed.add(name)
+
+        # Sets are iterated in the order of `moves`: the order of the cells freed
+        # and of the food placed must not depend on string hashing, so that a game
+        # can be replayed.
+        for name in moves:
+            if name in crashed:
+                self.kill_snake(name)
+
+        # All the cells are released before any is occupied, since a snake
+        # may move into a cell freed by another one's tail.
+        steps = []
+        for name, direction in moves.items():
+            if name in crashed:
+                continue
+            snake = self._snakes[name]
+            if name in growing:
+                steps.append(snake.grow(direction))
+            else:
+                steps.append(snake.move(direction))
+            self._delta_recorder.advance(name, direction, pop_tail=name not in growing)
+
+        for step in steps:
+            if step.new_free is not None:
+                self._storage.release(step.new_free)
+        for step in steps:
+            self._storage.occupy(step.new_occupied)
+            self._free_cells.discard(step.new_occupied)
+        for step in steps:
+            if step.new_free is not None:
+                self._sync_free_cell(step.new_free)
+
+        for name in moves:
+            if name not in growing or name in crashed:
+                continue
+            snake = self._snakes[name]
+            self._storage.pop_object(snake.head)
+            self._delta_recorder.remove_object(snake.head)
+            self._sync_free_cell(snake.head)
+            snake.change_score_by(1)
+            self._maybe_respawn_food_item()
+
+        # Keep the rate of object placement the same as when moving one by one.
+        for _ in moves:
+            self._do_object_placement_step()
+
+        return {
+            name: MoveResult.CRASH() if name in crashed else MoveResult.OK()
+            for name in moves
+        }
+
+    def _consume_food(self, name: str, snake: '_Snake', direction: Direction) -> MoveResult:
+        self._apply_snake_step(snake.grow(direction))
+        self._delta_recorder.advance(name, direction, pop_tail=False)
+        self._storage.pop_object(snake.head)
+        self._delta_recorder.remove_object(snake.head)
+        self._sync_free_cell(snake.head)
         snake.change_score_by(1)
 
         self._maybe_respawn_food_item()
@@ -297,25 +485,76 @@ class Field:
 
     def _update_occupied_cells(self, change_in_free_cells: ChangeInFreeCells) -> None:
         for cell in change_in_free_cells.new_occupied():
-            self._occupied_cells.add(cell)
+            self._storage.occupy(cell)
+            self._free_cells.discard(cell)
 
         for cell in change_in_free_cells.new_free():
-            self._occupied_cells.remove(cell)
+            self._storage.release(cell)
+            self._sync_free_cell(cell)
+
+    def _apply_snake_step(self, step: SnakeStep) -> None:
+        # The order matters: a snake may move into the cell freed by its own tail.
+        if step.new_free is not None:
+            self._storage.release(step.new_free)
+            self._sync_free_cell(step.new_free)
+        self._storage.occupy(step.new_occupied)
+        self._free_cells.discard(step.new_occupied)
+
+    def _sync_free_cell(self, cell: Point) -> None:
+        if self._storage.is_completely_free(cell):
+            self._free_cells.add(cell)
+        else:
+            self._free_cells.discard(cell)
 
     def is_cell_passable(self, cell: Point) -> bool:
         if cell not in self:
             return False
 
-        return cell not in self._occupied_cells
+        return not self._storage.is_occupied(cell)
 
     def __contains__(self, cell: Point) -> bool:
         return 0 <= cell.x < self.width and 0 <= cell.y < self.height
 
+    @property
+    def version(self) -> int:
+        """A number that changes every time the field changes."""
+
+        return self._version
+
+    def _invalidate_state(self) -> None:
+        self._version += 1
+        self._snapshot = None
+
+    def snapshot(self) -> 'FieldSnapshot':
+        """Return the current state of the field, reusing it until the field changes.
+
+        Only the snakes that have moved since the previous snapshot are
+        converted to SnakeStates again.
+        """
+
+        if self._snapshot is None:
+            self._snapshot = FieldSnapshot(
+                version = self._version,
+                state = FieldState(
+                    snakes = {name: snake.get_state() for name, snake in self._snakes.items()},
+                    objects = list(self._objects.items()),
+                ),
+            )
+        return self._snapshot
+
     def get_state(self) -> FieldState:
-        return FieldState(
-            snakes = {name: snake.get_state() for name, snake in self._snakes.items()},
-            objects = list(self._objects.items()),
-        )
+        """Return the current state of the field.
+
+        The state is shared with the other callers until the field changes,
+        so it must not be modified.
+        """
+
+        return self.snapshot().state
+
+    def take_delta(self) -> FieldDelta:
+        """Return the changes made to the field since the previous call to this method."""
+
+        return self._delta_recorder.take()
 
     @property
     def width(self) -> int:
@@ -326,26 +565,20 @@ class Field:
         return self._config.field_height
 
     def place_object_randomly(self, obj: Object) -> None:
-        for _ in range(self._random_cell_num_attempts):
-            if self.try_place_object_randomly(obj):
-                return
-
-        # Otherwise
-        self._lost_objects.append(obj)
+        if not self.try_place_object_randomly(obj):
+            # The field is full, try again later.
+            self._lost_objects.append(obj)
 
     def try_place_object_randomly(self, obj: Object) -> bool:
-        x = random.randrange(0, self.width)
-        y = random.randrange(0, self.height)
-        point = Point(x, y)
-        if self.is_cell_completely_free(point):
-            self._place_object_at(obj, point)
-            return True
-        else:
+        point = self._free_cells.sample()
+        if point is None:
             return False
+        self._place_object_at(obj, point)
+        return True
 
     def _do_object_placement_step(self) -> None:
         self._config.respawn_food.match(
-            yes = lambda: self._do_lost_object_placement_step,
+            yes = self._do_lost_object_placement_step,
             no = lambda: None,
             random = self._do_probability_object_placement_step,
         ) # type: ignore
@@ -361,7 +594,7 @@ class Field:
         return self.width * self.height
 
     def num_occupied_cells(self) -> int:
-        return len(self._occupied_cells)
+        return self._storage.num_occupied()
 
     def num_passable_cells(self) -> int:
         return self.num_cells() - self.num_occupied_cells()
@@ -370,27 +603,104 @@ class Field:
         return self.num_passable_cells() - len(self._objects)
 
     def _do_probability_object_placement_step(self, probability: float) -> None:
-        random_value = random.random()
+        random_value = self._rng.random()
         if random_value >= probability:
             return
 
         self.place_object_randomly(Object.FOOD())
 
     def is_cell_completely_free(self, cell: Point) -> bool:
-        return (cell in self) and (cell not in self._occupied_cells) and (cell not in self._objects)
+        return (cell in self) and self._storage.is_completely_free(cell)
 
     def _place_object_at(self, obj: Object, point: Point) -> None:
-        self._objects[point] = obj
+        self._invalidate_state()
+        self._storage.put_object(point, obj)
+        self._free_cells.discard(point)
+        self._delta_recorder.add_object(point, obj)
 
     def add_snake(self, snake_name: str, snake: '_Snake') -> None:
         if snake_name in self._snakes:
             raise KeyError(f'Snake {snake_name!r} is already present on the game field')
+        self._invalidate_state()
         self._snakes[snake_name] = snake
         self._update_occupied_cells(
             ChangeInFreeCells(new_free=[], new_occupied=snake.list_occupied_cells())
         )
 
-    _random_cell_num_attempts = 5
+
+class FieldSnapshot:
+    """The state of a field at a certain version, along with its encodings.
+
+    The snapshot is shared by everyone who asks the field for its state
+    until the field changes, so neither the state nor the encodings must be
+    modified.
+    """
+
+    def __init__(self, version: int, state: FieldState) -> None:
+        self.version = version
+        self.state = state
+        self._encoded: Dict[bool, bytes] = {}
+
+    def is_encoded(self, compact: bool = False) -> bool:
+        return compact in self._encoded
+
+    def encode(self, compact: bool = False) -> bytes:
+        """Return the state encoded as a NEW_FIELD_STATE message (NEW_COMPACT_FIELD_STATE if `compact` is set)."""
+
+        encoded = self._encoded.get(compact)
+        if encoded is None:
+            if compact:
+                encoded = Message.NEW_COMPACT_FIELD_STATE(self.state).to_bytes()
+            else:
+                encoded = Message.NEW_FIELD_STATE(self.state).to_bytes()
+            self._encoded[compact] = encoded
+        return encoded
+
+
+class _FieldDeltaRecorder:
+    """Accumulates the changes made to a field until they are taken as a FieldDelta."""
+
+    def __init__(self) -> None:
+        self._reset()
+
+    def _reset(self) -> None:
+        self._snakes: Dict[str, SnakeDelta] = {}
+        self._dead_snakes: List[str] = []
+        self._new_objects: Dict[Point, Object] = {}
+        self._removed_objects: List[Point] = []
+
+    def advance(self, name: str, direction: Direction, pop_tail: bool) -> None:
+        snake_delta = self._snakes.get(name)
+        if snake_delta is None:
+            snake_delta = SnakeDelta(advances=[], tail_pops=0)
+            self._snakes[name] = snake_delta
+        snake_delta.advances.append(direction)
+        if pop_tail:
+            snake_delta.tail_pops += 1
+
+    def kill(self, name: str) -> None:
+        self._snakes.pop(name, None)
+        self._dead_snakes.append(name)
+
+    def add_object(self, point: Point, obj: Object) -> None:
+        self._new_objects[point] = obj
+
+    def remove_object(self, point: Point) -> None:
+        if point in self._new_objects:
+            # Clients have never seen this object.
+            del self._new_objects[point]
+        else:
+            self._removed_objects.append(point)
+
+    def take(self) -> FieldDelta:
+        delta = FieldDelta(
+            snakes = self._snakes,
+            dead_snakes = self._dead_snakes,
+            new_objects = list(self._new_objects.items()),
+            removed_objects = self._removed_objects,
+        )
+        self._reset()
+        return delta
 
 
 def _directions_to_points(head: Point, tail: List[Direction]) -> List[Point]:
@@ -402,33 +712,36 @@ def _directions_to_points(head: Point, tail: List[Direction]) -> List[Point]:
     return result
 
 
-def _points_to_directions(head: Point, tail: List[Point]) -> List[Direction]:
-    def inner() -> Generator[Direction, None, None]:
-        last_point = head
-        for point in tail:
-            dx = point.x - last_point.x
-            dy = point.y - last_point.y
-
-            if dx == 1 and dy == 0:
-                yield Direction.RIGHT()
-            elif dx == -1 and dy == 0:
-                yield Direction.LEFT()
-            elif dx == 0 and dy == 1:
-                yield Direction.UP()
-            elif dx == 0 and dy == -1:
-                yield Direction.DOWN()
-            else:
-                raise ValueError(f'Invalid tail: {tail!r}')
+_DIRECTIONS_BY_OFFSET = {
+    (1, 0): Direction.RIGHT(),
+    (-1, 0): Direction.LEFT(),
+    (0, 1): Direction.UP(),
+    (0, -1): Direction.DOWN(),
+}
 
-            last_point = point
 
-    return list(inner())
+def _points_to_directions(head: Point, tail: Iterable[Point]) -> List[Direction]:
+    result: List[Direction] = []
+    last_point = head
+    for point in tail:
+        direction = _DIRECTIONS_BY_OFFSET.get((point.x - last_point.x, point.y - last_point.y))
+        if direction is None:
+            raise ValueError(f'Invalid tail: {tail!r}')
+        result.append(direction)
+        last_point = point
+    return result
 
 
 class _Snake:
     def __init__(self, head: Point, tail: List[Direction]) -> None:
         self._head = head
-        self._tail = _directions_to_points(head, tail)
+        # The tail is stored from the segment next to the head to the very end,
+        # so that both growing and moving only touch the ends of the deque.
+        self._tail: Deque[Point] = deque(_directions_to_points(head, tail))
+        # The same tail as directions, kept up to date along with `_tail`,
+        # so that building a SnakeState does not need to compute them.
+        self._tail_directions: Deque[Direction] = deque(tail)
+        self._state: Optional[SnakeState] = None
         self._score = 0
 
     @property
@@ -439,51 +752,68 @@ class _Snake:
         self._score += score_delta
 
     @staticmethod
-    def from_raw_parts(head: Point, tail: List[Point]) -> '_Snake':
+    def from_raw_parts(head: Point, tail: Iterable[Point]) -> '_Snake':
         snake = _Snake(head, [])
-        snake._tail = tail
+        snake._tail = deque(tail)
+        snake._tail_directions = deque(_points_to_directions(head, snake._tail))
         return snake
 
     def get_state(self) -> SnakeState:
-        return SnakeState(
-            head = copy(self._head),
-            tail = _points_to_directions(self._head, self._tail),
-        )
+        """Return the state of the snake.
+
+        The state is reused until the snake moves, so it must not be modified.
+        """
 
-    def move(self, direction: Direction) -> ChangeInFreeCells:
+        if self._state is None:
+            self._state = SnakeState(head=self._head, tail=list(self._tail_directions))
+        return self._state
+
+    def move(self, direction: Direction) -> SnakeStep:
         """Move snake in the specified direction.
 
         The legality of such a movement is not checked.
 
-        Complexity: O(length). Might be improved in the future if deemed
-        reasonable.
+        Complexity: O(1).
         """
 
         # Moving differs from growing only by not keeping the last segment
         # of the tail.
-        change_in_free_cells = self.grow(direction)
-        popped_cell = self._tail.pop()
-        change_in_free_cells.add_new_free(popped_cell)
-        return change_in_free_cells
+        step = self.grow(direction)
+        step.new_free = self._tail.pop()
+        self._tail_directions.pop()
+        return step
 
-    def grow(self, direction: Direction) -> ChangeInFreeCells:
+    def grow(self, direction: Direction) -> SnakeStep:
         """Grow the snake in the specified direction.
 
         Whether the snake can actually grow in this direction is not checked.
 
-        Complexity: O(length). Might be improved in the future if deemed
-        reasonable.
+        Complexity: O(1).
         """
 
         old_head = self._head
         self._head = self._head.shift(direction)
-        self._tail.insert(0, old_head)
-        return ChangeInFreeCells(new_occupied=[self._head], new_free=[])
+        self._tail.appendleft(old_head)
+        self._tail_directions.appendleft(direction.opposite())
+        self._state = None
+        return SnakeStep(new_occupied=self._head)
 
     def list_occupied_cells(self) -> Generator[Point, None, None]:
         yield self._head
         yield from self._tail
 
+    @property
+    def length(self) -> int:
+        return len(self._tail) + 1
+
+    @property
+    def tail_end(self) -> Point:
+        """The cell that the snake leaves when it moves without growing."""
+
+        if len(self._tail) == 0:
+            return self._head
+        return self._tail[-1]
+
     @property
     def head(self) -> Point:
         return self._head
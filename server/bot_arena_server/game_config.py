@@ -12,3 +12,5 @@ class GameConfig:
     num_food_items: int
     respawn_food: FoodRespawnBehavior
     max_turns: Optional[int]
+    # One of `field_storage.FIELD_STORAGE_KINDS`.
+    field_storage: str = 'hash'
@@ -1,15 +1,23 @@
+from bot_arena_server import metrics
 from bot_arena_server.client_name import RichClientInfo
 from bot_arena_server.control_flow import EnsureDisconnect
 from bot_arena_server.coroutine_utils import select
 from bot_arena_server.game import Game, IllegalAction
-from bot_arena_server.game_room import GameRoom, GameRoomExit
+from bot_arena_server.game_room import FieldUpdate, GameRoom, GameRoomExit, encode_snapshot
 
 from dataclasses import dataclass
-from typing import NoReturn
+from time import perf_counter
+from typing import NoReturn, Optional
 
 import curio # type: ignore
 from bot_arena_proto.event import Event
-from bot_arena_proto.session import ServerSession, GameInfo, ClientInfo
+from bot_arena_proto.session import (
+    ServerSession,
+    GameInfo,
+    ClientInfo,
+    CAPABILITY_COMPACT_FIELD_STATE,
+    CAPABILITY_FIELD_DELTAS,
+)
 from loguru import logger # type: ignore
 
 
@@ -37,11 +45,22 @@ class GameLoop:
 
     async def run(self) -> None:
         try:
-            self.game_room.set_session(self.client_info.name, self.sess)
+            # The initial state must be taken at the moment the session is added,
+            # since all the subsequent field updates are based on it.
+            # The snapshot (and its encoding) is shared by all the clients.
+            initial_snapshot = self.game.field.snapshot()
+            capabilities = self.client_info.info.capabilities
+            receives_compact_field_states = CAPABILITY_COMPACT_FIELD_STATE in capabilities
+            self.game_room.set_session(
+                self.client_info.name,
+                self.sess,
+                receives_field_deltas = CAPABILITY_FIELD_DELTAS in capabilities,
+                receives_compact_field_states = receives_compact_field_states,
+            )
             await self.sess.send_event(
                 Event(name='GameStarted', data=self.game.info().to_primitive(), must_know=True)
             )
-            await self.sess.send_new_field_state(self.game.field.get_state())
+            await self.sess.send_raw_frame(encode_snapshot(initial_snapshot, compact=receives_compact_field_states))
 
             if self.client_info.name.is_player():
                 await self.run_for_player()
@@ -54,17 +73,27 @@ class GameLoop:
             raise EnsureDisconnect(e)
 
     async def run_for_non_player(self) -> None:
-        while True:
-            which, _ = await select(
-                message = self.sess.recv_message(),
-                end = self.game_room.wait_until_game_ends(self.client_info.name),
-            )
+        # The game updates are relayed by a separate task, which keeps running
+        # while this one answers the viewer's messages.
+        relay_task = await curio.spawn(self.game_room.serve_viewer, self.client_info.name)
+        try:
+            while True:
+                which, _ = await select(
+                    message = self.sess.recv_message(),
+                    end = self.game_room.wait_until_game_ends(self.client_info.name),
+                )
+
+                if which == 'message':
+                    await self.sess.respond_err('You cannot send messages during a game')
+                    continue
 
-            if which == 'message':
-                await self.sess.respond_err('You cannot send messages during a game')
-                continue
+                break
+        except BaseException:
+            await relay_task.cancel()
+            raise
 
-            break
+        # Let the viewer receive all the updates before the end of the game is announced.
+        await relay_task.join()
 
         winners = self.game.get_winners()
         await self.sess.send_event(Event(
@@ -75,6 +104,8 @@ class GameLoop:
 
     async def run_for_player(self) -> None:
         client_name = self.client_info.name
+        tracer = self.game_room.tracer
+        lane = str(client_name)
 
         while True:
             try:
@@ -88,16 +119,30 @@ class GameLoop:
                     continue
 
                 logger.debug('It is {!r}\'s turn', client_name)
+                span_args = {'room': self.game_room.name, 'turn': self.game_room.turn, 'player': lane}
                 with self.game_room.lock_events_for(client_name):
-                    which, action = await select(
-                        action = self.sess.request_action(),
-                        timeout = self.game_room.wait_for_turn_timeout(client_name),
-                    )
+                    request_start = perf_counter()
+                    with tracer.span('request_action', lane, **span_args):
+                        which, action = await select(
+                            action = self.sess.request_action(),
+                            timeout = self.game_room.wait_for_turn_timeout(client_name),
+                        )
                     assert which == 'action'
+                    metrics.ACTION_LATENCY.observe(perf_counter() - request_start)
 
                     logger.debug('{!r} requested action: {!r}', client_name, action)
 
-                    move_result = self.game.take_turn(name=str(client_name), action=action)
+                    field_update: Optional[FieldUpdate]
+                    if self.game_room.simultaneous_moves:
+                        # The room resolves everyone's moves together and
+                        # broadcasts the field update by itself.
+                        with tracer.span('submit_action', lane, **span_args):
+                            move_result = await self.game_room.submit_action(client_name, action)
+                        field_update = None
+                    else:
+                        with tracer.span('take_turn', lane, **span_args):
+                            move_result = self.game_room.take_turn(client_name, action)
+                        field_update = self.game_room.capture_field_update()
                     crashed: bool = move_result.match(
                         OK = lambda: False,
                         CRASH = lambda: True,
@@ -108,11 +153,9 @@ class GameLoop:
 
                     await self.sess.respond_ok()
 
-                new_field_state = self.game.field.get_state()
-                await self.game_room.broadcast(
-                    lambda context: context.session.send_new_field_state(new_field_state),
-                    lambda name: True,
-                )
+                if field_update is not None:
+                    with tracer.span('broadcast_field_update', lane, **span_args):
+                        await self.game_room.broadcast_field_update(field_update)
             except GameRoomExit:
                 winners = self.game.get_winners()
                 await self.sess.send_event(Event(
@@ -141,4 +184,5 @@ class GameLoop:
 
         self.game_room.mark_client_disconnected(client_name)
         if client_name.is_player():
+            await self.game_room.withdraw_from_round(client_name)
             await self.game_room.report_disconnect(client_name)
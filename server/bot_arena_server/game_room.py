@@ -1,22 +1,32 @@
+from bot_arena_server import metrics
 from bot_arena_server.client_name import ClientName
 from bot_arena_server.control_flow import EnsureDisconnect
-from bot_arena_server.game import Game, GameScore
+from bot_arena_server.game import FieldSnapshot, Game, GameScore, MoveResult
+from bot_arena_server.pacing import make_pacer
 from bot_arena_server.pubsub import PublishSubscribeService
+from bot_arena_server.replay import ReplayWriter
+from bot_arena_server.spectator_relay import SpectatorRelay
+from bot_arena_server.tracing import NULL_TRACER, Tracer
 
-from dataclasses import dataclass
-from typing import List, Dict, Callable, Coroutine, Any, Set, Optional
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import List, Dict, Callable, Coroutine, Any, Set, Optional, Union
 
 import curio    # type: ignore
 from adt import adt, Case
+from bot_arena_proto.data import Action, Direction, FieldDelta
 from bot_arena_proto.event import Event
+from bot_arena_proto.message import Message
 from bot_arena_proto.session import ServerSession
 from loguru import logger # type: ignore
 
 
 __all__ = [
+    'FieldUpdate',
     'GameRoom',
     'GameRoomError',
     'GameRoomExit',
+    'encode_snapshot',
 ]
 
 
@@ -33,15 +43,55 @@ class GameRoomError(Exception):
     pass
 
 
+class OutboundQueueOverflow(Exception):
+    def __init__(self, max_size: int) -> None:
+        super().__init__()
+        self.max_size = max_size
+
+    def __str__(self) -> str:
+        return f'More than {self.max_size} messages are waiting to be sent'
+
+
 class GameRoom:
-    def __init__(self, client_names: List[ClientName], game: Game, name: str, turn_delay: float) -> None:
+    def __init__(
+        self,
+        client_names: List[ClientName],
+        game: Game,
+        name: str,
+        turn_delay: float,
+        write_timeout: Optional[float] = None,
+        max_pending_events: Optional[int] = None,
+        simultaneous_moves: bool = False,
+        spectator_buffer_size: int = 256,
+        tracer: Tracer = NULL_TRACER,
+        replay: Optional[ReplayWriter] = None,
+    ) -> None:
         self._pending_clients = {name: make_pending_client_context(name) for name in client_names}
         self._clients: Dict[ClientName, ClientContext] = {}
         self._client_names = client_names
         self._game = game
         self._turn_timeout_seconds: Optional[float] = None
         self._name = name
-        self._turn_delay = turn_delay
+        # The turns start every `turn_delay` seconds (or as soon as possible, if it is 0),
+        # no matter how much of that time the previous turn has taken.
+        self._pacer = make_pacer(turn_delay)
+        # Clients that take longer than this to accept a broadcast message are dropped.
+        self._write_timeout = write_timeout
+        # Clients that have more than this many events waiting to be sent are dropped.
+        self._max_pending_events = max_pending_events
+        self._field_update_seq = 0
+        # Clients that are being disconnected because a broadcast to them failed.
+        self._dropped_clients: Set[ClientName] = set()
+        self._simultaneous_moves = simultaneous_moves
+        # The round in progress, only used with simultaneous moves.
+        self._round: Optional[SimultaneousRound] = None
+        # Viewers do not take part in broadcasts: everything they need is published
+        # here once, and each viewer is served from its own task (see `serve_viewer`).
+        self._spectator_relay: SpectatorRelay[Union[bytes, FieldUpdate]] = SpectatorRelay(spectator_buffer_size)
+        self._has_viewers = any(not name.is_player() for name in client_names)
+        self._tracer = tracer
+        # Everything that changes the field is recorded here, if set.
+        self._replay = replay
 
     def set_turn_timeout(self, turn_timeout_seconds: Optional[float]) -> None:
         self._turn_timeout_seconds = turn_timeout_seconds
@@ -49,7 +99,25 @@ class GameRoom:
     def get_score(self) -> GameScore:
         return self._game.get_score()
 
-    def set_session(self, client_name: ClientName, session: ServerSession) -> None:
+    @property
+    def simultaneous_moves(self) -> bool:
+        return self._simultaneous_moves
+
+    @property
+    def tracer(self) -> Tracer:
+        return self._tracer
+
+    @property
+    def turn(self) -> int:
+        return self._game.turns_played
+
+    def set_session(
+        self,
+        client_name: ClientName,
+        session: ServerSession,
+        receives_field_deltas: bool = False,
+        receives_compact_field_states: bool = False,
+    ) -> None:
         if client_name in self._clients:
             raise GameRoomError(f'Session already added for {client_name!r}')
         if client_name not in self._pending_clients:
@@ -60,6 +128,12 @@ class GameRoom:
             session = session,
             category = pending_context.category,
             event_queue = LockedEventQueue(),
+            receives_field_deltas = receives_field_deltas,
+            receives_compact_field_states = receives_compact_field_states,
+            # The client is expected to get the current field state in full
+            # right away, so it does not need the updates captured before.
+            first_field_update = self._field_update_seq + 1,
+            relay_position = self._spectator_relay.end,
         )
         self._clients[client_name] = context
 
@@ -72,7 +146,7 @@ class GameRoom:
             raise GameRoomError(f'Snake {client_name!r} somehow managed to die twice')
 
         context.category = ClientCategory.DEAD_PLAYER()
-        self._game.kill_snake_off(str(client_name))
+        self._kill_snake_off(client_name)
 
     def mark_client_disconnected(self, client_name: ClientName) -> None:
         self._check_for_client(client_name)
@@ -82,10 +156,26 @@ class GameRoom:
             raise GameRoomError(f'Client {client_name!r} somehow managed to disconnect twice')
 
         if context.category == ClientCategory.ALIVE_PLAYER():
-            self._game.kill_snake_off(str(client_name))
+            self._kill_snake_off(client_name)
 
         context.category = ClientCategory.DISCONNECTED()
 
+    def _kill_snake_off(self, client_name: ClientName) -> None:
+        snake_name = str(client_name)
+        if self._replay is not None and snake_name in self._game.snake_names():
+            self._replay.record_kill(snake_name)
+        self._game.kill_snake_off(snake_name)
+
+    def take_turn(self, client_name: ClientName, action: Action) -> MoveResult:
+        if self._replay is not None:
+            self._replay.record_move(str(client_name), _action_direction(action))
+        return self._game.take_turn(name=str(client_name), action=action)
+
+    def _finish_round(self) -> None:
+        self._game.finish_turn()
+        if self._replay is not None:
+            self._replay.record_end_of_round()
+
     async def report_death(self, client_name: ClientName) -> None:
         assert client_name.is_player()
         self._check_for_client(client_name)
@@ -138,60 +228,160 @@ class GameRoom:
             raise Exception(f'Internal error: unknown synchronization message: {msg!r}')
 
     async def run_loop(self) -> None:
+        try:
+            await self._run_loop()
+        finally:
+            if self._replay is not None:
+                self._replay.close()
+
+    async def _run_loop(self) -> None:
         last_game_score = self.get_score()
         await self.broadcast_event(
             Event(name='GameScoreChanged', data=last_game_score.score, must_know=False),
             lambda _: True,
         )
 
+        self._pacer.start()
+        if self._simultaneous_moves:
+            await self._run_simultaneous_loop(last_game_score)
+            return
+
         logger.debug('Loop started')
         while True:
             logger.debug('New round')
-            for client_name in self._client_names:
-                if self._game.is_finish_condition_satisfied():
+            round_start = perf_counter()
+            with self._tracer.span('round', 'room', room=self._name, turn=self.turn):
+                for client_name in self._client_names:
+                    if self._game.is_finish_condition_satisfied():
+                        await self._finish_game()
+                        return
+
                     await self._flush_event_queues()
-                    logger.debug('Loop finished')
-                    logger.info(
-                        'Game in the room {!r} has finished (winners: {!r})',
-                        self.name,
-                        self._game.get_winners(),
-                    )
-                    await self.terminate_all_sessions()
 
-                    return
+                    if self._clients[client_name].category != ClientCategory.ALIVE_PLAYER():
+                        continue
 
-                await self._flush_event_queues()
+                    logger.debug('{!r}\'s turn', client_name)
+                    queue = self._clients[client_name].sync_queue
 
-                if self._clients[client_name].category != ClientCategory.ALIVE_PLAYER():
-                    continue
+                    with self._tracer.span('turn', 'room', room=self._name, turn=self.turn, player=str(client_name)):
+                        await queue.put('continue')
+                        await queue.join()
 
-                logger.debug('{!r}\'s turn', client_name)
-                queue = self._clients[client_name].sync_queue
+                    last_game_score = await self._report_game_score(last_game_score)
 
-                await queue.put('continue')
-                await queue.join()
+                    await self._pacer.wait_for_next_turn()
+            self._finish_round()
+            metrics.ROUND_DURATION.observe(perf_counter() - round_start)
 
-                current_game_score = self.get_score()
-                logger.debug('Game score check: {} vs {}', last_game_score, current_game_score)
-                if current_game_score != last_game_score:
-                    logger.debug('New game score: {}', current_game_score)
-                    await self.broadcast_event(
-                        Event(name='GameScoreChanged', data=current_game_score.score, must_know=False),
-                        lambda _: True,
-                    )
-                    last_game_score = current_game_score
+    async def _run_simultaneous_loop(self, last_game_score: GameScore) -> None:
+        logger.debug('Loop started (simultaneous moves)')
+        while True:
+            logger.debug('New round')
+            round_start = perf_counter()
+            await self._flush_event_queues()
+            if self._game.is_finish_condition_satisfied():
+                await self._finish_game()
+                return
+            with self._tracer.span('round', 'room', room=self._name, turn=self.turn):
+                last_game_score = await self._play_simultaneous_round(last_game_score)
+                await self._pacer.wait_for_next_turn()
+            self._finish_round()
+            metrics.ROUND_DURATION.observe(perf_counter() - round_start)
+
+    async def _play_simultaneous_round(self, last_game_score: GameScore) -> GameScore:
+        alive_players = [
+            client_name
+            for client_name in self._client_names
+            if self._clients[client_name].category == ClientCategory.ALIVE_PLAYER()
+        ]
+        current_round = SimultaneousRound(awaiting=set(alive_players))
+        self._round = current_round
+
+        # Everyone gets their turn at once, and the moves are resolved
+        # when all the players have either acted or left the game.
+        for client_name in alive_players:
+            await self._clients[client_name].sync_queue.put('continue')
+        if len(current_round.awaiting) > 0:
+            await current_round.all_submitted.wait()
+
+        actions = {
+            str(client_name): action
+            for client_name, action in current_round.actions.items()
+            if self._clients[client_name].category == ClientCategory.ALIVE_PLAYER()
+        }
+        if self._replay is not None:
+            self._replay.record_simultaneous_moves({
+                name: _action_direction(action)
+                for name, action in actions.items()
+            })
+        with self._tracer.span('take_simultaneous_turn', 'room', room=self._name, turn=self.turn):
+            results = self._game.take_simultaneous_turn(actions)
+        field_update = self.capture_field_update()
+        current_round.results = {
+            client_name: results[str(client_name)]
+            for client_name in current_round.actions
+            if str(client_name) in results
+        }
+        await current_round.resolved.set()
+
+        for client_name in alive_players:
+            await self._clients[client_name].sync_queue.join()
+        self._round = None
+
+        await self.broadcast_field_update(field_update)
+        return await self._report_game_score(last_game_score)
+
+    async def submit_action(self, client_name: ClientName, action: Action) -> MoveResult:
+        """Submit the player's action for the current round and wait until it is resolved.
+
+        Only used with simultaneous moves.
+        """
 
-                await curio.sleep(self._turn_delay)
-            self._game.finish_turn()
+        assert client_name.is_player()
+        self._check_for_client(client_name)
+        current_round = self._round
+        if current_round is None or client_name not in current_round.awaiting:
+            raise GameRoomError(f'{client_name!r} is not expected to act now')
+
+        current_round.actions[client_name] = action
+        await current_round.stop_awaiting(client_name)
+        await current_round.resolved.wait()
+        return current_round.results[client_name]
+
+    async def withdraw_from_round(self, client_name: ClientName) -> None:
+        """Stop waiting for the action of a player who has left the game."""
+
+        if self._round is not None:
+            await self._round.stop_awaiting(client_name)
+
+    async def _report_game_score(self, last_game_score: GameScore) -> GameScore:
+        current_game_score = self.get_score()
+        logger.debug('Game score check: {} vs {}', last_game_score, current_game_score)
+        if current_game_score != last_game_score:
+            logger.debug('New game score: {}', current_game_score)
+            await self.broadcast_event(
+                Event(name='GameScoreChanged', data=current_game_score.score, must_know=False),
+                lambda _: True,
+            )
+        return current_game_score
+
+    async def _finish_game(self) -> None:
+        await self._flush_event_queues()
+        await self._spectator_relay.close()
+        logger.debug('Loop finished')
+        logger.info(
+            'Game in the room {!r} has finished (winners: {!r})',
+            self.name,
+            self._game.get_winners(),
+        )
+        await self.terminate_all_sessions()
 
     async def _flush_event_queues(self) -> None:
-        for context in self._clients.values():
-            events = context.event_queue.try_flush()
-            try:
-                for event in events:
-                    await context.session.send_event(event)
-            except (IOError, EOFError, OSError) as _:
-                pass
+        async def flush(context: ClientContext) -> None:
+            await context.session.send_raw_frames(context.event_queue.try_flush())
+
+        await self.broadcast(flush, lambda name: True)
 
     async def terminate_all_sessions(self) -> None:
         logger.debug('Terminating all game sessions in this game room')
@@ -217,14 +407,140 @@ class GameRoom:
         action: Callable[['ClientContext'], Coroutine[Any, None, None]],
         filter_func: Callable[[ClientName], bool],
     ) -> None:
-        for client_name, context in self._clients.items():
-            if context.category != ClientCategory.DISCONNECTED() and filter_func(client_name):
-                logger.debug('Broadcast: {!r}, context = {!r}', client_name, context)
-                try:
+        """Run the action for all matching players concurrently.
+
+        A slow client cannot hold up the others: if the action does not finish
+        within the write timeout, or fails, the client is dropped.
+
+        Viewers are skipped: they get the messages meant for everyone through
+        the spectator relay.
+        """
+
+        recipients = [
+            (client_name, context)
+            for client_name, context in self._clients.items()
+            if client_name.is_player()
+            and context.category != ClientCategory.DISCONNECTED()
+            and client_name not in self._dropped_clients
+            and filter_func(client_name)
+        ]
+
+        async def run_action(client_name: ClientName, context: ClientContext) -> None:
+            logger.debug('Broadcast: {!r}, context = {!r}', client_name, context)
+            try:
+                if self._write_timeout is None:
                     await action(context)
-                except (IOError, EOFError, OSError) as e:
-                    logger.debug('Broadcast failed: endpoint disconnected')
-                    await self.ensure_disconnect(client_name)
+                else:
+                    await curio.timeout_after(self._write_timeout, action, context)
+            except curio.TaskTimeout:
+                logger.info('Dropping {!r}: broadcast write timed out', client_name)
+                await self._drop_client(client_name)
+            except OutboundQueueOverflow as e:
+                logger.info('Dropping {!r}: {}', client_name, e)
+                await self._drop_client(client_name)
+            except (IOError, EOFError, OSError) as e:
+                logger.debug('Broadcast failed: endpoint disconnected')
+                await self._drop_client(client_name)
+
+        with metrics.BROADCAST_DURATION.time(), \
+                self._tracer.span('broadcast', 'room', room=self._name, turn=self.turn, recipients=len(recipients)):
+            if len(recipients) == 1:
+                await run_action(*recipients[0])
+                return
+
+            async with curio.TaskGroup() as tg:
+                for client_name, context in recipients:
+                    await tg.spawn(run_action, client_name, context)
+
+    async def _drop_client(self, client_name: ClientName) -> None:
+        if client_name in self._dropped_clients:
+            return
+        self._dropped_clients.add(client_name)
+        # `ensure_disconnect` waits until the client's coroutine picks up the
+        # notification, and that coroutine may be the one broadcasting right now.
+        await curio.spawn(self.ensure_disconnect, client_name, daemon=True)
+
+    def capture_field_update(self) -> 'FieldUpdate':
+        """Take the changes made to the field since the previous update.
+
+        Must be called right after the field is changed, without awaiting anything
+        in between, so that every client receives a consistent sequence of updates.
+        """
+
+        self._field_update_seq += 1
+        delta = self._game.field.take_delta()
+        is_keyframe = self._field_update_seq % self._field_keyframe_interval == 0
+
+        needs_state = is_keyframe or any(
+            not context.receives_field_deltas
+            for context in self._clients.values()
+            if context.category != ClientCategory.DISCONNECTED()
+        )
+
+        snapshot = None
+        if needs_state:
+            with self._tracer.span('snapshot', 'room', room=self._name, turn=self.turn):
+                snapshot = self._game.field.snapshot()
+
+        return FieldUpdate(
+            seq = self._field_update_seq,
+            delta = delta,
+            snapshot = snapshot,
+            keyframe = is_keyframe,
+        )
+
+    async def broadcast_field_update(self, update: 'FieldUpdate') -> None:
+        """Send a field update to all clients.
+
+        Clients that support field deltas receive only the delta, except for
+        periodic keyframes; other clients always receive the full state.
+        """
+
+        async def send(context: ClientContext) -> None:
+            if update.seq < context.first_field_update:
+                return
+            # Pending events go out together with the update, in a single write.
+            await context.session.send_raw_frames(context.event_queue.try_flush() + [update.encode_for(context)])
+
+        await self.broadcast(send, lambda name: True)
+        await self._publish_for_viewers(update, keyframe=update.keyframe)
+
+    async def _publish_for_viewers(self, entry: Union[bytes, 'FieldUpdate'], keyframe: bool = False) -> None:
+        # Viewers get everything that is broadcast: no broadcast filter excludes them.
+        if self._has_viewers:
+            await self._spectator_relay.publish(entry, keyframe)
+
+    async def serve_viewer(self, client_name: ClientName) -> None:
+        """Send a viewer everything published for the viewers, until the game ends.
+
+        This runs in the viewer's own task, so a slow viewer only delays itself.
+        A viewer that falls too far behind skips to the latest keyframe.
+        """
+
+        assert not client_name.is_player()
+        self._check_for_client(client_name)
+        context = self._clients[client_name]
+
+        position = context.relay_position
+        while True:
+            entries, position = await self._spectator_relay.read(position)
+            if len(entries) == 0:
+                return
+            frames = [
+                entry if isinstance(entry, bytes) else entry.encode_for(context)
+                for entry in entries
+                # As with the players, the updates captured before the session was
+                # added are already contained in the initial field state.
+                if isinstance(entry, bytes) or entry.seq >= context.first_field_update
+            ]
+            if len(frames) == 0:
+                continue
+            try:
+                await context.session.send_raw_frames(frames)
+            except (IOError, EOFError, OSError):
+                logger.debug('Relaying to {!r} failed: endpoint disconnected', client_name)
+                await self._drop_client(client_name)
+                return
 
     async def ensure_disconnect(self, client_name: ClientName) -> None:
         logger.debug('Ensuring that {!r} is disconnected', client_name)
@@ -232,13 +548,27 @@ class GameRoom:
         await queue.put('disconnect')
         await queue.put(None)
 
+    async def broadcast_message(self, message: Message, filter_func: Callable[[ClientName], bool]) -> None:
+        """Send the same message to all clients, encoding it only once."""
+
+        frame = metrics.encode_message(message)
+        await self.broadcast(lambda context: context.session.send_raw_frame(frame), filter_func)
+        await self._publish_for_viewers(frame)
+
     async def broadcast_event(self, event: Event, filter_func: Callable[[ClientName], bool]) -> None:
         logger.debug(f'Broadcasting event: {event}')
+        if self._replay is not None:
+            self._replay.record_event(event)
+        frame = metrics.encode_message(Message.EVENT_HAPPENED(event))
 
         async def callback(context: ClientContext):
-            context.event_queue.enqueue(event)
+            queue = context.event_queue
+            if self._max_pending_events is not None and len(queue) >= self._max_pending_events:
+                raise OutboundQueueOverflow(self._max_pending_events)
+            queue.enqueue(frame)
 
         await self.broadcast(callback, filter_func)
+        await self._publish_for_viewers(frame)
 
     async def wait_until_game_ends(self, client_name: ClientName) -> None:
         if client_name.is_player():
@@ -295,10 +625,72 @@ class GameRoom:
         )
         raise EnsureDisconnect()
 
+    # Every this many field updates, even the clients supporting deltas receive the full state.
+    _field_keyframe_interval = 50
+
+
+def _action_direction(action: Action) -> Direction:
+    return action.match(move = lambda direction: direction) # type: ignore
+
+
+@dataclass
+class SimultaneousRound:
+    # Players whose actions have not been received yet.
+    awaiting: Set[ClientName]
+    actions: Dict[ClientName, Action] = field(default_factory=dict)
+    results: Dict[ClientName, MoveResult] = field(default_factory=dict)
+    all_submitted: curio.Event = field(default_factory=curio.Event)
+    resolved: curio.Event = field(default_factory=curio.Event)
+
+    async def stop_awaiting(self, client_name: ClientName) -> None:
+        if client_name not in self.awaiting:
+            return
+        self.awaiting.remove(client_name)
+        if len(self.awaiting) == 0:
+            await self.all_submitted.set()
+
+
+@dataclass
+class FieldUpdate:
+    seq: int
+    delta: FieldDelta
+    # Only taken if some client needs it.
+    snapshot: Optional[FieldSnapshot]
+    keyframe: bool
+    _delta_frame: Optional[bytes] = field(default=None, repr=False)
+
+    def encode_for(self, context: 'ClientContext') -> bytes:
+        """Encode the update in the form the client expects.
+
+        Each form is encoded only once, however many clients receive it.
+        """
+
+        if context.receives_field_deltas and not self.keyframe:
+            if self._delta_frame is None:
+                self._delta_frame = metrics.encode_message(Message.NEW_FIELD_DELTA(self.delta))
+            return self._delta_frame
+        assert self.snapshot is not None
+        return encode_snapshot(self.snapshot, compact=context.receives_compact_field_states)
+
+
+def encode_snapshot(snapshot: FieldSnapshot, compact: bool) -> bytes:
+    """Encode the snapshot, timing the encoding if it hasn't been done yet."""
+
+    if snapshot.is_encoded(compact):
+        return snapshot.encode(compact)
+    start = perf_counter()
+    frame = snapshot.encode(compact)
+    kind = 'NewCompactFieldState' if compact else 'NewFieldState'
+    metrics.ENCODE_DURATION.observe(perf_counter() - start, kind=kind)
+    return frame
+
 
 class LockedEventQueue:
+    # Events are stored already encoded as EVENT_HAPPENED messages,
+    # since the same event is usually sent to many clients.
+
     def __init__(self) -> None:
-        self.queue: List[Event] = []
+        self.queue: List[bytes] = []
         self.is_locked = False
 
     def lock(self) -> None:
@@ -309,7 +701,7 @@ class LockedEventQueue:
         assert self.is_locked
         self.is_locked = False
 
-    def try_flush(self) -> List[Event]:
+    def try_flush(self) -> List[bytes]:
         if self.is_locked:
             return []
         else:
@@ -317,8 +709,11 @@ class LockedEventQueue:
             self.queue = []
             return queue
 
-    def enqueue(self, event: Event) -> None:
-        self.queue.append(event)
+    def enqueue(self, frame: bytes) -> None:
+        self.queue.append(frame)
+
+    def __len__(self) -> int:
+        return len(self.queue)
 
 
 class EventLock:
@@ -358,6 +753,11 @@ class ClientContext:
     session: ServerSession
     category: ClientCategory
     event_queue: LockedEventQueue
+    receives_field_deltas: bool
+    receives_compact_field_states: bool
+    first_field_update: int
+    # Where the viewer starts reading from the spectator relay.
+    relay_position: int
 
 
 def make_pending_client_context(client_name: ClientName) -> PendingClientContext:
@@ -1,7 +1,7 @@
 from bot_arena_server.work_limit import WorkLimit
 
 from abc import abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import TypeVar, Generic, Optional, Protocol, Any
 
 
@@ -109,3 +109,15 @@ class Limits:
     max_turns: OptionalUpperBound[int]
     work_units: WorkLimit
     turn_delay: float
+    broadcast_write_timeout: Optional[float] = None
+    max_pending_events: Optional[int] = None
+    spectator_buffer_size: int = 256
+    # Rooms may not set a turn rate higher than this.
+    max_turns_per_second: OptionalUpperBound[float] = field(default_factory=lambda: OptionalUpperBound(None))
+    # Whether the games nobody watches run as fast as the players can move,
+    # unless their rooms set a turn rate.
+    unpaced_without_viewers: bool = False
+    # If set, a Chrome trace of every game is saved into this directory.
+    trace_dir: Optional[str] = None
+    # If set, every game is recorded into this directory (see `replay`).
+    replay_dir: Optional[str] = None
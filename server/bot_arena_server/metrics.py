@@ -0,0 +1,354 @@
+"""Counters, gauges and histograms describing what the server is doing.
+
+The metrics are kept per process in `REGISTRY` and can be served over HTTP
+in the Prometheus text exposition format (see `serve_metrics`). Updating a
+metric is cheap enough to be done on every message.
+
+Rooms and players are not used as labels: their names are chosen by the
+clients, so there would be no bound on the number of time series.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Sequence, Tuple, Union
+
+import curio # type: ignore
+from bot_arena_proto.message import Message
+from bot_arena_proto.session import ServerSession, AsyncStream
+from loguru import logger # type: ignore
+
+
+__all__ = [
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'MeteredServerSession',
+    'MetricsRegistry',
+    'REGISTRY',
+    'decode_message',
+    'encode_message',
+    'render',
+    'serve_metrics',
+]
+
+
+LabelValues = Tuple[str, ...]
+# A metric family as a primitive: {'name', 'type', 'help', 'samples'},
+# where a sample is [name, {label: value}, value].
+Family = Dict[str, Any]
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if len(labels) != len(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key: LabelValues) -> Dict[str, str]:
+        return dict(zip(self.label_names, key))
+
+    def collect(self) -> Family:
+        return {
+            'name': self.name,
+            'type': self.type_name,
+            'help': self.help,
+            'samples': list(self._samples()),
+        }
+
+    def _samples(self) -> Iterator[List[Any]]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type_name = 'counter'
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()) -> None:
+        super().__init__(name, help, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> Iterator[List[Any]]:
+        for key, value in self._values.items():
+            yield [self.name, self._labels(key), value]
+
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+
+    type_name = 'gauge'
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts the observed values falling into each of the buckets."""
+
+    type_name = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float],
+        label_names: Sequence[str] = (),
+    ) -> None:
+        super().__init__(name, help, label_names)
+        self.buckets = sorted(buckets)
+        # Per label values: the count in each bucket (the last one is +Inf) and the sum.
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def get_count(self, **labels: str) -> int:
+        return sum(self._counts.get(self._key(labels), []))
+
+    def _samples(self) -> Iterator[List[Any]]:
+        for key, counts in self._counts.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float('inf')], counts):
+                cumulative += count
+                yield [self.name + '_bucket', {**labels, 'le': _format_value(bound)}, cumulative]
+            yield [self.name + '_sum', labels, self._sums[key]]
+            yield [self.name + '_count', labels, cumulative]
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Any:
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name!r} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def collect(self) -> List[Family]:
+        return [metric.collect() for metric in self._metrics.values()]
+
+
+def render(sources: Sequence[Tuple[Dict[str, str], List[Family]]]) -> str:
+    """Render metric families in the Prometheus text exposition format.
+
+    `sources` are the families collected in different places (e.g. different
+    processes) along with the labels to tell them apart. Families with the
+    same name are merged.
+    """
+
+    merged: Dict[str, Family] = {}
+    for extra_labels, families in sources:
+        for family in families:
+            target = merged.setdefault(family['name'], {**family, 'samples': []})
+            for name, labels, value in family['samples']:
+                target['samples'].append([name, {**extra_labels, **labels}, value])
+
+    lines = []
+    for family in merged.values():
+        lines.append(f'# HELP {family["name"]} {_escape_help(family["help"])}')
+        lines.append(f'# TYPE {family["name"]} {family["type"]}')
+        for name, labels, value in family['samples']:
+            if len(labels) > 0:
+                formatted_labels = ','.join(f'{k}="{_escape_label_value(v)}"' for k, v in labels.items())
+                lines.append(f'{name}{{{formatted_labels}}} {_format_value(value)}')
+            else:
+                lines.append(f'{name} {_format_value(value)}')
+    return ''.join(line + '\n' for line in lines)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_help(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _escape_label_value(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+REGISTRY = MetricsRegistry()
+
+_LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+_CODEC_BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01]
+
+CONNECTIONS: Gauge = REGISTRY.register(Gauge(
+    'bot_arena_connections',
+    'Connected clients by the state they are in (hub, room, ready or game)',
+    ['state'],
+))
+ROOMS: Gauge = REGISTRY.register(Gauge(
+    'bot_arena_rooms',
+    'Rooms by state (waiting for the game to start or playing)',
+    ['state'],
+))
+ROUND_DURATION: Histogram = REGISTRY.register(Histogram(
+    'bot_arena_round_duration_seconds',
+    'Time it takes a room to play a round, including the turn delays',
+    [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0],
+))
+ACTION_LATENCY: Histogram = REGISTRY.register(Histogram(
+    'bot_arena_action_latency_seconds',
+    'Time from sending YourTurn to a player to receiving its action',
+    _LATENCY_BUCKETS,
+))
+BROADCAST_DURATION: Histogram = REGISTRY.register(Histogram(
+    'bot_arena_broadcast_duration_seconds',
+    'Time it takes to send a broadcast message to all the players of a room',
+    _LATENCY_BUCKETS,
+))
+SENT_BYTES: Counter = REGISTRY.register(Counter(
+    'bot_arena_sent_bytes_total',
+    'Bytes sent to the clients',
+))
+RECEIVED_BYTES: Counter = REGISTRY.register(Counter(
+    'bot_arena_received_bytes_total',
+    'Bytes received from the clients',
+))
+ENCODE_DURATION: Histogram = REGISTRY.register(Histogram(
+    'bot_arena_message_encode_seconds',
+    'Time it takes to encode a message, by message kind',
+    _CODEC_BUCKETS,
+    ['kind'],
+))
+DECODE_DURATION: Histogram = REGISTRY.register(Histogram(
+    'bot_arena_message_decode_seconds',
+    'Time it takes to decode a message, by message kind',
+    _CODEC_BUCKETS,
+    ['kind'],
+))
+
+
+def encode_message(message: Message) -> bytes:
+    start = perf_counter()
+    frame = message.to_bytes()
+    ENCODE_DURATION.observe(perf_counter() - start, kind=message.kind())
+    return frame
+
+
+def decode_message(frame: Union[bytes, memoryview]) -> Message:
+    start = perf_counter()
+    message = Message.from_bytes(frame)
+    DECODE_DURATION.observe(perf_counter() - start, kind=message.kind())
+    return message
+
+
+class MeteredStream:
+    """Counts the bytes going through a stream."""
+
+    def __init__(self, stream: AsyncStream) -> None:
+        self._stream = stream
+
+    async def read(self, how_many: int) -> bytes:
+        data = await self._stream.read(how_many)
+        RECEIVED_BYTES.inc(len(data))
+        return data
+
+    async def write(self, data: bytes) -> None:
+        await self._stream.write(data)
+        SENT_BYTES.inc(len(data))
+
+
+class MeteredServerSession(ServerSession):
+    """A server session that reports the traffic and the time spent on encoding and decoding."""
+
+    def __init__(self, stream: AsyncStream, unread_data: bytes = b'') -> None:
+        super().__init__(MeteredStream(stream), unread_data)
+
+    def _encode_message(self, message: Message) -> bytes:
+        return encode_message(message)
+
+    def _decode_message(self, frame: memoryview) -> Message:
+        return decode_message(frame)
+
+
+_MAX_REQUEST_HEADER_SIZE = 8192
+
+
+async def serve_metrics(
+    host: str,
+    port: int,
+    collect: Callable[[], Awaitable[str]],
+) -> None:
+    """Serve the metrics over HTTP: `GET /metrics` responds with what `collect` returns."""
+
+    async def handle(sock: curio.io.Socket, peer_address: Tuple[str, int]) -> None:
+        stream = sock.as_stream()
+        request = b''
+        try:
+            while b'\r\n\r\n' not in request and len(request) < _MAX_REQUEST_HEADER_SIZE:
+                data = await curio.timeout_after(10, stream.read, 4096)
+                if len(data) == 0:
+                    return
+                request += data
+        except (curio.TaskTimeout, OSError):
+            return
+
+        request_line = request.split(b'\r\n', 1)[0].split(b' ')
+        if len(request_line) != 3:
+            status, body = '400 Bad Request', 'Bad request\n'
+        elif request_line[0] != b'GET':
+            status, body = '405 Method Not Allowed', 'Only GET is supported\n'
+        elif request_line[1].split(b'?', 1)[0] != b'/metrics':
+            status, body = '404 Not Found', 'The metrics are at /metrics\n'
+        else:
+            status, body = '200 OK', await collect()
+
+        encoded_body = body.encode('utf-8')
+        header = (
+            f'HTTP/1.0 {status}\r\n'
+            f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(encoded_body)}\r\n'
+            f'Connection: close\r\n'
+            f'\r\n'
+        )
+        try:
+            await stream.write(header.encode('ascii') + encoded_body)
+        except OSError:
+            pass
+
+    logger.info('Serving metrics on http://{}:{}/metrics', host, port)
+    await curio.tcp_server(host, port, handle)
+
@@ -0,0 +1,96 @@
+"""How long a game room waits between turns.
+
+The time a turn has already taken (waiting for the client's action,
+moving the snakes, broadcasting) counts towards the interval, so a room
+set to 10 turns per second makes 10 turns per second however slow its
+clients are, as long as they fit into the interval.
+"""
+
+import math
+import time
+from typing import Optional
+
+import curio # type: ignore
+
+
+__all__ = [
+    'FixedRatePacer',
+    'Pacer',
+    'UnpacedPacer',
+    'choose_turn_interval',
+    'make_pacer',
+]
+
+
+class Pacer:
+    def start(self) -> None:
+        """Called once when the first turn starts."""
+
+    async def wait_for_next_turn(self) -> None:
+        """Called after each turn: return when the next turn may start."""
+
+        raise NotImplementedError
+
+
+class FixedRatePacer(Pacer):
+    """Starts a turn every `interval` seconds.
+
+    A turn that takes longer than the interval delays the following ones:
+    the missed time is not caught up on with a burst of turns.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self._interval = interval
+        self._turn_started_at: Optional[float] = None
+
+    def start(self) -> None:
+        self._turn_started_at = time.monotonic()
+
+    async def wait_for_next_turn(self) -> None:
+        if self._turn_started_at is None:
+            self.start()
+            assert self._turn_started_at is not None
+
+        next_turn_at = self._turn_started_at + self._interval
+        delay = next_turn_at - time.monotonic()
+        if delay > 0:
+            await curio.sleep(delay)
+            self._turn_started_at = next_turn_at
+        else:
+            await curio.sleep(0)
+            self._turn_started_at = time.monotonic()
+
+
+class UnpacedPacer(Pacer):
+    """Starts the next turn right away."""
+
+    async def wait_for_next_turn(self) -> None:
+        # Still let the other tasks (e.g. the viewers' relays) run.
+        await curio.sleep(0)
+
+
+def make_pacer(interval: float) -> Pacer:
+    if interval <= 0:
+        return UnpacedPacer()
+    return FixedRatePacer(interval)
+
+
+def choose_turn_interval(
+    turn_delay: float,
+    turns_per_second: Optional[float],
+    has_viewers: bool,
+    unpaced_without_viewers: bool,
+) -> float:
+    """Choose the interval between turns in a room.
+
+    The rate set for the room wins. Otherwise, rooms nobody watches may run
+    as fast as possible if the server allows it, and the rest use the
+    server's turn delay.
+    """
+
+    if turns_per_second is not None:
+        assert math.isfinite(turns_per_second) and turns_per_second > 0
+        return 1 / turns_per_second
+    if unpaced_without_viewers and not has_viewers:
+        return 0.0
+    return turn_delay
@@ -0,0 +1,366 @@
+"""Recording games and playing them back.
+
+A replay does not store the field after every turn. It stores what is
+needed to simulate the game again: the game config, the seed of its random
+number generator and every action, so a long game takes about a byte per
+action. The initial field is stored as well, to make sure the simulation
+starts from the same position as the recorded game.
+
+The file starts with `MAGIC`, the format version and a CBOR header. The
+header is followed by records, which are appended as the game goes on:
+
+    0b0PPPPPDD                      MOVE of the player with index P (< 32) in direction D
+    0x80                            END_OF_ROUND
+    0x81 <player>                   KILL: the snake is removed (its client has left the game)
+    0x82 <player> <direction>       MOVE of a player with a larger index
+    0x83 <n>                        SIMULTANEOUS: the next n MOVE records are resolved together
+    0x84 <length> <CBOR>            EVENT reported to the clients
+
+Numbers in angle brackets are unsigned LEB128. The players are numbered in
+the order of the header's `players` list. A file cut short (e.g. by a
+crash of the server) is read up to the last complete record.
+"""
+
+from bot_arena_server.game import Game, IllegalAction
+from bot_arena_server.game_config import GameConfig
+from bot_arena_server.work_limit import WorkLimit
+
+import copy
+import random
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+import cbor2
+from bot_arena_proto.data import Direction, FieldState, FoodRespawnBehavior
+from bot_arena_proto.event import Event
+
+
+__all__ = [
+    'Replay',
+    'ReplayFormatError',
+    'ReplayWriter',
+]
+
+
+MAGIC = b'BAREPLAY'
+FORMAT_VERSION = 1
+
+# Opcodes below this one are short MOVE records.
+_MOVE = 0x00
+_END_OF_ROUND = 0x80
+_KILL = 0x81
+_MOVE_EXTENDED = 0x82
+_SIMULTANEOUS = 0x83
+_EVENT = 0x84
+
+_MAX_SHORT_PLAYER_INDEX = 31
+
+_DIRECTIONS = [Direction.UP(), Direction.DOWN(), Direction.LEFT(), Direction.RIGHT()]
+_DIRECTION_CODES = {direction: code for code, direction in enumerate(_DIRECTIONS)}
+
+# Events that can be computed from the field are not recorded.
+_UNRECORDED_EVENTS = {'GameScoreChanged'}
+
+
+class ReplayFormatError(Exception):
+    def __init__(self, description: str) -> None:
+        super().__init__()
+        self.description = description
+
+    def __str__(self) -> str:
+        return f'Invalid replay: {self.description}'
+
+
+def _encode_uint(value: int) -> bytes:
+    result = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value == 0:
+            result.append(byte)
+            return bytes(result)
+        result.append(byte | 0x80)
+
+
+def _config_to_primitive(config: GameConfig) -> Dict[str, Any]:
+    return {
+        'snake_len': config.snake_len,
+        'field_width': config.field_width,
+        'field_height': config.field_height,
+        'num_food_items': config.num_food_items,
+        'respawn_food': config.respawn_food.to_primitive(),
+        'max_turns': config.max_turns,
+        'field_storage': config.field_storage,
+    }
+
+
+def _config_from_primitive(p: Dict[str, Any]) -> GameConfig:
+    return GameConfig(
+        snake_len = p['snake_len'],
+        field_width = p['field_width'],
+        field_height = p['field_height'],
+        num_food_items = p['num_food_items'],
+        respawn_food = FoodRespawnBehavior.from_primitive(p['respawn_food']),
+        max_turns = p['max_turns'],
+        field_storage = p['field_storage'],
+    )
+
+
+class ReplayWriter:
+    """Appends the records of a game to a replay file.
+
+    The game must be created with `rng=random.Random(seed)` and recorded
+    from its very beginning. Writes are buffered, so recording a turn does
+    not wait for the disk.
+    """
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        game: Game,
+        seed: int,
+        simultaneous_moves: bool = False,
+        room_name: Optional[str] = None,
+    ) -> None:
+        self._file = file
+        players = list(game.snake_names())
+        self._player_indices = {name: i for i, name in enumerate(players)}
+        header = cbor2.dumps({
+            'room': room_name,
+            'config': _config_to_primitive(game.config),
+            'seed': seed,
+            'players': players,
+            'simultaneous_moves': simultaneous_moves,
+            'initial_field': game.field.get_state().to_primitive(),
+        })
+        self._file.write(MAGIC + bytes([FORMAT_VERSION]) + _encode_uint(len(header)) + header)
+
+    @staticmethod
+    def open(path: str, *args: Any, **kwargs: Any) -> 'ReplayWriter':
+        return ReplayWriter(open(path, 'wb', buffering=_WRITE_BUFFER_SIZE), *args, **kwargs)
+
+    def record_move(self, snake_name: str, direction: Direction) -> None:
+        self._file.write(self._encode_move(snake_name, direction))
+
+    def record_simultaneous_moves(self, moves: Dict[str, Direction]) -> None:
+        """Record the moves resolved together, in the order they are passed to the game."""
+
+        records = [bytes([_SIMULTANEOUS]), _encode_uint(len(moves))]
+        records.extend(self._encode_move(name, direction) for name, direction in moves.items())
+        self._file.write(b''.join(records))
+
+    def record_kill(self, snake_name: str) -> None:
+        self._file.write(bytes([_KILL]) + _encode_uint(self._player_indices[snake_name]))
+
+    def record_end_of_round(self) -> None:
+        self._file.write(bytes([_END_OF_ROUND]))
+
+    def record_event(self, event: Event) -> None:
+        if event.name in _UNRECORDED_EVENTS:
+            return
+        data = cbor2.dumps(event.to_primitive())
+        self._file.write(bytes([_EVENT]) + _encode_uint(len(data)) + data)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _encode_move(self, snake_name: str, direction: Direction) -> bytes:
+        player = self._player_indices[snake_name]
+        code = _DIRECTION_CODES[direction]
+        if player <= _MAX_SHORT_PLAYER_INDEX:
+            return bytes([player << 2 | code])
+        return bytes([_MOVE_EXTENDED]) + _encode_uint(player) + bytes([code])
+
+
+_WRITE_BUFFER_SIZE = 2**16
+
+
+# Records as decoded by the reader.
+_Record = Tuple[int, Any]
+
+
+class Replay:
+    """A recorded game that can show the field after any turn.
+
+    The field is computed by simulating the game from the nearest keyframe,
+    a copy of the game kept in memory every `keyframe_interval` turns. The
+    keyframes are taken as the simulation reaches them, so going back is
+    cheap, and going forward costs at most the turns not yet simulated.
+    """
+
+    def __init__(self, data: bytes, keyframe_interval: int = 1000) -> None:
+        if not data.startswith(MAGIC):
+            raise ReplayFormatError('not a replay file')
+        reader = _ByteReader(data, len(MAGIC))
+        try:
+            version = reader.read_byte()
+            if version != FORMAT_VERSION:
+                raise ReplayFormatError(f'unsupported format version {version}')
+            header = cbor2.loads(reader.read_bytes(reader.read_uint()))
+        except _Truncated:
+            raise ReplayFormatError('the header is incomplete')
+
+        self.room_name: Optional[str] = header['room']
+        self.config = _config_from_primitive(header['config'])
+        self.seed: int = header['seed']
+        self.players: List[str] = header['players']
+        self.simultaneous_moves: bool = header['simultaneous_moves']
+        self.initial_field = FieldState.from_primitive(header['initial_field'])
+        # (turn, event)
+        self.events: List[Tuple[int, Event]] = []
+
+        self._records: List[_Record] = []
+        # The index of the first record of each turn, and the end of the last one.
+        self._turn_starts = [0]
+        self._read_records(reader)
+
+        game = Game(self.players, self.config, WorkLimit(2**62), rng=random.Random(self.seed))
+        if game.field.get_state() != self.initial_field:
+            raise ReplayFormatError('the initial field cannot be reproduced with this version of the server')
+        self._keyframe_interval = keyframe_interval
+        self._keyframes: Dict[int, Game] = {0: game}
+
+    @staticmethod
+    def load(path: str, keyframe_interval: int = 1000) -> 'Replay':
+        with open(path, 'rb') as f:
+            return Replay(f.read(), keyframe_interval)
+
+    @property
+    def num_turns(self) -> int:
+        return len(self._turn_starts) - 1
+
+    def state_at(self, turn: int) -> FieldState:
+        """Return the field after the first `turn` turns (0 is the initial field)."""
+
+        return self.game_at(turn).field.get_state()
+
+    def game_at(self, turn: int) -> Game:
+        """Return the game as it was after the first `turn` turns.
+
+        The game is a copy owned by the caller.
+        """
+
+        if not 0 <= turn <= self.num_turns:
+            raise IndexError(f'Turn {turn} is out of range [0, {self.num_turns}]')
+
+        keyframe_turn = max(t for t in self._keyframes if t <= turn)
+        game = copy.deepcopy(self._keyframes[keyframe_turn])
+        for current_turn in range(keyframe_turn, turn):
+            for i in range(self._turn_starts[current_turn], self._turn_starts[current_turn + 1]):
+                self._apply(game, self._records[i])
+            next_turn = current_turn + 1
+            if next_turn % self._keyframe_interval == 0 and next_turn not in self._keyframes:
+                self._keyframes[next_turn] = copy.deepcopy(game)
+        return game
+
+    def _apply(self, game: Game, record: _Record) -> None:
+        kind, argument = record
+        try:
+            if kind == _MOVE:
+                player, direction = argument
+                game.field.move_snake(self.players[player], direction)
+            elif kind == _SIMULTANEOUS:
+                game.field.move_snakes_simultaneously({
+                    self.players[player]: direction
+                    for player, direction in argument
+                })
+            elif kind == _KILL:
+                game.kill_snake_off(self.players[argument])
+            elif kind == _END_OF_ROUND:
+                game.finish_turn()
+        except IllegalAction:
+            # The recorded game has rejected this action in the same way.
+            pass
+
+    def _read_records(self, reader: '_ByteReader') -> None:
+        while not reader.at_end():
+            start = reader.position
+            try:
+                record = self._read_record(reader)
+            except _Truncated:
+                # The rest of the file has not been written.
+                reader.position = start
+                break
+
+            if record is None:
+                continue
+            self._records.append(record)
+            if record[0] == _END_OF_ROUND:
+                self._turn_starts.append(len(self._records))
+
+        if self._turn_starts[-1] != len(self._records):
+            # The last turn has not been finished: the game has ended in the middle of it.
+            self._turn_starts.append(len(self._records))
+
+    def _read_record(self, reader: '_ByteReader') -> Optional[_Record]:
+        opcode = reader.read_byte()
+        if opcode < _END_OF_ROUND:
+            return _MOVE, (opcode >> 2, _DIRECTIONS[opcode & 3])
+        if opcode == _END_OF_ROUND:
+            return _END_OF_ROUND, None
+        if opcode == _KILL:
+            return _KILL, self._read_player(reader)
+        if opcode == _MOVE_EXTENDED:
+            player = self._read_player(reader)
+            return _MOVE, (player, self._read_direction(reader))
+        if opcode == _SIMULTANEOUS:
+            moves = []
+            for _ in range(reader.read_uint()):
+                kind, move = self._read_record(reader) or (None, None)
+                if kind != _MOVE:
+                    raise ReplayFormatError(f'a move is expected at offset {reader.position}')
+                moves.append(move)
+            return _SIMULTANEOUS, moves
+        if opcode == _EVENT:
+            event = Event.from_primitive(cbor2.loads(reader.read_bytes(reader.read_uint())))
+            self.events.append((self.num_turns, event))
+            return None
+        raise ReplayFormatError(f'unknown record 0x{opcode:02x} at offset {reader.position - 1}')
+
+    def _read_player(self, reader: '_ByteReader') -> int:
+        player = reader.read_uint()
+        if player >= len(self.players):
+            raise ReplayFormatError(f'no player with index {player}')
+        return player
+
+    def _read_direction(self, reader: '_ByteReader') -> Direction:
+        code = reader.read_byte()
+        if code >= len(_DIRECTIONS):
+            raise ReplayFormatError(f'invalid direction {code}')
+        return _DIRECTIONS[code]
+
+
+class _Truncated(Exception):
+    pass
+
+
+class _ByteReader:
+    def __init__(self, data: bytes, position: int = 0) -> None:
+        self.data = data
+        self.position = position
+
+    def at_end(self) -> bool:
+        return self.position >= len(self.data)
+
+    def read_byte(self) -> int:
+        if self.at_end():
+            raise _Truncated()
+        byte = self.data[self.position]
+        self.position += 1
+        return byte
+
+    def read_uint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            byte = self.read_byte()
+            value |= (byte & 0x7f) << shift
+            if byte & 0x80 == 0:
+                return value
+            shift += 7
+
+    def read_bytes(self, how_many: int) -> bytes:
+        if self.position + how_many > len(self.data):
+            raise _Truncated()
+        result = self.data[self.position : self.position + how_many]
+        self.position += how_many
+        return result
@@ -0,0 +1,125 @@
+from bot_arena_server.client_name import ClientName
+
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, cast
+
+from bot_arena_proto.data import RoomOpenness, RoomInfo
+
+
+__all__ = [
+    'RoomDirectory',
+    'RoomSummary',
+    'make_room_info',
+]
+
+
+@dataclass(frozen=True)
+class RoomSummary:
+    """What has to be known about a room to list it and to decide whether a client can join it.
+
+    The password of a password-protected room is not included.
+    """
+
+    id: str
+    name: str
+    players: List[str]
+    min_players: int
+    max_players: int
+    open: RoomOpenness
+    game_started: bool
+
+    def to_primitive(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'name': self.name,
+            'players': self.players,
+            'min_players': self.min_players,
+            'max_players': self.max_players,
+            'open': self.open.to_primitive(),
+            'game_started': self.game_started,
+        }
+
+    @classmethod
+    def from_primitive(Class, p: Dict[str, Any]) -> 'RoomSummary':
+        return Class(
+            id = p['id'],
+            name = p['name'],
+            players = p['players'],
+            min_players = p['min_players'],
+            max_players = p['max_players'],
+            open = RoomOpenness.from_primitive(p['open']),
+            game_started = p['game_started'],
+        )
+
+
+def make_room_info(summary: RoomSummary, invoking_client: ClientName) -> RoomInfo:
+    if summary.game_started:
+        # TODO: maybe make an exception for viewers?
+        can_join = 'no'
+    elif len(summary.players) + (1 if invoking_client.is_player() else 0) > summary.max_players:
+        can_join = 'no'
+    else:
+        can_join = summary.open.match(
+            open = lambda: 'yes',
+            closed = lambda: 'no',
+            whitelist = lambda whitelist: {False: 'no', True: 'yes'}[
+                invoking_client.is_player() and (str(invoking_client) in whitelist)
+            ],
+            password = lambda _: 'password',
+        ) # type: ignore
+
+    can_join = cast(str, can_join)
+
+    return RoomInfo(
+        id = summary.id,
+        name = summary.name,
+        min_players = summary.min_players,
+        max_players = summary.max_players,
+        players = summary.players,
+        can_join = can_join,
+    )
+
+
+class RoomDirectory:
+    """The rooms of all the workers of a sharded server, as last reported by the workers."""
+
+    def __init__(self, num_workers: int) -> None:
+        self._rooms: List[List[RoomSummary]] = [[] for _ in range(num_workers)]
+        self._next_worker = 0
+
+    def update(self, worker: int, rooms: List[RoomSummary]) -> None:
+        self._rooms[worker] = rooms
+
+    def list_room_infos(self, invoking_client: ClientName) -> Iterable[RoomInfo]:
+        for rooms in self._rooms:
+            for room in rooms:
+                yield make_room_info(room, invoking_client)
+
+    def find_room(self, room_name: str) -> Optional[int]:
+        """Return the worker that has a room with the given name or id."""
+
+        for worker, rooms in enumerate(self._rooms):
+            if any(room_name in (room.name, room.id) for room in rooms):
+                return worker
+        return None
+
+    def find_joinable_room(self, invoking_client: ClientName) -> Optional[int]:
+        """Return a worker that has a room the client can join without a password."""
+
+        for worker, rooms in enumerate(self._rooms):
+            if any(make_room_info(room, invoking_client).can_join == 'yes' for room in rooms):
+                return worker
+        return None
+
+    def least_loaded_worker(self) -> int:
+        """Return the worker with the fewest rooms.
+
+        Ties are broken in a round-robin fashion, so that the rooms created
+        before the workers report them are still spread out.
+        """
+
+        num_workers = len(self._rooms)
+        candidates = [(self._next_worker + i) % num_workers for i in range(num_workers)]
+        worker = min(candidates, key=lambda w: len(self._rooms[w]))
+        self._next_worker = (worker + 1) % num_workers
+        return worker
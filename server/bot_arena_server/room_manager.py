@@ -1,16 +1,24 @@
-from bot_arena_server import password_utils
+from bot_arena_server import metrics, password_utils
 from bot_arena_server.client_name import ClientName
+from bot_arena_server.field_storage import FIELD_STORAGE_KINDS
 from bot_arena_server.game import Game
 from bot_arena_server.game_config import GameConfig
 from bot_arena_server.game_room import GameRoom
 from bot_arena_server.limits import Limits, ConstraintNotMetError
+from bot_arena_server.pacing import choose_turn_interval
 from bot_arena_server.pubsub import PublishSubscribeService
+from bot_arena_server.replay import ReplayWriter
+from bot_arena_server.room_directory import RoomSummary, make_room_info
 from bot_arena_server.room_mapping import RoomMapping
+from bot_arena_server.tracing import NULL_TRACER, Tracer
 from bot_arena_server.work_limit import WorkLimit
 
 import copy
 import math
+import os
+import random
 import secrets
+import time
 from dataclasses import dataclass
 from typing import Dict, Set, Any, Tuple, List, Callable, Coroutine, Iterable, cast, Optional
 
@@ -127,6 +135,10 @@ class RoomDetails:
     open: RoomOpenness
     max_turns: Optional[int]
     turn_timeout_seconds: Optional[float]
+    # None means the server's default pace.
+    turns_per_second: Optional[float]
+    field_storage: str
+    simultaneous_moves: bool
     game_started: bool
 
     def strip_private_info(self) -> 'RoomDetails':
@@ -147,6 +159,7 @@ class RoomDetails:
             num_food_items = self.num_food_items,
             respawn_food = self.respawn_food,
             max_turns = self.max_turns,
+            field_storage = self.field_storage,
         )
 
 
@@ -178,6 +191,20 @@ class RoomManager:
         self._rooms: Dict[str, RoomDetails] = {}
         self._room_sync: Dict[str, RoomSyncObject] = {}
         self._limits = limits
+        self._change_listeners: List[Callable[[], None]] = []
+
+    def add_change_listener(self, listener: Callable[[], None]) -> None:
+        """Call `listener` whenever the list of rooms or a summary of a room changes."""
+
+        self._change_listeners.append(listener)
+
+    def _notify_changed(self) -> None:
+        num_playing = sum(1 for room in self._rooms.values() if room.game_started)
+        metrics.ROOMS.set(len(self._rooms) - num_playing, state='waiting')
+        metrics.ROOMS.set(num_playing, state='playing')
+
+        for listener in self._change_listeners:
+            listener()
 
     def create_room(self, invoking_client: ClientName) -> None:
         room_id = generate_room_id()
@@ -209,8 +236,12 @@ class RoomManager:
             max_turns = self._limits.max_turns.clamp(500),
             game_started = False,
             turn_timeout_seconds = self._limits.max_turn_timeout.clamp(None),
+            turns_per_second = None,
+            field_storage = 'hash',
+            simultaneous_moves = False,
         )
         self._room_sync[room_id] = RoomSyncObject()
+        self._notify_changed()
 
     def handle_room_quit(self, invoking_client: ClientName) -> None:
         # Precondition: client is in a room, where a game has not yet started.
@@ -225,6 +256,7 @@ class RoomManager:
         # is always in the room.
         self._mapping.remove_client_from_room(invoking_client)
         self._room_sync[room_id].readiness_set.discard(invoking_client)
+        self._notify_changed()
         remaining_clients = self._mapping.list_clients_in_a_room(room_id)
 
         # If nobody is left in the room, it should be deleted.
@@ -247,6 +279,7 @@ class RoomManager:
         self._alias_map.pop(room_id, None)
         self._room_sync.pop(room_id)
         self._rooms.pop(room_id)
+        self._notify_changed()
 
     def _rename_room(self, room_name: str, new_name: str) -> None:
         check_that_room_name_is_valid(new_name)
@@ -258,6 +291,7 @@ class RoomManager:
 
         self._alias_map[new_name] = room_id
         self._rooms[room_id].name = new_name
+        self._notify_changed()
 
     def room_name_to_id(self, room_name: str) -> str:
         return self._alias_map[room_name]
@@ -307,6 +341,7 @@ class RoomManager:
 
         logger.info('{!r} enters room {!r}', invoking_client, room_name)
         self._mapping.add_client_to_room(room_id, invoking_client)
+        self._notify_changed()
 
     def get_room_properties(self, invoking_client: ClientName) -> Dict[str, Any]:
         # Precondition: client must be in a room and a game must not have started there.
@@ -339,6 +374,9 @@ class RoomManager:
             'open': room.open,
             'max_turns': room.max_turns,
             'turn_timeout_seconds': room.turn_timeout_seconds,
+            'turns_per_second': room.turns_per_second,
+            'field_storage': room.field_storage,
+            'simultaneous_moves': room.simultaneous_moves,
         }
 
     def set_room_properties(self, invoking_client: ClientName, properties: Dict[str, Any]) -> None:
@@ -354,8 +392,11 @@ class RoomManager:
             raise Exception('You must be an admin to change room properties')
 
         # TODO: maybe introduce an all-or-nothing scheme?
-        for key, value in properties.items():
-            self._set_room_property(room_id, room, key, value)
+        try:
+            for key, value in properties.items():
+                self._set_room_property(room_id, room, key, value)
+        finally:
+            self._notify_changed()
 
     @wrap_constraint_not_met_exceptions
     def _set_room_property(self, room_id: str, room: RoomDetails, key: str, value: Any) -> None:
@@ -435,6 +476,21 @@ class RoomManager:
             self._limits.max_turn_timeout.validate(value)
             room.turn_timeout_seconds = value
 
+        elif key == 'turns_per_second':
+            if value is not None:
+                if not math.isfinite(value) or value <= 0:
+                    raise PropertyValueIsInvalid(key, 'must be finite, non-nan and positive')
+                self._limits.max_turns_per_second.validate(value)
+            room.turns_per_second = value
+
+        elif key == 'field_storage':
+            if value not in FIELD_STORAGE_KINDS:
+                raise PropertyValueIsInvalid(key, f'must be one of {FIELD_STORAGE_KINDS}')
+            room.field_storage = value
+
+        elif key == 'simultaneous_moves':
+            room.simultaneous_moves = value
+
         else:
             raise Exception(f'Invalid room property name: {key!r}')
 
@@ -474,24 +530,50 @@ class RoomManager:
             # TODO: shuffle for fairness.
             client_names = list(clients)
 
+            # Every game has its own random number generator, so that it can be replayed.
+            seed = secrets.randbits(64)
             game: Game = await curio.run_in_thread(
                 create_game,
                 client_names,
                 room.as_game_config(),
                 self._limits.work_units,
+                seed,
             )
+            replay = self._start_replay(game, seed, room_id, room_info.name, room.simultaneous_moves)
 
-            game_room = GameRoom(client_names, game, room_info.name, self._limits.turn_delay)
+            turn_interval = choose_turn_interval(
+                turn_delay = self._limits.turn_delay,
+                turns_per_second = room.turns_per_second,
+                has_viewers = any(not name.is_player() for name in client_names),
+                unpaced_without_viewers = self._limits.unpaced_without_viewers,
+            )
+            game_room = GameRoom(
+                client_names,
+                game,
+                room_info.name,
+                turn_interval,
+                write_timeout = self._limits.broadcast_write_timeout,
+                max_pending_events = self._limits.max_pending_events,
+                simultaneous_moves = room.simultaneous_moves,
+                spectator_buffer_size = self._limits.spectator_buffer_size,
+                tracer = Tracer() if self._limits.trace_dir is not None else NULL_TRACER,
+                replay = replay,
+            )
             game_room.set_turn_timeout(room.turn_timeout_seconds)
 
             await sync_object.pubsub.publish((game, game_room))
             logger.info('The game in the room {!r} is starting', room.name)
 
             room.game_started = True
+            self._notify_changed()
 
             async def coro() -> None:
-                await game_room.run_loop()
-                self.remove_room(room_info.name)
+                try:
+                    await game_room.run_loop()
+                    self.remove_room(room_info.name)
+                finally:
+                    if game_room.tracer.enabled:
+                        await self._save_trace(game_room.tracer, room_id)
 
             await curio.spawn(coro, daemon=True)
         else:
@@ -500,34 +582,50 @@ class RoomManager:
 
         return game, game_room
 
+    def _start_replay(
+        self,
+        game: Game,
+        seed: int,
+        room_id: str,
+        room_name: str,
+        simultaneous_moves: bool,
+    ) -> Optional[ReplayWriter]:
+        if self._limits.replay_dir is None:
+            return None
+
+        path = os.path.join(self._limits.replay_dir, make_game_file_name(room_id, '.replay'))
+        try:
+            replay = ReplayWriter.open(path, game, seed, simultaneous_moves, room_name)
+        except OSError as e:
+            logger.error('Failed to start recording the game to {!r}: {}', path, e)
+            return None
+        logger.info('Recording the game in the room {!r} to {!r}', room_name, path)
+        return replay
+
+    async def _save_trace(self, tracer: Tracer, room_id: str) -> None:
+        assert self._limits.trace_dir is not None
+        path = os.path.join(self._limits.trace_dir, make_game_file_name(room_id, '.json'))
+        try:
+            await curio.run_in_thread(tracer.write, path)
+        except OSError as e:
+            logger.error('Failed to save the trace of the game to {!r}: {}', path, e)
+        else:
+            logger.info('Saved the trace of the game to {!r}', path)
+
     def list_room_infos(self, invoking_client: ClientName) -> Iterable[RoomInfo]:
         for room_id in self._rooms.keys():
             yield self._get_room_info_unchecked(invoking_client, room_id)
 
+    def list_room_summaries(self) -> List[RoomSummary]:
+        return [self._get_room_summary_unchecked(room_id) for room_id in self._rooms.keys()]
+
     def _get_room_info_unchecked(self, invoking_client: ClientName, room_id: str) -> RoomInfo:
+        return make_room_info(self._get_room_summary_unchecked(room_id), invoking_client)
+
+    def _get_room_summary_unchecked(self, room_id: str) -> RoomSummary:
         room = self._rooms[room_id]
 
-        if room.game_started:
-            # TODO: maybe make an exception for viewers?
-            can_join = 'no'
-        elif (
-            self._mapping.count_players_in_a_room(room_id) + (1 if invoking_client.is_player() else 0)
-                > room.max_players
-        ):
-            can_join = 'no'
-        else:
-            can_join = room.open.match(
-                open = lambda: 'yes',
-                closed = lambda: 'no',
-                whitelist = lambda whitelist: {False: 'no', True: 'yes'}[
-                    invoking_client.is_player() and (str(invoking_client) in whitelist)
-                ],
-                password = lambda _: 'password',
-            ) # type: ignore
-
-        can_join = cast(str, can_join)
-
-        return RoomInfo(
+        return RoomSummary(
             id = room_id,
             name = room.name,
             min_players = room.min_players,
@@ -537,18 +635,30 @@ class RoomManager:
                 for x in self._mapping.list_clients_in_a_room(room_id)
                 if x.is_player()
             ],
-            can_join = can_join,
+            open = room.strip_private_info().open,
+            game_started = room.game_started,
         )
 
 
-def create_game(client_names: List[ClientName], game_config: GameConfig, work_limit: WorkLimit) -> Game:
+def create_game(
+    client_names: List[ClientName],
+    game_config: GameConfig,
+    work_limit: WorkLimit,
+    seed: int,
+) -> Game:
     return Game(
         [str(x) for x in client_names if x.is_player()],
         game_config,
         work_limit,
+        rng = random.Random(seed),
     )
 
 
+def make_game_file_name(room_id: str, extension: str) -> str:
+    # Room names are chosen by the clients, so they are not used in file names.
+    return f'game-{time.strftime("%Y%m%d-%H%M%S")}-{room_id}{extension}'
+
+
 def check_that_room_name_is_valid(room_name: str) -> None:
     if not is_room_name_valid(room_name):
         raise ValueError(f'Room name is invalid: {room_name!r}')
@@ -1,3 +1,4 @@
+from bot_arena_server import metrics
 from bot_arena_server.client_name import ClientName, RichClientInfo
 from bot_arena_server.control_flow import EnsureDisconnect
 from bot_arena_server.game import Game
@@ -36,12 +37,30 @@ class ClientWorker:
         self._should_terminate = False
 
     async def run(self) -> None:
-        while self.should_run():
-            await self.run_step()
+        state_name = self.state_name()
+        metrics.CONNECTIONS.inc(state=state_name)
+        try:
+            while self.should_run():
+                await self.run_step()
+                new_state_name = self.state_name()
+                if new_state_name != state_name:
+                    metrics.CONNECTIONS.dec(state=state_name)
+                    metrics.CONNECTIONS.inc(state=new_state_name)
+                    state_name = new_state_name
+        finally:
+            metrics.CONNECTIONS.dec(state=state_name)
 
     def should_run(self) -> bool:
         return not self._should_terminate
 
+    def state_name(self) -> str:
+        return self._state.match(
+            hub = lambda: 'hub',
+            room = lambda: 'room',
+            ready = lambda: 'ready',
+            game = lambda game, game_room: 'game',
+        ) # type: ignore
+
     async def run_step(self) -> None:
         try:
             await self._state.match(
@@ -169,9 +188,18 @@ class Server:
         self._room_manager = RoomManager(limits)
         self._limits = limits
 
-    def listen(self, host: str, port: int) -> None:
+    def listen(self, host: str, port: int, metrics_address: Optional[Tuple[str, int]] = None) -> None:
         logger.info('Listening on {}:{}', host, port)
-        curio.run(curio.tcp_server, host, port, self._handle_client)
+        curio.run(self._serve, host, port, metrics_address)
+
+    async def _serve(self, host: str, port: int, metrics_address: Optional[Tuple[str, int]]) -> None:
+        if metrics_address is not None:
+            metrics_host, metrics_port = metrics_address
+            await curio.spawn(metrics.serve_metrics, metrics_host, metrics_port, self._collect_metrics, daemon=True)
+        await curio.tcp_server(host, port, self._handle_client)
+
+    async def _collect_metrics(self) -> str:
+        return metrics.render([({}, metrics.REGISTRY.collect())])
 
     async def _handle_client(
         self,
@@ -193,26 +221,34 @@ class Server:
             logger.error('Protocol error: {}. Client dicsonnected', e)
 
     async def _try_handle_client_with_stream(self, stream: AsyncStream) -> None:
-        sess = ServerSession(stream)
+        sess = metrics.MeteredServerSession(stream)
         client_info = await sess.pre_initialize()
         try:
-            client_name = ClientName(client_info.name)
-            if client_name.is_player():
-                self._limits.max_client_name_len.validate(len(str(client_name)), 'your name length')
-            if client_name in self._client_infos:
-                raise Exception(f'Client {client_name!r} is already connected')
-            logger.info('{!r} joined the party', client_name)
+            client_name = self._admit_client(client_info)
             await sess.initialize_ok()
         except Exception as e:
             await sess.initialize_err(str(e))
             return
 
         client_rich_info = RichClientInfo(info=client_info, name=client_name)
+        await self._run_client_worker(ClientWorker(client_rich_info, self, sess))
+
+    def _admit_client(self, client_info: ClientInfo) -> ClientName:
+        client_name = ClientName(client_info.name)
+        if client_name.is_player():
+            self._limits.max_client_name_len.validate(len(str(client_name)), 'your name length')
+        if client_name in self._client_infos:
+            raise Exception(f'Client {client_name!r} is already connected')
+        logger.info('{!r} joined the party', client_name)
+        return client_name
+
+    async def _run_client_worker(self, worker: ClientWorker) -> None:
+        client_rich_info = worker._client_info
+        client_name = client_rich_info.name
         assert client_name not in self._client_infos
         self._client_infos[client_name] = client_rich_info
 
         try:
-            worker = ClientWorker(client_rich_info, self, sess)
             await worker.run()
         except EnsureDisconnect:
             return
@@ -0,0 +1,389 @@
+"""A server that runs the rooms in several worker processes.
+
+The front process accepts the connections, performs the handshakes and serves
+the clients while they are in the hub. When a client creates or enters a room,
+its connection is handed over to the worker that owns the room (the socket is
+passed over a Unix socket with `SCM_RIGHTS`, together with the data that has
+been received, but not consumed yet). When the client gets back to the hub
+(it leaves the room, fails to enter it or its game ends), the worker hands
+the connection back.
+
+The workers report their rooms to the front process whenever they change, so
+that the front process can list the rooms of all the workers and know where
+each room is. A new room is created by the worker that has the fewest rooms.
+"""
+
+from bot_arena_server import metrics
+from bot_arena_server.client_name import ClientName, RichClientInfo
+from bot_arena_server.control_channel import ControlChannel
+from bot_arena_server.game import Game
+from bot_arena_server.game_room import GameRoom
+from bot_arena_server.limits import Limits
+from bot_arena_server.room_directory import RoomDirectory, RoomSummary
+from bot_arena_server.server import Server, ClientWorker
+
+import itertools
+import multiprocessing
+import signal
+import socket
+from dataclasses import dataclass, field
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+import curio # type: ignore
+from bot_arena_proto.error import ProtocolError
+from bot_arena_proto.message import Message
+from bot_arena_proto.session import ServerSession, ClientInfo
+from loguru import logger # type: ignore
+
+
+__all__ = [
+    'ShardedServer',
+]
+
+
+ClientHandler = Callable[
+    [ServerSession, RichClientInfo, Game, GameRoom],
+    Coroutine[None, None, None],
+]
+
+
+@dataclass
+class Connection:
+    client_info: ClientInfo
+    name: ClientName
+    worker: Optional[int] = None
+
+
+@dataclass
+class MetricsRequest:
+    num_expected: int = 0
+    replies: Dict[int, List[metrics.Family]] = field(default_factory=dict)
+    all_received: curio.Event = field(default_factory=curio.Event)
+
+    async def add_reply(self, worker: int, families: List[metrics.Family]) -> None:
+        self.replies[worker] = families
+        if len(self.replies) >= self.num_expected:
+            await self.all_received.set()
+
+
+class ShardedServer(Server):
+    """The front process of a server with several worker processes."""
+
+    def __init__(self, client_handler: ClientHandler, limits: Limits, num_workers: int) -> None:
+        super().__init__(client_handler, limits)
+        self._num_workers = num_workers
+        self._directory = RoomDirectory(num_workers)
+        self._channels: List[ControlChannel] = []
+        self._connections: Dict[int, Connection] = {}
+        self._connection_ids = itertools.count()
+        self._worker_sockets: List[socket.socket] = []
+        self._metrics_requests: Dict[int, MetricsRequest] = {}
+        self._metrics_request_ids = itertools.count()
+
+    def listen(self, host: str, port: int, metrics_address: Optional[Tuple[str, int]] = None) -> None:
+        # The workers are forked before the event loop is started.
+        self._worker_sockets = self._start_workers()
+        logger.info('Listening on {}:{} with {} workers', host, port, self._num_workers)
+        curio.run(self._serve, host, port, metrics_address)
+
+    def _start_workers(self) -> List[socket.socket]:
+        context = multiprocessing.get_context('fork')
+        sockets: List[socket.socket] = []
+        for worker in range(self._num_workers):
+            front_socket, worker_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            process = context.Process(
+                target = run_worker,
+                args = (worker, worker_socket, sockets + [front_socket], self._client_handler, self._limits),
+                name = f'bot-arena-worker-{worker}',
+                daemon = True,
+            )
+            process.start()
+            worker_socket.close()
+            sockets.append(front_socket)
+        return sockets
+
+    async def _serve(self, host: str, port: int, metrics_address: Optional[Tuple[str, int]]) -> None:
+        self._channels = [ControlChannel(curio.io.Socket(sock)) for sock in self._worker_sockets]
+        for worker in range(self._num_workers):
+            await curio.spawn(self._listen_to_worker, worker, daemon=True)
+        await super()._serve(host, port, metrics_address)
+
+    async def _collect_metrics(self) -> str:
+        # Every process has its own metrics, so the workers are asked for theirs.
+        request_id = next(self._metrics_request_ids)
+        request = MetricsRequest()
+        self._metrics_requests[request_id] = request
+        request.num_expected = len(self._channels)
+        try:
+            for channel in self._channels:
+                try:
+                    await channel.send({'type': 'collect_metrics', 'request': request_id})
+                except OSError:
+                    request.num_expected -= 1
+            if len(request.replies) < request.num_expected:
+                await curio.ignore_after(self._metrics_timeout, request.all_received.wait())
+        finally:
+            self._metrics_requests.pop(request_id)
+
+        sources = [({'process': 'front'}, metrics.REGISTRY.collect())]
+        for worker, families in sorted(request.replies.items()):
+            sources.append(({'process': f'worker-{worker}'}, families))
+        return metrics.render(sources)
+
+    async def _handle_client(self, sock: curio.io.Socket, peer_address: Tuple[str, int]) -> None:
+        host, port = peer_address
+        logger.info('Connection from {}:{}', host, port)
+        sess = metrics.MeteredServerSession(sock.as_stream())
+        try:
+            client_info = await sess.pre_initialize()
+            try:
+                client_name = self._admit_client(client_info)
+                await sess.initialize_ok()
+            except Exception as e:
+                await sess.initialize_err(str(e))
+                return
+        except EOFError:
+            logger.error('Client closed connection abruptly')
+            return
+        except ProtocolError as e:
+            logger.error('Protocol error: {}. Client dicsonnected', e)
+            return
+
+        self._client_infos[client_name] = RichClientInfo(info=client_info, name=client_name)
+        connection_id = next(self._connection_ids)
+        self._connections[connection_id] = Connection(client_info, client_name)
+        await self._serve_in_hub(connection_id, sock, sess)
+
+    async def _serve_in_hub(self, connection_id: int, sock: curio.io.Socket, sess: ServerSession) -> None:
+        connection = self._connections[connection_id]
+        metrics.CONNECTIONS.inc(state='hub')
+        try:
+            while True:
+                msg = await sess.wait_for_hub_action()
+                worker = await self._choose_worker(msg, connection.name, sess)
+                if worker is not None:
+                    break
+        except Exception as e:
+            if isinstance(e, (EOFError, IOError)):
+                logger.info('{!r} disconnected', connection.name)
+            elif isinstance(e, ProtocolError):
+                logger.info('{!r} disconnected due to a protocol error: {}', connection.name, e)
+                try:
+                    await sess.respond_err(str(e))
+                except IOError:
+                    pass
+            else:
+                logger.error('{!r} disconnected due to an internal error: {}', connection.name, e)
+            self._forget_connection(connection_id)
+            return
+        finally:
+            metrics.CONNECTIONS.dec(state='hub')
+
+        # The worker handles the hub action itself, including the response to it.
+        sess.unread_message(msg)
+        connection.worker = worker
+        logger.debug('Handing {!r} over to worker {}', connection.name, worker)
+        try:
+            await self._channels[worker].send(
+                {
+                    'type': 'client',
+                    'connection': connection_id,
+                    'name': connection.client_info.name,
+                    'capabilities': connection.client_info.capabilities,
+                    'unread_data': sess.take_unread_data(),
+                },
+                fd = sock.fileno(),
+            )
+        except OSError as e:
+            logger.error('Cannot hand {!r} over to worker {}: {}', connection.name, worker, e)
+            self._forget_connection(connection_id)
+        await close_handed_over_socket(sock)
+
+    async def _choose_worker(self, msg: Message, client_name: ClientName, sess: ServerSession) -> Optional[int]:
+        """Return the worker that should handle the hub action, or handle it right away and return None."""
+
+        msg_type = msg.kind()
+        if msg_type == 'ListRooms':
+            await sess.respond_with_room_list(list(self._directory.list_room_infos(client_name)))
+            return None
+        elif msg_type == 'EnterRoom':
+            room_name, _ = msg.enter_room()
+            worker = self._directory.find_room(room_name)
+            if worker is None:
+                # The same response as from a single-process server.
+                await sess.respond_err(str(KeyError(room_name)))
+            return worker
+        elif msg_type == 'NewRoom':
+            return self._directory.least_loaded_worker()
+        elif msg_type == 'EnterAnyRoom':
+            worker = self._directory.find_joinable_room(client_name)
+            if worker is None:
+                worker = self._directory.least_loaded_worker()
+            return worker
+        else:
+            await sess.respond_err(f'Invalid hub action: {msg!r}')
+            return None
+
+    # How long to wait for the workers' metrics before responding without them.
+    _metrics_timeout = 2.0
+
+    async def _listen_to_worker(self, worker: int) -> None:
+        channel = self._channels[worker]
+        while True:
+            try:
+                message, fd = await channel.recv()
+            except EOFError:
+                break
+
+            msg_type = message['type']
+            if msg_type == 'rooms':
+                self._directory.update(worker, [RoomSummary.from_primitive(p) for p in message['rooms']])
+            elif msg_type == 'return':
+                assert fd is not None
+                await curio.spawn(self._serve_returned_client, message['connection'], fd, message['unread_data'], daemon=True)
+            elif msg_type == 'gone':
+                self._forget_connection(message['connection'])
+            elif msg_type == 'metrics':
+                request = self._metrics_requests.get(message['request'])
+                if request is not None:
+                    await request.add_reply(worker, message['families'])
+
+        logger.error('Worker {} has exited, its rooms and clients are lost', worker)
+        self._directory.update(worker, [])
+        for connection_id, connection in list(self._connections.items()):
+            if connection.worker == worker:
+                self._forget_connection(connection_id)
+
+    async def _serve_returned_client(self, connection_id: int, fd: int, unread_data: bytes) -> None:
+        sock = curio.io.Socket(socket.socket(fileno=fd))
+        try:
+            self._connections[connection_id].worker = None
+            sess = metrics.MeteredServerSession(sock.as_stream(), unread_data)
+            await self._serve_in_hub(connection_id, sock, sess)
+        finally:
+            await close_handed_over_socket(sock)
+
+    def _forget_connection(self, connection_id: int) -> None:
+        connection = self._connections.pop(connection_id)
+        self._client_infos.pop(connection.name)
+
+
+class ShardClientWorker(ClientWorker):
+    """Serves a client on a worker process until it gets back to the hub."""
+
+    def __init__(self, client_info: RichClientInfo, server: Server, sess: ServerSession) -> None:
+        super().__init__(client_info, server, sess)
+        self._has_run = False
+
+    async def run_step(self) -> None:
+        await super().run_step()
+        self._has_run = True
+
+    def should_run(self) -> bool:
+        # The first step handles the hub action the client has been handed over for.
+        return super().should_run() and not (self._has_run and self.is_in_hub())
+
+    def has_returned_to_hub(self) -> bool:
+        return not self._should_terminate and self.is_in_hub()
+
+    def is_in_hub(self) -> bool:
+        return self.state_name() == 'hub'
+
+
+class WorkerServer(Server):
+    """A worker process of a sharded server: runs the rooms and the games in them."""
+
+    def __init__(self, client_handler: ClientHandler, limits: Limits, worker: int, channel: ControlChannel) -> None:
+        super().__init__(client_handler, limits)
+        self._worker = worker
+        self._channel = channel
+        self._rooms_changed = curio.UniversalEvent()
+        self._room_manager.add_change_listener(self._on_rooms_changed)
+
+    def _on_rooms_changed(self) -> None:
+        self._rooms_changed.set()
+
+    async def serve(self) -> None:
+        await curio.spawn(self._publish_rooms, daemon=True)
+        while True:
+            try:
+                message, fd = await self._channel.recv()
+            except EOFError:
+                logger.info('Worker {}: the front process has exited', self._worker)
+                return
+
+            if message['type'] == 'client':
+                assert fd is not None
+                await curio.spawn(self._serve_client, message, fd, daemon=True)
+            elif message['type'] == 'collect_metrics':
+                await self._send_to_front({
+                    'type': 'metrics',
+                    'request': message['request'],
+                    'families': metrics.REGISTRY.collect(),
+                })
+
+    async def _publish_rooms(self) -> None:
+        while True:
+            await self._rooms_changed.wait()
+            self._rooms_changed.clear()
+            rooms = [summary.to_primitive() for summary in self._room_manager.list_room_summaries()]
+            await self._send_to_front({'type': 'rooms', 'rooms': rooms})
+
+    async def _send_to_front(self, message: Dict[str, Any], fd: Optional[int] = None) -> None:
+        try:
+            await self._channel.send(message, fd)
+        except OSError:
+            # The front process has exited, `serve` will return soon.
+            pass
+
+    async def _serve_client(self, message: Dict[str, Any], fd: int) -> None:
+        connection_id = message['connection']
+        sock = curio.io.Socket(socket.socket(fileno=fd))
+        try:
+            sess = metrics.MeteredServerSession(sock.as_stream(), message['unread_data'])
+            client_info = ClientInfo(name=message['name'], capabilities=message['capabilities'])
+            client_rich_info = RichClientInfo(info=client_info, name=ClientName(client_info.name))
+            worker = ShardClientWorker(client_rich_info, self, sess)
+            await self._run_client_worker(worker)
+
+            if worker.has_returned_to_hub():
+                await self._send_to_front(
+                    {
+                        'type': 'return',
+                        'connection': connection_id,
+                        'unread_data': sess.take_unread_data(),
+                    },
+                    fd = sock.fileno(),
+                )
+            else:
+                await self._send_to_front({'type': 'gone', 'connection': connection_id})
+        finally:
+            await close_handed_over_socket(sock)
+
+
+async def close_handed_over_socket(sock: curio.io.Socket) -> None:
+    # Unlike closing the socket with `async with`, this removes it from the
+    # event loop's selector first. Otherwise, as the connection stays open in
+    # the other process, its registration would outlive the descriptor and
+    # break the registration of the next socket that gets the same number.
+    await sock.close()
+
+
+def run_worker(
+    worker: int,
+    sock: socket.socket,
+    front_sockets: List[socket.socket],
+    client_handler: ClientHandler,
+    limits: Limits,
+) -> None:
+    # The front process' ends of the control channels are inherited, but must
+    # not be kept open here: the workers would not notice the front process exit.
+    for front_socket in front_sockets:
+        front_socket.close()
+
+    # Ctrl-C stops the front process, and the worker exits after it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    logger.info('Worker {} started', worker)
+    server = WorkerServer(client_handler, limits, worker, ControlChannel(curio.io.Socket(sock)))
+    curio.run(server.serve)
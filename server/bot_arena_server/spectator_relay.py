@@ -0,0 +1,95 @@
+import curio    # type: ignore
+
+import itertools
+from collections import deque
+from typing import Deque, Generic, List, Tuple, TypeVar
+
+
+__all__ = [
+    'SpectatorRelay',
+]
+
+
+_T = TypeVar('_T')
+
+
+class SpectatorRelay(Generic[_T]):
+    """A single channel of updates for all the viewers of a game.
+
+    The game room publishes every update once, without waiting for anyone,
+    and each viewer reads the updates at its own pace from its own task.
+    Updates are kept in a ring buffer of about `capacity` entries. A viewer
+    that falls further behind skips to the latest keyframe, i.e. an update
+    that does not depend on the previous ones.
+
+    The updates from the latest keyframe on are never evicted, so a lagging
+    viewer can always catch up, even if they do not fit into the buffer.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self._capacity = capacity
+        self._entries: Deque[_T] = deque()
+        # Position of the next update to be published. Positions are never reused.
+        self._end = 0
+        self._last_keyframe = 0
+        self._closed = False
+        # Replaced every time something is published, so that waiting for
+        # the next update does not need any bookkeeping of the readers.
+        self._published = curio.Event()
+
+    @property
+    def end(self) -> int:
+        """The position that a viewer joining right now should start reading from."""
+
+        return self._end
+
+    @property
+    def _start(self) -> int:
+        return self._end - len(self._entries)
+
+    async def publish(self, entry: _T, keyframe: bool = False) -> None:
+        if self._closed:
+            raise ValueError('Cannot publish to a closed spectator relay')
+
+        if keyframe:
+            self._last_keyframe = self._end
+        self._entries.append(entry)
+        self._end += 1
+        while len(self._entries) > self._capacity and self._start < self._last_keyframe:
+            self._entries.popleft()
+
+        await self._wake_up_readers()
+
+    async def close(self) -> None:
+        """Let the viewers know that there will be no more updates."""
+
+        self._closed = True
+        await self._wake_up_readers()
+
+    async def _wake_up_readers(self) -> None:
+        published = self._published
+        self._published = curio.Event()
+        await published.set()
+
+    async def read(self, position: int) -> Tuple[List[_T], int]:
+        """Wait for the updates starting from `position`.
+
+        Returns the updates and the position to continue reading from. If the
+        reader lags too far behind, some updates are skipped. An empty list
+        means that the relay is closed and there are no more updates.
+        """
+
+        while position >= self._end and not self._closed:
+            await self._published.wait()
+
+        if self._is_lagging(position):
+            position = self._last_keyframe
+
+        entries = list(itertools.islice(self._entries, position - self._start, None))
+        return entries, self._end
+
+    def _is_lagging(self, position: int) -> bool:
+        if position >= self._last_keyframe:
+            # Nothing to skip to.
+            return False
+        return position < self._start or self._end - position > self._capacity
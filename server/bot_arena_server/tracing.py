@@ -0,0 +1,102 @@
+"""Spans showing where the time of a game goes, in the Chrome trace-event format.
+
+A game traced with `Tracer` can be saved as JSON and opened in `chrome://tracing`,
+Perfetto or speedscope. The room loop and every player get a lane of their own,
+so a slow turn shows whether the time went to the client's thinking, to the
+game logic or to the broadcast.
+"""
+
+import json
+import os
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional
+
+
+__all__ = [
+    'NULL_TRACER',
+    'Tracer',
+]
+
+
+class Tracer:
+    """Records the spans of a single game."""
+
+    def __init__(self, max_events: int = 500000) -> None:
+        self._start = perf_counter()
+        self._pid = os.getpid()
+        self._max_events = max_events
+        self._events: List[Dict[str, Any]] = []
+        self._num_dropped_events = 0
+        # Lanes are shown as threads, in the order of appearance.
+        self._lanes: Dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return True
+
+    @contextmanager
+    def span(self, name: str, lane: str, **args: Any) -> Iterator[None]:
+        """Record the time spent inside the `with` block.
+
+        `args` (e.g. the turn number and the player) are shown along with the span.
+        """
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self._add_span(name, lane, start, perf_counter(), args)
+
+    def _add_span(self, name: str, lane: str, start: float, end: float, args: Dict[str, Any]) -> None:
+        if len(self._events) >= self._max_events:
+            self._num_dropped_events += 1
+            return
+        self._events.append({
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self._start) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self._pid,
+            'tid': self._lane_id(lane),
+            'args': args,
+        })
+
+    def _lane_id(self, lane: str) -> int:
+        lane_id = self._lanes.get(lane)
+        if lane_id is None:
+            lane_id = self._lanes[lane] = len(self._lanes)
+        return lane_id
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        lane_names = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': lane_id, 'args': {'name': lane}}
+            for lane, lane_id in self._lanes.items()
+        ]
+        return {
+            'traceEvents': lane_names + self._events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'dropped_events': self._num_dropped_events},
+        }
+
+    def write(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+class _NullTracer(Tracer):
+    """A tracer that records nothing, used when tracing is off."""
+
+    def __init__(self) -> None:
+        super().__init__(max_events=0)
+
+    @property
+    def enabled(self) -> bool:
+        return False
+
+    @contextmanager
+    def span(self, name: str, lane: str, **args: Any) -> Iterator[None]:
+        yield
+
+
+NULL_TRACER: Tracer = _NullTracer()
@@ -11,11 +11,12 @@ setup(
         'bot_arena_server': ['py.typed'],
     },
 
-    install_requires = ['bot-arena-proto ~= 1.0.1', 'curio', 'loguru'],
+    install_requires = ['bot-arena-proto ~= 1.1', 'cbor2', 'curio', 'loguru'],
 
     entry_points = {
         'console_scripts': [
             'bot-arena-server=bot_arena_server.__main__:main',
+            'bot-arena-batch=bot_arena_server.batch:main',
         ],
     }
 )
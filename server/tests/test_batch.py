@@ -0,0 +1,107 @@
+from bot_arena_server.batch import (
+    BatchJob,
+    SubprocessPolicy,
+    load_policy,
+    parse_args,
+    play_game,
+    random_policy,
+    run_batch,
+)
+from bot_arena_server.game_config import GameConfig
+from bot_arena_server.work_limit import WorkLimit
+
+import random
+
+import pytest
+from bot_arena_proto.data import Action, Direction, FieldState, FoodRespawnBehavior, Point, SnakeState, Object
+from bot_arena_proto.session import GameInfo
+
+
+def make_config(**kwargs) -> GameConfig:
+    params = dict(
+        snake_len = 3,
+        field_width = 10,
+        field_height = 10,
+        num_food_items = 3,
+        respawn_food = FoodRespawnBehavior.YES(),
+        max_turns = 50,
+    )
+    params.update(kwargs)
+    return GameConfig(**params)
+
+
+@pytest.mark.parametrize('simultaneous_moves', [False, True])
+def test_play_game(simultaneous_moves):
+    # Seeded: with some seeds all the snakes crash on the same turn, leaving no winners.
+    random.seed(1)
+    result = play_game(
+        {'A': random_policy, 'B': random_policy},
+        make_config(),
+        WorkLimit(999999),
+        simultaneous_moves = simultaneous_moves,
+    )
+    assert 1 <= result['turns'] <= 50
+    assert len(result['winners']) > 0
+    assert set(result['winners']) <= {'A', 'B'}
+
+
+def test_failing_policy_loses():
+    def failing_policy(name, state, info):
+        raise RuntimeError('oops')
+
+    result = play_game({'A': random_policy, 'B': failing_policy}, make_config(), WorkLimit(999999))
+    assert result['turns'] == 1
+    assert result['winners'] == ['A']
+
+
+def test_run_batch_is_reproducible():
+    jobs = [
+        BatchJob(
+            index = i,
+            seed = 42 + i,
+            bots = {'A': 'random', 'B': 'random', 'C': 'random'},
+            config = BatchJob.pack_config(make_config(respawn_food=FoodRespawnBehavior.RANDOM(0.5))),
+        )
+        for i in range(3)
+    ]
+
+    results = list(run_batch(jobs))
+    assert [result['game'] for result in results] == [0, 1, 2]
+    assert results == list(run_batch(jobs))
+
+
+def test_load_policy():
+    assert load_policy('random') is random_policy
+    assert load_policy('bot_arena_server.batch:random_policy') is random_policy
+    assert load_policy('exec:./bot').cmd == './bot'
+    with pytest.raises(ValueError):
+        load_policy('no_such_policy')
+
+
+def test_respawn_food_is_parsed(monkeypatch):
+    monkeypatch.setattr('sys.argv', ['bot-arena-batch', '--bot', 'A=random', '--respawn-food', '0.5'])
+    assert parse_args().respawn_food == 0.5
+
+
+@pytest.mark.parametrize('value', ['1.5', '-0.1', 'nan'])
+def test_respawn_food_must_be_probability(value, monkeypatch):
+    monkeypatch.setattr('sys.argv', ['bot-arena-batch', '--bot', 'A=random', '--respawn-food', value])
+    with pytest.raises(SystemExit):
+        parse_args()
+
+
+def test_subprocess_policy_input():
+    state = FieldState(
+        snakes = {
+            'A': SnakeState(head=Point(0, 0), tail=[Direction.RIGHT()]),
+            'B': SnakeState(head=Point(2, 1), tail=[Direction.UP()]),
+        },
+        objects = [(Point(0, 2), Object.FOOD())],
+    )
+    info = GameInfo(field_width=3, field_height=3)
+    assert SubprocessPolicy.encode_input('B', state, info) == '3 3 4 5 3 2 0 0 0 5 1 0 4\n'
+
+
+def test_subprocess_policy():
+    policy = SubprocessPolicy('echo 2')
+    assert policy('A', FieldState(snakes={}, objects=[]), GameInfo(1, 1)) == Action.MOVE(Direction.UP())
@@ -0,0 +1,12 @@
+from bot_arena_server.bench import BENCHMARKS, BenchCase, run_benchmarks
+from bot_arena_server.field_storage import FIELD_STORAGE_KINDS
+
+
+def test_benchmarks_run():
+    cases = [BenchCase(field_side=10, num_snakes=2, snake_len=3, field_storage=kind) for kind in FIELD_STORAGE_KINDS]
+    results = list(run_benchmarks(cases, BENCHMARKS.keys(), num_ops=5))
+    assert len(results) == len(cases) * len(BENCHMARKS)
+    for result in results:
+        assert result.ops_per_sec > 0
+        assert result.peak_bytes_per_op > 0
+        result.format()
@@ -1,23 +1,40 @@
 import copy
+import random
 
 from bot_arena_server.game import (
     _Snake,
     _points_to_directions,
     _directions_to_points,
     Field,
+    NoFreeCellsError,
     NoSuchSnakeError,
     MoveResult,
     ChangeInFreeCells,
+    SnakeStep,
     Game,
     Action,
     GameInfo,
     GameScore,
 )
+from bot_arena_server.field_storage import FIELD_STORAGE_KINDS, FreeCellIndex, GridFieldStorage
 from bot_arena_server.game_config import GameConfig
 from bot_arena_server.limits import WorkLimit
 
 import pytest
 from bot_arena_proto.data import Direction, Point, SnakeState, FieldState, Object, FoodRespawnBehavior
+from bot_arena_proto.message import Message
+
+
+# Every test in this module is run once for each field storage engine.
+_field_storage = 'hash'
+
+
+@pytest.fixture(autouse=True, params=FIELD_STORAGE_KINDS)
+def field_storage(request):
+    global _field_storage
+    _field_storage = request.param
+    yield request.param
+    _field_storage = 'hash'
 
 
 def make_default_config(**kwargs) -> GameConfig:
@@ -26,6 +43,7 @@ def make_default_config(**kwargs) -> GameConfig:
         num_food_items = 5,
         respawn_food = FoodRespawnBehavior.YES(),
         max_turns = None,
+        field_storage = _field_storage,
     )
 
     params.update(kwargs)
@@ -45,10 +63,9 @@ class TestSnake:
     def test_get_state_copies():
         snake = _Snake(head=Point(7, 3), tail=[Direction.RIGHT()])
         state_before = snake.get_state()
-        snake._head.y += 1
-        snake._tail.insert(0, Point(7, 3))
+        snake.grow(Direction.UP())
         assert snake._head == Point(7, 4)
-        assert snake._tail == [Point(7, 3), Point(8, 3)]
+        assert list(snake._tail) == [Point(7, 3), Point(8, 3)]
 
         # Just to make sure subsequent get_state() works fine
         state_after = snake.get_state()
@@ -65,31 +82,31 @@ class TestSnake:
     def test_grow():
         snake = _Snake(head=Point(2, 4), tail=[])
 
-        assert snake.grow(Direction.UP()) == ChangeInFreeCells([], [Point(2, 5)])
+        assert snake.grow(Direction.UP()) == SnakeStep(new_occupied=Point(2, 5))
         assert snake.get_state() == SnakeState(
             head = Point(2, 5),
             tail = [Direction.DOWN()],
         )
 
-        assert snake.grow(Direction.UP()) == ChangeInFreeCells([], [Point(2, 6)])
+        assert snake.grow(Direction.UP()) == SnakeStep(new_occupied=Point(2, 6))
         assert snake.get_state() == SnakeState(
             head = Point(2, 6),
             tail = [Direction.DOWN(), Direction.DOWN()],
         )
 
-        assert snake.grow(Direction.LEFT()) == ChangeInFreeCells([], [Point(1, 6)])
+        assert snake.grow(Direction.LEFT()) == SnakeStep(new_occupied=Point(1, 6))
         assert snake.get_state() == SnakeState(
             head = Point(1, 6),
             tail = [Direction.RIGHT(), Direction.DOWN(), Direction.DOWN()],
         )
 
-        assert snake.grow(Direction.DOWN()) == ChangeInFreeCells([], [Point(1, 5)])
+        assert snake.grow(Direction.DOWN()) == SnakeStep(new_occupied=Point(1, 5))
         assert snake.get_state() == SnakeState(
             head = Point(1, 5),
             tail = [Direction.UP(), Direction.RIGHT(), Direction.DOWN(), Direction.DOWN()],
         )
 
-        assert snake.grow(Direction.RIGHT()) == ChangeInFreeCells([], [Point(2, 5)])
+        assert snake.grow(Direction.RIGHT()) == SnakeStep(new_occupied=Point(2, 5))
         assert snake.get_state() == SnakeState(
             head = Point(2, 5),
             tail = [Direction.LEFT(), Direction.UP(), Direction.RIGHT(), Direction.DOWN(), Direction.DOWN()],
@@ -99,31 +116,31 @@ class TestSnake:
     def test_move():
         snake = _Snake(head=Point(2, 4), tail=[Direction.RIGHT(), Direction.DOWN(), Direction.LEFT()])
 
-        assert snake.move(Direction.UP()) == ChangeInFreeCells([Point(2, 3)], [Point(2, 5)])
+        assert snake.move(Direction.UP()) == SnakeStep(new_occupied=Point(2, 5), new_free=Point(2, 3))
         assert snake.get_state() == SnakeState(
             head = Point(2, 5),
             tail = [Direction.DOWN(), Direction.RIGHT(), Direction.DOWN()],
         )
 
-        assert snake.move(Direction.UP()) == ChangeInFreeCells([Point(3, 3)], [Point(2, 6)])
+        assert snake.move(Direction.UP()) == SnakeStep(new_occupied=Point(2, 6), new_free=Point(3, 3))
         assert snake.get_state() == SnakeState(
             head = Point(2, 6),
             tail = [Direction.DOWN(), Direction.DOWN(), Direction.RIGHT()],
         )
 
-        assert snake.move(Direction.LEFT()) == ChangeInFreeCells([Point(3, 4)], [Point(1, 6)])
+        assert snake.move(Direction.LEFT()) == SnakeStep(new_occupied=Point(1, 6), new_free=Point(3, 4))
         assert snake.get_state() == SnakeState(
             head = Point(1, 6),
             tail = [Direction.RIGHT(), Direction.DOWN(), Direction.DOWN()],
         )
 
-        assert snake.move(Direction.DOWN()) == ChangeInFreeCells([Point(2, 4)], [Point(1, 5)])
+        assert snake.move(Direction.DOWN()) == SnakeStep(new_occupied=Point(1, 5), new_free=Point(2, 4))
         assert snake.get_state() == SnakeState(
             head = Point(1, 5),
             tail = [Direction.UP(), Direction.RIGHT(), Direction.DOWN()],
         )
 
-        assert snake.move(Direction.RIGHT()) == ChangeInFreeCells([], [])
+        assert snake.move(Direction.RIGHT()) == SnakeStep(new_occupied=Point(2, 5), new_free=Point(2, 5))
         assert snake.get_state() == SnakeState(
             head = Point(2, 5),
             tail = [Direction.LEFT(), Direction.UP(), Direction.RIGHT()],
@@ -215,6 +232,42 @@ class TestField:
         assert set(state.objects) == set(objects)
         assert state.snakes == {name: snake.get_state() for name, snake in snakes.items()}
 
+    @staticmethod
+    def test_state_snapshot_is_reused():
+        snakes = {
+            'A': _Snake(head=Point(1, 1), tail=[Direction.DOWN()]),
+            'B': _Snake(head=Point(5, 5), tail=[Direction.LEFT(), Direction.LEFT()]),
+        }
+        config = make_default_config(field_width=10, field_height=10, respawn_food=FoodRespawnBehavior.NO())
+        field = Field(config=config, snakes=snakes, objects=[(Point(8, 8), Object.FOOD())])
+
+        snapshot = field.snapshot()
+        assert field.snapshot() is snapshot
+        assert field.get_state() is snapshot.state
+        assert snapshot.encode() is snapshot.encode()
+        assert Message.from_bytes(snapshot.encode()) == Message.NEW_FIELD_STATE(snapshot.state)
+        assert Message.from_bytes(snapshot.encode(compact=True)) == Message.NEW_COMPACT_FIELD_STATE(snapshot.state)
+
+        field.move_snake('A', Direction.UP())
+        new_snapshot = field.snapshot()
+        assert new_snapshot is not snapshot
+        assert new_snapshot.version > snapshot.version
+        assert new_snapshot.state.snakes == {
+            'A': SnakeState(head=Point(1, 2), tail=[Direction.DOWN()]),
+            'B': SnakeState(head=Point(5, 5), tail=[Direction.LEFT(), Direction.LEFT()]),
+        }
+        # The snake that has not moved is not converted again.
+        assert new_snapshot.state.snakes['B'] is snapshot.state.snakes['B']
+        # The old snapshot is left intact.
+        assert snapshot.state.snakes['A'] == SnakeState(head=Point(1, 1), tail=[Direction.DOWN()])
+
+        field.move_snake('A', Direction.UP())
+        field.kill_snake('B')
+        field.place_object_randomly(Object.FOOD())
+        state = field.get_state()
+        assert state.snakes == {'A': SnakeState(head=Point(1, 3), tail=[Direction.DOWN()])}
+        assert len(state.objects) == 2
+
     @staticmethod
     def test_random_free_cell():
         width = 5
@@ -592,6 +645,192 @@ class TestField:
             assert field.is_cell_completely_free(new_cell)
             assert not field_copy.is_cell_completely_free(new_cell)
 
+    @staticmethod
+    def test_place_object_on_almost_full_field():
+        width = 5
+        height = 6
+        snakes = {
+            'A': _Snake(head=Point(0, 0), tail=[Direction.RIGHT()] * (width - 1)),
+        }
+        objects = [
+            (Point(x, y), Object.FOOD())
+            for x in range(width)
+            for y in range(1, height)
+            if Point(x, y) != Point(3, 3)
+        ]
+
+        config = make_default_config(field_width=width, field_height=height)
+        field = Field(
+            config = config,
+            snakes = snakes,
+            objects = objects,
+        )
+
+        assert field.random_free_cell() == Point(3, 3)
+        field.place_object_randomly(Object.FOOD())
+        assert field._objects[Point(3, 3)] == Object.FOOD()
+        assert len(field._lost_objects) == 0
+
+        with pytest.raises(NoFreeCellsError):
+            field.random_free_cell()
+
+        field.place_object_randomly(Object.FOOD())
+        assert len(field._lost_objects) == 1
+
+    @staticmethod
+    def test_free_cell_index_follows_moves():
+        width = 6
+        height = 6
+        snakes = {
+            'A': _Snake(head=Point(2, 2), tail=[Direction.DOWN(), Direction.DOWN()]),
+            'B': _Snake(head=Point(4, 4), tail=[Direction.RIGHT()]),
+        }
+        objects = [(Point(2, 3), Object.FOOD())]
+
+        config = make_default_config(field_width=width, field_height=height)
+        field = Field(
+            config = config,
+            snakes = snakes,
+            objects = objects,
+        )
+
+        def check():
+            for x in range(width):
+                for y in range(height):
+                    cell = Point(x, y)
+                    assert (cell in field._free_cells) == field.is_cell_completely_free(cell)
+            assert len(field._free_cells) == field.num_free_cells()
+
+        check()
+        field.move_snake('A', Direction.UP())
+        check()
+        field.move_snake('A', Direction.LEFT())
+        check()
+        field.move_snake('B', Direction.LEFT())
+        check()
+        field.move_snake('B', Direction.RIGHT())
+        check()
+        field.kill_snake('A')
+        check()
+
+    @staticmethod
+    def test_take_delta():
+        config = make_default_config(field_width=8, field_height=8, snake_len=3, num_food_items=10)
+        game = Game(['A', 'B', 'C'], config, work_limit=WorkLimit(999999))
+        field = game.field
+
+        assert field.take_delta().is_empty()
+
+        directions = [Direction.UP(), Direction.DOWN(), Direction.LEFT(), Direction.RIGHT()]
+        state = field.get_state()
+        for i in range(200):
+            names = list(game.snake_names())
+            if len(names) == 0:
+                break
+            field.move_snake(random.choice(names), random.choice(directions))
+            if i == 7 and len(names) > 1:
+                field.kill_snake(names[1])
+
+            state = field.take_delta().apply_to(state)
+            expected_state = field.get_state()
+            assert state.snakes == expected_state.snakes
+            assert dict(state.objects) == dict(expected_state.objects)
+
+    @staticmethod
+    def test_move_snakes_simultaneously():
+        config = make_default_config(field_width=6, field_height=5, respawn_food=FoodRespawnBehavior.NO())
+
+        def make_field():
+            return Field(
+                config = config,
+                snakes = {
+                    'A': _Snake(head=Point(1, 2), tail=[Direction.LEFT()]),
+                    'B': _Snake(head=Point(3, 2), tail=[Direction.RIGHT(), Direction.RIGHT()]),
+                    'C': _Snake(head=Point(0, 1), tail=[Direction.DOWN()]),
+                },
+                objects = [(Point(2, 2), Object.FOOD())],
+            )
+
+        # Head-on collision: the longer snake survives and eats the food.
+        field = make_field()
+        results = field.move_snakes_simultaneously({'A': Direction.RIGHT(), 'B': Direction.LEFT()})
+        assert results == {'A': MoveResult.CRASH(), 'B': MoveResult.OK()}
+        assert set(field._snakes.keys()) == {'B', 'C'}
+        assert field._snakes['B'].get_state() == SnakeState(
+            head = Point(2, 2),
+            tail = [Direction.RIGHT(), Direction.RIGHT(), Direction.RIGHT()],
+        )
+        assert field._objects == {}
+        assert field.get_score().score['B'] == 1
+        assert field.is_cell_passable(Point(0, 2))
+        assert len(field._free_cells) == field.num_free_cells()
+
+        # A snake may move into the cell left by another snake's tail.
+        field = make_field()
+        results = field.move_snakes_simultaneously({'A': Direction.UP(), 'C': Direction.UP()})
+        assert results == {'A': MoveResult.OK(), 'C': MoveResult.OK()}
+        assert field._snakes['A'].get_state() == SnakeState(head=Point(1, 3), tail=[Direction.DOWN()])
+        assert field._snakes['C'].get_state() == SnakeState(head=Point(0, 2), tail=[Direction.DOWN()])
+        assert not field.is_cell_passable(Point(0, 2))
+        assert field.is_cell_passable(Point(0, 0))
+        assert len(field._free_cells) == field.num_free_cells()
+
+        # Swapping heads is a crash for both snakes, and so is moving into
+        # a snake that stays in place.
+        snakes = {
+            'A': _Snake(head=Point(1, 1), tail=[Direction.LEFT()]),
+            'B': _Snake(head=Point(2, 1), tail=[Direction.RIGHT()]),
+        }
+        field = Field(config=config, snakes=copy.deepcopy(snakes), objects=[])
+        results = field.move_snakes_simultaneously({'A': Direction.RIGHT(), 'B': Direction.LEFT()})
+        assert results == {'A': MoveResult.CRASH(), 'B': MoveResult.CRASH()}
+        assert field._snakes == {}
+        assert field.num_free_cells() == field.num_cells()
+
+        field = Field(config=config, snakes=copy.deepcopy(snakes), objects=[])
+        results = field.move_snakes_simultaneously({'A': Direction.RIGHT()})
+        assert results == {'A': MoveResult.CRASH()}
+        assert set(field._snakes.keys()) == {'B'}
+
+        # Snakes of length 1 leave their heads, but still cannot pass through each other.
+        snakes = {
+            'A': _Snake(head=Point(1, 1), tail=[]),
+            'B': _Snake(head=Point(2, 1), tail=[]),
+        }
+        field = Field(config=config, snakes=copy.deepcopy(snakes), objects=[])
+        results = field.move_snakes_simultaneously({'A': Direction.RIGHT(), 'B': Direction.LEFT()})
+        assert results == {'A': MoveResult.CRASH(), 'B': MoveResult.CRASH()}
+        assert field._snakes == {}
+        assert field.num_free_cells() == field.num_cells()
+
+        # Following a snake of length 1 is fine.
+        field = Field(config=config, snakes=copy.deepcopy(snakes), objects=[])
+        results = field.move_snakes_simultaneously({'A': Direction.RIGHT(), 'B': Direction.RIGHT()})
+        assert results == {'A': MoveResult.OK(), 'B': MoveResult.OK()}
+        assert field._snakes['A'].head == Point(2, 1)
+        assert field._snakes['B'].head == Point(3, 1)
+        assert len(field._free_cells) == field.num_free_cells()
+
+    @staticmethod
+    def test_move_snakes_simultaneously_take_delta():
+        config = make_default_config(field_width=8, field_height=8, snake_len=3, num_food_items=10)
+        game = Game(['A', 'B', 'C', 'D'], config, work_limit=WorkLimit(999999))
+        field = game.field
+
+        directions = [Direction.UP(), Direction.DOWN(), Direction.LEFT(), Direction.RIGHT()]
+        state = field.get_state()
+        for _ in range(100):
+            names = list(game.snake_names())
+            if len(names) == 0:
+                break
+            game.take_simultaneous_turn({name: Action.MOVE(random.choice(directions)) for name in names})
+
+            state = field.take_delta().apply_to(state)
+            expected_state = field.get_state()
+            assert state.snakes == expected_state.snakes
+            assert dict(state.objects) == dict(expected_state.objects)
+            assert len(field._free_cells) == field.num_free_cells()
+
     @staticmethod
     def test_score():
         snake_a = _Snake(head=Point(2, 4), tail=[Direction.LEFT()])
@@ -699,6 +938,61 @@ class TestField:
         assert len(field._objects) == 2
 
 
+class TestFreeCellIndex:
+    @staticmethod
+    def test_add_discard_sample():
+        index = FreeCellIndex(3, 2)
+        assert len(index) == 6
+
+        for x in range(3):
+            index.discard(Point(x, 0))
+        index.discard(Point(0, 0))
+        assert len(index) == 3
+        assert Point(1, 0) not in index
+        assert Point(1, 1) in index
+
+        samples = {index.sample() for _ in range(500)}
+        # P(false alarm) < 10^(-80)
+        assert samples == {Point(0, 1), Point(1, 1), Point(2, 1)}
+
+        index.add(Point(2, 0))
+        index.add(Point(2, 0))
+        assert len(index) == 4
+        assert Point(2, 0) in index
+
+        for x in range(3):
+            index.discard(Point(x, 1))
+        assert index.sample() == Point(2, 0)
+        index.discard(Point(2, 0))
+        assert index.sample() is None
+
+
+class TestGridFieldStorage:
+    @staticmethod
+    def test_cell_flags():
+        storage = GridFieldStorage(4, 3)
+        cell = Point(3, 2)
+        assert storage.is_completely_free(cell)
+
+        storage.occupy(cell)
+        storage.put_object(cell, Object.FOOD())
+        assert storage.is_occupied(cell)
+        assert storage.num_occupied() == 1
+        assert storage.get_object(cell) == Object.FOOD()
+
+        assert storage.pop_object(cell) == Object.FOOD()
+        assert storage.is_occupied(cell)
+        assert storage.get_object(cell) is None
+        assert not storage.is_completely_free(cell)
+
+        storage.release(cell)
+        assert storage.num_occupied() == 0
+        assert storage.is_completely_free(cell)
+        assert storage.is_completely_free(Point(2, 2))
+        with pytest.raises(KeyError):
+            storage.release(cell)
+
+
 class TestGame:
     @staticmethod
     def test_take_turn():
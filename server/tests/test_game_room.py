@@ -0,0 +1,157 @@
+from bot_arena_server.client_name import ClientName
+from bot_arena_server.game import Game
+from bot_arena_server.game_config import GameConfig
+from bot_arena_server.game_room import GameRoom
+from bot_arena_server.limits import WorkLimit
+from bot_arena_server.tracing import Tracer
+
+import curio
+from bot_arena_proto.data import FoodRespawnBehavior
+from bot_arena_proto.event import Event
+
+
+def async_run(f):
+    return lambda *args, **kwargs: curio.run(f(*args, **kwargs))
+
+
+class FakeSession:
+    def __init__(self, write_delay: float = 0.0) -> None:
+        self.write_delay = write_delay
+        self.frames = []
+
+    async def send_raw_frame(self, frame: bytes) -> None:
+        await curio.sleep(self.write_delay)
+        self.frames.append(frame)
+
+    async def send_raw_frames(self, frames) -> None:
+        await curio.sleep(self.write_delay)
+        self.frames.extend(frames)
+
+
+def make_game_room(names, **kwargs) -> GameRoom:
+    config = GameConfig(
+        snake_len = 2,
+        field_width = 10,
+        field_height = 10,
+        num_food_items = 1,
+        respawn_food = FoodRespawnBehavior.NO(),
+        max_turns = None,
+    )
+    game = Game([str(name) for name in names if name.is_player()], config, work_limit=WorkLimit(999999))
+    return GameRoom(names, game, 'test', turn_delay=0.0, **kwargs)
+
+
+class TestBroadcast:
+    @staticmethod
+    @async_run
+    async def test_slow_client_does_not_stall_others():
+        names = [ClientName('A'), ClientName('B'), ClientName('C')]
+        room = make_game_room(names, write_timeout=0.5)
+        sessions = {
+            names[0]: FakeSession(),
+            names[1]: FakeSession(write_delay=999),
+            names[2]: FakeSession(write_delay=0.1),
+        }
+        for name, session in sessions.items():
+            room.set_session(name, session)
+
+        start = await curio.clock()
+        await room.broadcast(lambda context: context.session.send_raw_frame(b'frame'), lambda name: True)
+        elapsed = await curio.clock() - start
+
+        assert elapsed < 1.0
+        assert sessions[names[0]].frames == [b'frame']
+        assert sessions[names[1]].frames == []
+        assert sessions[names[2]].frames == [b'frame']
+
+        # The slow client gets disconnected and is skipped from now on.
+        assert await room._clients[names[1]].sync_queue.get() == 'disconnect'
+        await room.broadcast(lambda context: context.session.send_raw_frame(b'next'), lambda name: True)
+        assert sessions[names[1]].frames == []
+        assert sessions[names[0]].frames == [b'frame', b'next']
+
+    @staticmethod
+    @async_run
+    async def test_client_with_too_many_pending_events_is_dropped():
+        names = [ClientName('A'), ClientName('B')]
+        room = make_game_room(names, max_pending_events=2)
+        sessions = {name: FakeSession() for name in names}
+        for name, session in sessions.items():
+            room.set_session(name, session)
+
+        event = Event(name='Test', data=None, must_know=False)
+        with room.lock_events_for(names[1]):
+            for _ in range(3):
+                await room.broadcast_event(event, lambda name: True)
+                await room._flush_event_queues()
+
+        assert await room._clients[names[1]].sync_queue.get() == 'disconnect'
+        assert len(sessions[names[0]].frames) == 3
+
+    @staticmethod
+    @async_run
+    async def test_viewers_are_served_by_the_relay():
+        names = [ClientName('A'), ClientName('@viewer'), ClientName('@viewer')]
+        room = make_game_room(names, write_timeout=0.5)
+        sessions = {
+            names[0]: FakeSession(),
+            names[1]: FakeSession(),
+            names[2]: FakeSession(write_delay=999),
+        }
+        for name, session in sessions.items():
+            room.set_session(name, session)
+        relay_tasks = [await curio.spawn(room.serve_viewer, name) for name in names[1:]]
+
+        start = await curio.clock()
+        await room.broadcast_event(Event(name='Test', data=None, must_know=False), lambda name: True)
+        await room._flush_event_queues()
+        await room.broadcast_field_update(room.capture_field_update())
+        elapsed = await curio.clock() - start
+
+        # The players do not wait for the viewers, not even for the slow one.
+        assert elapsed < 0.5
+        assert len(sessions[names[0]].frames) == 2
+
+        await room._spectator_relay.close()
+        await relay_tasks[0].join()
+        assert sessions[names[1]].frames == sessions[names[0]].frames
+        await relay_tasks[1].cancel()
+
+    @staticmethod
+    @async_run
+    async def test_viewer_skips_updates_in_its_initial_state():
+        names = [ClientName('A'), ClientName('@viewer')]
+        room = make_game_room(names)
+        sessions = {name: FakeSession() for name in names}
+        room.set_session(names[0], sessions[names[0]])
+
+        early_update = room.capture_field_update()
+        # The viewer's initial state already includes the early update.
+        room.set_session(names[1], sessions[names[1]])
+        relay_task = await curio.spawn(room.serve_viewer, names[1])
+        await room.broadcast_field_update(early_update)
+        late_update = room.capture_field_update()
+        await room.broadcast_field_update(late_update)
+
+        await room._spectator_relay.close()
+        await relay_task.join()
+        player, viewer = room._clients[names[0]], room._clients[names[1]]
+        assert sessions[names[0]].frames == [early_update.encode_for(player), late_update.encode_for(player)]
+        assert sessions[names[1]].frames == [late_update.encode_for(viewer)]
+
+
+class TestTracing:
+    @staticmethod
+    @async_run
+    async def test_broadcasts_are_traced():
+        names = [ClientName('A'), ClientName('B')]
+        tracer = Tracer()
+        room = make_game_room(names, tracer=tracer)
+        for name in names:
+            room.set_session(name, FakeSession())
+
+        await room.broadcast(lambda context: context.session.send_raw_frame(b'frame'), lambda name: True)
+
+        [span] = [event for event in tracer.to_chrome_trace()['traceEvents'] if event['ph'] == 'X']
+        assert span['name'] == 'broadcast'
+        assert span['args'] == {'room': 'test', 'turn': 0, 'recipients': 2}
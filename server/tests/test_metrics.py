@@ -0,0 +1,153 @@
+from bot_arena_server import metrics
+from bot_arena_server.game import FieldSnapshot
+from bot_arena_server.game_room import encode_snapshot
+from bot_arena_server.metrics import Counter, Gauge, Histogram, MeteredServerSession, MetricsRegistry, render
+
+import socket
+
+import curio
+from bot_arena_proto.data import Action, Direction, FieldState, Object, Point
+from bot_arena_proto.message import Message
+
+
+def async_run(f):
+    return lambda *args, **kwargs: curio.run(f(*args, **kwargs))
+
+
+class ScriptedStream:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.writes = []
+
+    async def read(self, size: int) -> bytes:
+        if len(self.chunks) == 0:
+            return b''
+        return self.chunks.pop(0)
+
+    async def write(self, data: bytes) -> None:
+        self.writes.append(data)
+
+
+def make_frame(message: Message) -> bytes:
+    data = message.to_bytes()
+    return len(data).to_bytes(8, 'little') + data
+
+
+class TestExposition:
+    @staticmethod
+    def test_metrics_are_rendered():
+        registry = MetricsRegistry()
+        counter = registry.register(Counter('requests_total', 'Requests', ['kind']))
+        gauge = registry.register(Gauge('temperature', 'Current "temperature"\nin degrees'))
+        histogram = registry.register(Histogram('latency_seconds', 'Latency', [0.1, 1.0]))
+
+        counter.inc(kind='a')
+        counter.inc(2, kind='b"c')
+        gauge.set(2.5)
+        for value in [0.05, 0.1, 0.5, 7.0]:
+            histogram.observe(value)
+
+        assert render([({}, registry.collect())]) == (
+            '# HELP requests_total Requests\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{kind="a"} 1\n'
+            'requests_total{kind="b\\"c"} 2\n'
+            '# HELP temperature Current "temperature"\\nin degrees\n'
+            '# TYPE temperature gauge\n'
+            'temperature 2.5\n'
+            '# HELP latency_seconds Latency\n'
+            '# TYPE latency_seconds histogram\n'
+            'latency_seconds_bucket{le="0.1"} 2\n'
+            'latency_seconds_bucket{le="1"} 3\n'
+            'latency_seconds_bucket{le="+Inf"} 4\n'
+            'latency_seconds_sum 7.65\n'
+            'latency_seconds_count 4\n'
+        )
+
+    @staticmethod
+    def test_sources_are_merged():
+        registry = MetricsRegistry()
+        gauge = registry.register(Gauge('rooms', 'Rooms', ['state']))
+        gauge.set(1, state='playing')
+        first = registry.collect()
+        gauge.set(3, state='playing')
+        second = registry.collect()
+
+        assert render([({'process': 'a'}, first), ({'process': 'b'}, second)]) == (
+            '# HELP rooms Rooms\n'
+            '# TYPE rooms gauge\n'
+            'rooms{process="a",state="playing"} 1\n'
+            'rooms{process="b",state="playing"} 3\n'
+        )
+
+
+class TestMeteredServerSession:
+    @staticmethod
+    @async_run
+    async def test_traffic_and_decoding_are_measured():
+        received_before = metrics.RECEIVED_BYTES.get()
+        sent_before = metrics.SENT_BYTES.get()
+        decoded_before = metrics.DECODE_DURATION.get_count(kind='Act')
+        encoded_before = metrics.ENCODE_DURATION.get_count(kind='Ok')
+
+        frame = make_frame(Message.ACT(Action.MOVE(Direction.UP())))
+        stream = ScriptedStream([frame])
+        sess = MeteredServerSession(stream)
+        assert await sess.recv_message() == Message.ACT(Action.MOVE(Direction.UP()))
+        await sess.respond_ok()
+
+        assert metrics.RECEIVED_BYTES.get() - received_before == len(frame)
+        assert metrics.SENT_BYTES.get() - sent_before == len(stream.writes[0])
+        assert metrics.DECODE_DURATION.get_count(kind='Act') - decoded_before == 1
+        assert metrics.ENCODE_DURATION.get_count(kind='Ok') - encoded_before == 1
+
+
+class TestSnapshotEncoding:
+    @staticmethod
+    def test_each_encoding_is_measured_once():
+        snapshot = FieldSnapshot(version=0, state=FieldState(snakes={}, objects=[(Point(1, 2), Object.FOOD())]))
+        full_before = metrics.ENCODE_DURATION.get_count(kind='NewFieldState')
+        compact_before = metrics.ENCODE_DURATION.get_count(kind='NewCompactFieldState')
+
+        for _ in range(3):
+            assert Message.from_bytes(encode_snapshot(snapshot, compact=False)) == Message.NEW_FIELD_STATE(snapshot.state)
+            encode_snapshot(snapshot, compact=True)
+
+        assert metrics.ENCODE_DURATION.get_count(kind='NewFieldState') - full_before == 1
+        assert metrics.ENCODE_DURATION.get_count(kind='NewCompactFieldState') - compact_before == 1
+
+
+class TestMetricsEndpoint:
+    @staticmethod
+    @async_run
+    async def test_metrics_are_served_over_http():
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+
+        async def collect() -> str:
+            return 'some_metric 1\n'
+
+        server_task = await curio.spawn(metrics.serve_metrics, '127.0.0.1', port, collect)
+        await curio.sleep(0.1)
+
+        async def get(path: str) -> bytes:
+            sock = await curio.open_connection('127.0.0.1', port)
+            async with sock:
+                await sock.sendall(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode('ascii'))
+                response = b''
+                while True:
+                    data = await sock.recv(4096)
+                    if len(data) == 0:
+                        return response
+                    response += data
+
+        response = await get('/metrics')
+        assert response.startswith(b'HTTP/1.0 200 OK\r\n')
+        assert b'Content-Type: text/plain; version=0.0.4' in response
+        assert response.endswith(b'\r\n\r\nsome_metric 1\n')
+
+        response = await get('/')
+        assert response.startswith(b'HTTP/1.0 404 ')
+
+        await server_task.cancel()
@@ -0,0 +1,96 @@
+from bot_arena_server.client_name import ClientName
+from bot_arena_server.limits import Limits, UpperBound, OptionalUpperBound, Range
+from bot_arena_server.pacing import FixedRatePacer, UnpacedPacer, choose_turn_interval, make_pacer
+from bot_arena_server.room_manager import PropertyValueIsInvalid, RoomManager
+from bot_arena_server.work_limit import WorkLimit
+
+import curio
+
+
+def async_run(f):
+    return lambda *args, **kwargs: curio.run(f(*args, **kwargs))
+
+
+def make_limits(**kwargs) -> Limits:
+    return Limits(
+        field_side_limits = Range(5, 200),
+        max_client_name_len = UpperBound(50),
+        max_food_items = UpperBound(50),
+        max_password_len = UpperBound(500),
+        max_players_in_a_room = UpperBound(20),
+        max_room_name_len = UpperBound(50),
+        max_snake_len = UpperBound(50),
+        max_turn_timeout = OptionalUpperBound(None),
+        max_turns = OptionalUpperBound(None),
+        turn_delay = 0.1,
+        work_units = WorkLimit(500),
+        **kwargs,
+    )
+
+
+class TestPacers:
+    @staticmethod
+    @async_run
+    async def test_time_taken_by_the_turn_is_subtracted():
+        pacer = FixedRatePacer(0.1)
+        pacer.start()
+        start = await curio.clock()
+        for _ in range(3):
+            # The turn itself takes most of the interval.
+            await curio.sleep(0.08)
+            await pacer.wait_for_next_turn()
+        elapsed = await curio.clock() - start
+
+        assert 0.3 <= elapsed < 0.36
+
+    @staticmethod
+    @async_run
+    async def test_slow_turns_are_not_caught_up_on():
+        pacer = FixedRatePacer(0.05)
+        pacer.start()
+        await curio.sleep(0.2)
+        await pacer.wait_for_next_turn()
+
+        # The next turn waits the full interval instead of starting right away.
+        start = await curio.clock()
+        await pacer.wait_for_next_turn()
+        assert await curio.clock() - start >= 0.04
+
+    @staticmethod
+    def test_zero_interval_means_no_pacing():
+        assert isinstance(make_pacer(0.0), UnpacedPacer)
+        assert isinstance(make_pacer(0.1), FixedRatePacer)
+
+
+class TestTurnInterval:
+    @staticmethod
+    def test_room_rate_wins():
+        assert choose_turn_interval(0.1, 4.0, has_viewers=False, unpaced_without_viewers=True) == 0.25
+        assert choose_turn_interval(0.1, 4.0, has_viewers=True, unpaced_without_viewers=False) == 0.25
+
+    @staticmethod
+    def test_games_without_viewers_may_run_unpaced():
+        assert choose_turn_interval(0.1, None, has_viewers=False, unpaced_without_viewers=True) == 0.0
+        assert choose_turn_interval(0.1, None, has_viewers=True, unpaced_without_viewers=True) == 0.1
+        assert choose_turn_interval(0.1, None, has_viewers=False, unpaced_without_viewers=False) == 0.1
+
+
+class TestTurnRateProperty:
+    @staticmethod
+    def test_rate_is_validated():
+        manager = RoomManager(make_limits(max_turns_per_second=OptionalUpperBound(20.0)))
+        manager.create_room(ClientName('A'))
+        assert manager.get_room_properties(ClientName('A'))['turns_per_second'] is None
+
+        manager.set_room_properties(ClientName('A'), {'turns_per_second': 5.0})
+        assert manager.get_room_properties(ClientName('A'))['turns_per_second'] == 5.0
+
+        for value in [0.0, -1.0, float('inf'), float('nan'), 50.0]:
+            try:
+                manager.set_room_properties(ClientName('A'), {'turns_per_second': value})
+                assert False, 'PropertyValueIsInvalid expected'
+            except PropertyValueIsInvalid:
+                pass
+
+        manager.set_room_properties(ClientName('A'), {'turns_per_second': None})
+        assert manager.get_room_properties(ClientName('A'))['turns_per_second'] is None
@@ -0,0 +1,120 @@
+from bot_arena_server.game import Game, IllegalAction
+from bot_arena_server.game_config import GameConfig
+from bot_arena_server.limits import WorkLimit
+from bot_arena_server.replay import Replay, ReplayFormatError, ReplayWriter
+
+import io
+import random
+
+from bot_arena_proto.data import Action, Direction, FoodRespawnBehavior
+from bot_arena_proto.event import Event
+
+
+DIRECTIONS = [Direction.UP(), Direction.DOWN(), Direction.LEFT(), Direction.RIGHT()]
+
+
+class UnclosableBytesIO(io.BytesIO):
+    def close(self) -> None:
+        pass
+
+
+def make_game(seed: int) -> Game:
+    config = GameConfig(
+        snake_len = 3,
+        field_width = 20,
+        field_height = 20,
+        num_food_items = 6,
+        respawn_food = FoodRespawnBehavior.RANDOM(0.3),
+        max_turns = None,
+    )
+    return Game(['A', 'B', 'C'], config, WorkLimit(999999), rng=random.Random(seed))
+
+
+def choose_direction(game: Game, name: str, rng: random.Random) -> Direction:
+    head = game.field.get_state().snakes[name].head
+    safe_directions = [d for d in DIRECTIONS if game.field.is_cell_passable(head.shift(d))]
+    return rng.choice(safe_directions or DIRECTIONS)
+
+
+def play_and_record(simultaneous_moves: bool, num_rounds: int = 60):
+    """Play a game with random moves, returning the replay and the field after every round."""
+
+    seed = 1234
+    game = make_game(seed)
+    f = UnclosableBytesIO()
+    writer = ReplayWriter(f, game, seed, simultaneous_moves, room_name='room')
+    moves_rng = random.Random(5)
+    states = [game.field.get_state()]
+
+    for turn in range(num_rounds):
+        if turn == 10 and 'C' in game.snake_names():
+            writer.record_kill('C')
+            writer.record_event(Event(name='ClientDisconnected', data='C', must_know=False))
+            game.kill_snake_off('C')
+
+        names = list(game.snake_names())
+        if simultaneous_moves:
+            moves = {name: choose_direction(game, name, moves_rng) for name in names}
+            writer.record_simultaneous_moves(moves)
+            game.take_simultaneous_turn({name: Action.MOVE(d) for name, d in moves.items()})
+        else:
+            for name in names:
+                if name not in game.snake_names():
+                    continue
+                direction = choose_direction(game, name, moves_rng)
+                writer.record_move(name, direction)
+                try:
+                    game.take_turn(name, Action.MOVE(direction))
+                except IllegalAction:
+                    pass
+        game.finish_turn()
+        writer.record_end_of_round()
+        states.append(game.field.get_state())
+
+    writer.close()
+    return f.getvalue(), states
+
+
+class TestReplay:
+    @staticmethod
+    def test_fields_are_reproduced():
+        for simultaneous_moves in [False, True]:
+            data, states = play_and_record(simultaneous_moves)
+            replay = Replay(data, keyframe_interval=7)
+
+            assert replay.players == ['A', 'B', 'C']
+            assert replay.room_name == 'room'
+            assert replay.simultaneous_moves == simultaneous_moves
+            assert replay.num_turns == len(states) - 1
+            assert replay.events == [(10, Event(name='ClientDisconnected', data='C', must_know=False))]
+
+            assert len(states[-1].snakes) > 0
+            # Seeking both forward and backward.
+            for turn in [35, 0, 60, 12, 13, 48, 6]:
+                assert replay.state_at(turn) == states[turn]
+
+    @staticmethod
+    def test_actions_take_about_a_byte():
+        data, _ = play_and_record(simultaneous_moves=False, num_rounds=1000)
+        header_size = len(ReplayWriter(UnclosableBytesIO(), make_game(1234), 1234, room_name='room')._file.getvalue())
+        # At most 3 moves and the end of the round per turn, plus the kill and its event.
+        assert len(data) - header_size <= 1000 * 4 + 100
+
+    @staticmethod
+    def test_incomplete_record_is_ignored():
+        data, states = play_and_record(simultaneous_moves=False, num_rounds=5)
+        # Cut the file in the middle of the last record (an extended record would
+        # be cut too, but a short one is just dropped).
+        replay = Replay(data[:-1])
+        assert replay.num_turns == 5
+        assert replay.state_at(4) == states[4]
+
+    @staticmethod
+    def test_invalid_files_are_rejected():
+        data, _ = play_and_record(simultaneous_moves=False, num_rounds=1)
+        for bad_data in [b'', b'NOTAREPLAY', data[:12], data + b'\xff']:
+            try:
+                Replay(bad_data)
+                assert False, 'ReplayFormatError expected'
+            except ReplayFormatError:
+                pass
@@ -0,0 +1,150 @@
+from bot_arena_server.client_name import ClientName
+from bot_arena_server.control_channel import ControlChannel
+from bot_arena_server.limits import Limits, UpperBound, OptionalUpperBound, Range
+from bot_arena_server.room_directory import RoomDirectory, RoomSummary
+from bot_arena_server.room_manager import RoomManager
+from bot_arena_server.work_limit import WorkLimit
+
+import os
+import socket
+
+import curio
+from bot_arena_proto.data import RoomOpenness
+
+
+def async_run(f):
+    return lambda *args, **kwargs: curio.run(f(*args, **kwargs))
+
+
+def make_limits() -> Limits:
+    return Limits(
+        field_side_limits = Range(5, 200),
+        max_client_name_len = UpperBound(50),
+        max_food_items = UpperBound(50),
+        max_password_len = UpperBound(500),
+        max_players_in_a_room = UpperBound(20),
+        max_room_name_len = UpperBound(50),
+        max_snake_len = UpperBound(50),
+        max_turn_timeout = OptionalUpperBound(None),
+        max_turns = OptionalUpperBound(None),
+        turn_delay = 0.0,
+        work_units = WorkLimit(500),
+    )
+
+
+def make_summary(name: str, players, open: RoomOpenness, max_players: int = 3) -> RoomSummary:
+    return RoomSummary(
+        id = 'id-' + name,
+        name = name,
+        players = players,
+        min_players = 2,
+        max_players = max_players,
+        open = open,
+        game_started = False,
+    )
+
+
+class TestControlChannel:
+    @staticmethod
+    @async_run
+    async def test_messages_and_descriptors_are_passed():
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        sender = ControlChannel(curio.io.Socket(a))
+        receiver = ControlChannel(curio.io.Socket(b))
+
+        read_end, write_end = os.pipe()
+        await sender.send({'type': 'first', 'data': b'\x00' * 100000})
+        await sender.send({'type': 'second'}, fd=write_end)
+        await sender.send({'type': 'third'})
+        os.close(write_end)
+
+        assert await receiver.recv() == ({'type': 'first', 'data': b'\x00' * 100000}, None)
+        message, fd = await receiver.recv()
+        assert message == {'type': 'second'}
+        assert await receiver.recv() == ({'type': 'third'}, None)
+
+        # The received descriptor refers to the same pipe.
+        os.write(fd, b'hello')
+        os.close(fd)
+        assert os.read(read_end, 100) == b'hello'
+        os.close(read_end)
+
+        await sender.close()
+        try:
+            await receiver.recv()
+            assert False, 'EOFError expected'
+        except EOFError:
+            pass
+        await receiver.close()
+
+
+class TestRoomDirectory:
+    @staticmethod
+    def test_rooms_of_all_workers_are_listed():
+        directory = RoomDirectory(2)
+        directory.update(0, [make_summary('a', ['X'], RoomOpenness.OPEN())])
+        directory.update(1, [
+            make_summary('b', ['Y'], RoomOpenness.CLOSED()),
+            make_summary('c', ['Z'], RoomOpenness.PASSWORD('')),
+        ])
+
+        infos = list(directory.list_room_infos(ClientName('W')))
+        assert [(info.name, info.can_join) for info in infos] == [('a', 'yes'), ('b', 'no'), ('c', 'password')]
+        assert directory.find_room('c') == 1
+        assert directory.find_room('id-a') == 0
+        assert directory.find_room('d') is None
+        assert directory.find_joinable_room(ClientName('W')) == 0
+
+        directory.update(0, [])
+        assert directory.find_joinable_room(ClientName('W')) is None
+
+    @staticmethod
+    def test_full_rooms_are_not_joinable():
+        directory = RoomDirectory(1)
+        directory.update(0, [make_summary('a', ['X', 'Y'], RoomOpenness.OPEN(), max_players=2)])
+        assert directory.find_joinable_room(ClientName('W')) is None
+        assert directory.find_joinable_room(ClientName('@viewer')) == 0
+
+    @staticmethod
+    def test_new_rooms_go_to_the_least_loaded_worker():
+        directory = RoomDirectory(3)
+        directory.update(0, [make_summary('a', ['X'], RoomOpenness.OPEN())])
+        assert [directory.least_loaded_worker() for _ in range(4)] == [1, 2, 1, 2]
+
+    @staticmethod
+    def test_summaries_survive_serialization():
+        summary = make_summary('a', ['X'], RoomOpenness.WHITELIST(['X', 'Y']))
+        assert RoomSummary.from_primitive(summary.to_primitive()) == summary
+
+
+class TestRoomManagerChanges:
+    @staticmethod
+    def test_changes_are_reported():
+        manager = RoomManager(make_limits())
+        num_changes = 0
+
+        def on_change():
+            nonlocal num_changes
+            num_changes += 1
+
+        manager.add_change_listener(on_change)
+        manager.create_room(ClientName('A'))
+        assert num_changes == 1
+
+        manager.set_room_properties(ClientName('A'), {'name': 'room', 'open': RoomOpenness.PASSWORD('secret')})
+        assert num_changes > 1
+        num_changes = 0
+
+        manager.handle_room_entry(ClientName('B'), 'room', 'secret')
+        assert num_changes == 1
+
+        [summary] = manager.list_room_summaries()
+        assert summary.name == 'room'
+        assert summary.players == ['A', 'B'] or summary.players == ['B', 'A']
+        assert summary.open == RoomOpenness.PASSWORD('')
+
+        num_changes = 0
+        manager.handle_room_quit(ClientName('A'))
+        manager.handle_room_quit(ClientName('B'))
+        assert num_changes >= 2
+        assert manager.list_room_summaries() == []
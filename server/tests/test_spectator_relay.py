@@ -0,0 +1,50 @@
+from bot_arena_server.spectator_relay import SpectatorRelay
+
+import curio
+
+
+def async_run(f):
+    return lambda *args, **kwargs: curio.run(f(*args, **kwargs))
+
+
+class TestSpectatorRelay:
+    @staticmethod
+    @async_run
+    async def test_read_waits_for_updates():
+        relay = SpectatorRelay(capacity=10)
+        reader = await curio.spawn(relay.read, relay.end)
+        await curio.sleep(0)
+        await relay.publish('a')
+        await relay.publish('b')
+        assert await reader.join() == (['a', 'b'], 2)
+
+        await relay.close()
+        assert await relay.read(2) == ([], 2)
+
+    @staticmethod
+    @async_run
+    async def test_lagging_reader_skips_to_keyframe():
+        relay = SpectatorRelay(capacity=3)
+        for entry in ['k0', 'a', 'b', 'c']:
+            await relay.publish(entry, keyframe=entry.startswith('k'))
+        # Nothing to skip to yet, so nothing has been evicted either.
+        assert await relay.read(1) == (['a', 'b', 'c'], 4)
+
+        for entry in ['k4', 'd', 'e']:
+            await relay.publish(entry, keyframe=entry.startswith('k'))
+        assert await relay.read(1) == (['k4', 'd', 'e'], 7)
+        # Readers that keep up are not affected.
+        assert await relay.read(5) == (['d', 'e'], 7)
+
+    @staticmethod
+    @async_run
+    async def test_updates_since_keyframe_are_kept():
+        relay = SpectatorRelay(capacity=2)
+        await relay.publish('k0', keyframe=True)
+        for entry in ['a', 'b', 'c', 'd']:
+            await relay.publish(entry)
+        assert await relay.read(0) == (['k0', 'a', 'b', 'c', 'd'], 5)
+
+        await relay.publish('k5', keyframe=True)
+        await relay.publish('e')
+        assert await relay.read(0) == (['k5', 'e'], 7)
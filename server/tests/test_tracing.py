@@ -0,0 +1,49 @@
+from bot_arena_server.tracing import NULL_TRACER, Tracer
+
+import json
+
+
+class TestTracer:
+    @staticmethod
+    def test_spans_are_exported_as_chrome_trace():
+        tracer = Tracer()
+        with tracer.span('round', 'room', turn=0):
+            with tracer.span('take_turn', 'A', turn=0, player='A'):
+                pass
+        with tracer.span('take_turn', 'B', turn=0, player='B'):
+            pass
+
+        trace = json.loads(json.dumps(tracer.to_chrome_trace()))
+        lanes = {event['tid']: event['args']['name'] for event in trace['traceEvents'] if event['ph'] == 'M'}
+        spans = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+
+        assert sorted(lanes.values()) == ['A', 'B', 'room']
+        # Spans are recorded as they end.
+        assert [(span['name'], lanes[span['tid']]) for span in spans] == [
+            ('take_turn', 'A'),
+            ('round', 'room'),
+            ('take_turn', 'B'),
+        ]
+        inner, outer, _ = spans
+        assert outer['ts'] <= inner['ts']
+        assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+        assert inner['args'] == {'turn': 0, 'player': 'A'}
+
+    @staticmethod
+    def test_events_over_the_limit_are_dropped():
+        tracer = Tracer(max_events=2)
+        for _ in range(5):
+            with tracer.span('turn', 'room'):
+                pass
+
+        trace = tracer.to_chrome_trace()
+        assert len([event for event in trace['traceEvents'] if event['ph'] == 'X']) == 2
+        assert trace['otherData']['dropped_events'] == 3
+
+    @staticmethod
+    def test_null_tracer_records_nothing():
+        with NULL_TRACER.span('turn', 'room', turn=1):
+            pass
+        assert not NULL_TRACER.enabled
+        assert NULL_TRACER.to_chrome_trace()['traceEvents'] == []
+